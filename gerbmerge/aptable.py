@@ -14,6 +14,7 @@ http://ruggedcircuits.com/gerbmerge
 import sys
 import re
 import string
+import copy
 
 import config
 import amacro
@@ -42,17 +43,64 @@ Apertures = (
 for ap in Apertures:
   globals()[ap[0]] = ap
 
-class Aperture:
+# Apertures are values: once constructed, an Aperture cannot be changed.
+# Rotating or adjusting one, or giving it a global code, makes a new one. The
+# canonical key used for hashing and equality, e.g., 'Rectangle (0.01000 x
+# 0.02000)', is computed when the Aperture is constructed. Its aperture code is
+# not part of the key.
+class Aperture(object):
+  __slots__ = ('aptype', 'apname', 'code', 'dimx', 'dimy', 'key')
+
   def __init__(self, aptype, code, dimx, dimy=None):
     assert aptype in Apertures
-    self.apname, self.pat, self.format = aptype
-    self.code = code
-    self.dimx = dimx      # Macro name for Macro apertures
-    self.dimy = dimy      # None for Macro apertures
+    set = object.__setattr__
+    set(self, 'aptype', aptype)
+    set(self, 'apname', aptype[0])
+    set(self, 'code', code)
+    set(self, 'dimx', dimx)      # Macro name for Macro apertures
+    set(self, 'dimy', dimy)      # None for Macro apertures
 
     if self.apname in ('Circle', 'Octagon', 'Macro'):
       assert (dimy is None)
-        
+
+    if dimy:
+      key = '%s (%.5f x %.5f)' % (self.apname, dimx, dimy)
+    elif self.apname in ('Macro',):
+      key = '%s (%s)' % (self.apname, dimx)
+    else:
+      key = '%s (%.5f)' % (self.apname, dimx)
+    set(self, 'key', key)
+
+  def __setattr__(self, name, value):
+    raise AttributeError, 'Aperture objects cannot be modified'
+
+  def __reduce__(self):
+    # Apertures are sent between processes by the name of their type
+    return (makeAperture, (self.apname, self.code, self.dimx, self.dimy))
+
+  def __eq__(self, other):
+    return isinstance(other, Aperture) and self.key == other.key
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash(self.key)
+
+  def getPat(self):
+    return self.aptype[1]
+  pat = property(getPat)
+
+  def getFormat(self):
+    return self.aptype[2]
+  format = property(getFormat)
+
+  def withCode(self, code):
+    "Return this aperture with a different code"
+    if code == self.code:
+      return self
+    return Aperture(self.aptype, code, self.dimx, self.dimy)
+
   def isRectangle(self):
     return self.apname == 'Rectangle'
 
@@ -81,6 +129,11 @@ class Aperture:
       Adjust aperture properties to conform to minimum feature dimensions
       Return new aperture if required, else return False
     """
+    try:
+      return AdjustedApertures[self.key, minimum]
+    except KeyError:
+      pass
+
     dimx = dimy = None
    
     # Check for X and Y dimensions less than minimum
@@ -93,35 +146,33 @@ class Aperture:
     if (dimx != None) or (dimy != None):
       if dimx==None: dimx=self.dimx
       if dimy==None: dimy=self.dimy
-      return Aperture( (self.apname, self.pat, self.format), self.code, dimx, dimy )
+      new = Aperture(self.aptype, self.code, dimx, dimy)
     else:
-      return False ## no new aperture needs to be created
+      new = False ## no new aperture needs to be created
+
+    AdjustedApertures[self.key, minimum] = new
+    return new
 
-  def rotate(self, RevGAMT):
+  def rotated(self, turns=1):
+    "Return this aperture rotated counterclockwise by the given number of quarter turns"
     if self.apname in ('Macro',):
-      # Construct a rotated macro, see if it's in the GAMT, and set self.dimx
-      # to its name if so. If not, add the rotated macro to the GAMT and set
-      # self.dimx to the new name. Recall that GAMT maps name to macro
-      # (e.g., GAMT['M9'] = ApertureMacro(...)) while RevGAMT maps hash to
-      # macro name (e.g., RevGAMT[hash] = 'M9')
-      AMR = config.GAMT[self.dimx].rotated()
-      hash = AMR.hash()
-      try:
-        self.dimx = RevGAMT[hash]
-      except KeyError:
+      # Construct a rotated macro, see if it's in the GAMT, and use its name
+      # if so. If not, add the rotated macro to the GAMT and use the new name.
+      # Recall that GAMT maps name to macro (e.g., GAMT['M9'] = ApertureMacro(...))
+      # and finds macros by hash.
+      AMR = config.GAMT[self.dimx]
+      for turn in range(turns):
+        AMR = AMR.rotated()
+      name = config.GAMT.find(AMR)
+      if name is None:
         AMR = amacro.addToApertureMacroTable(AMR)   # adds to GAMT and modifies name to global name
-        self.dimx = RevGAMT[hash] = AMR.name
+        name = AMR.name
+      return Aperture(self.aptype, self.code, name)
 
-    elif self.dimy is not None:       # Rectangles and Ovals have a dimy setting and need to be rotated
-      t = self.dimx
-      self.dimx = self.dimy
-      self.dimy = t
+    elif self.dimy is not None and (turns & 1):   # Rectangles and Ovals have a dimy setting and need to be rotated
+      return Aperture(self.aptype, self.code, self.dimy, self.dimx)
 
-  def rotated(self, RevGAMT):
-    # deepcopy doesn't work on re patterns for some reason so we copy ourselves manually
-    APR = Aperture((self.apname, self.pat, self.format), self.code, self.dimx, self.dimy)
-    APR.rotate(RevGAMT)
-    return APR
+    return self
 
   def dump(self, fid=sys.stdout):
     fid.write(str(self))
@@ -138,13 +189,7 @@ class Aperture:
     #      return ('%s: %s (%.4f)' % (self.code, self.apname, self.dimx))
 
   def hash(self):
-    if self.dimy:
-      return ('%s (%.5f x %.5f)' % (self.apname, self.dimx, self.dimy))
-    else:
-      if self.apname in ('Macro',):
-        return ('%s (%s)' % (self.apname, self.dimx))
-      else:
-        return ('%s (%.5f)' % (self.apname, self.dimx))
+    return self.key
 
   def writeDef(self, fid):
     if self.dimy:
@@ -152,6 +197,24 @@ class Aperture:
     else:
       fid.write(self.format % (self.code, self.dimx))
 
+# Results of Aperture.getAdjusted(), indexed by (aperture key, minimum). These
+# only depend on the aperture dimensions so they are never out of date.
+AdjustedApertures = {}
+
+# Identical aperture definitions, e.g., the same D-codes defined by the same
+# CAD program in every layer of every job, share one Aperture object. This
+# dictionary is indexed by (type name, code, dimx, dimy).
+InternedApertures = {}
+
+def makeAperture(apname, code, dimx, dimy=None):
+  "Return the Aperture of type 'apname' (e.g., 'Circle') with the given code and dimensions"
+  k = (apname, code, dimx, dimy)
+  try:
+    return InternedApertures[k]
+  except KeyError:
+    A = InternedApertures[k] = Aperture(globals()[apname], code, dimx, dimy)
+    return A
+
 # Parse the aperture definition in line 's'. macroNames is an aperture macro dictionary
 # that translates macro names local to this file to global names in the GAMT. We make
 # the translation right away so that the return value from this function is an aperture
@@ -179,13 +242,13 @@ def parseAperture(s, knownMacroNames):
         except:
           raise RuntimeError, "Illegal floating point aperture size"
 
-      return Aperture(ap, code, dimx, dimy)
+      return makeAperture(ap[0], code, dimx, dimy)
 
   return None
 
-# This function returns a dictionary where each key is an
-# aperture code string (e.g., "D11") and the value is the
-# Aperture object that represents it. For example:
+# This function constructs the global aperture table, a dictionary where each
+# key is an aperture code string (e.g., "D11") and the value is the Aperture
+# object that represents it. For example:
 #
 #    %ADD12R,0.0630X0.0630*%
 #
@@ -193,80 +256,72 @@ def parseAperture(s, knownMacroNames):
 #
 #    "D12": Aperture(ap, 'D10', 0.063, 0.063)
 #
-# The input fileList is a list of pathnames which will be read to construct the
-# aperture table for a job.  All the files in the given list will be so
-# examined, and a global aperture table will be constructed as a dictionary.
-# Same goes for the global aperture macro table.
-
-tool_pat  = re.compile(r'^(?:G54)?D\d+\*$')
-
-def constructApertureTable(fileList):
+# The input layerList is a list of (job, layername) tuples for Gerber layers
+# that have already been read in by Job.parseGerber(), which keeps the aperture
+# and aperture macro definitions local to each layer (job.apdefs and
+# job.apmdefs). All the layers in the given list will be so examined, and a
+# global aperture table will be constructed as a dictionary. Same goes for the
+# global aperture macro table. The per-layer translation tables job.apxlat and
+# job.apmxlat are filled in along the way.
+
+def constructApertureTable(layerList):
   # First we construct a dictionary where each key is the
   # string representation of the aperture. Then we go back and assign
   # numbers. For aperture macros, we construct their final version
-  # (i.e., 'M1', 'M2', etc.) right away, as they are parsed. Thus,
+  # (i.e., 'M1', 'M2', etc.) right away, as they are encountered. Thus,
   # we translate from 'THX10N' or whatever to 'M2' right away.
   GAT = config.GAT      # Global Aperture Table
   GAT.clear()
+  RotatedApertures.clear()
   GAMT = config.GAMT    # Global Aperture Macro Table
   GAMT.clear()
-  RevGAMT = {}          # Dictionary keyed by aperture macro hash and returning macro name
-
-  AT = {}               # Aperture Table for this file
-  for fname in fileList:
-    #print 'Reading apertures from %s ...' % fname
-
-    knownMacroNames = {}
-
-    fid = file(fname,'rt')
-    for line in fid:
-      # Get rid of CR
-      line = line.replace('\x0D', '')
-
-      if tool_pat.match(line):
-        break # When tools start, no more apertures are being defined
-
-      # If this is an aperture macro definition, add its string
-      # representation to the dictionary. It might already exist.
-      # Ignore %AMOC8* from Eagle for now as it uses a macro parameter.
-      if line[:7]=='%AMOC8*':
-        continue
-
-      # parseApertureMacro() sucks up all macro lines up to terminating '%'
-      AM = amacro.parseApertureMacro(line, fid)
-      if AM:
-        # Has this macro definition already been defined (perhaps by another name
-        # in another layer)?
-        try:
-          # If this macro has already been encountered anywhere in any job,
-          # RevGAMT will map the macro hash to the global macro name. Then,
-          # make the local association knownMacroNames[localMacroName] = globalMacroName.
-          knownMacroNames[AM.name] = RevGAMT[AM.hash()]
-        except KeyError:
-          # No, so define the global macro and do the translation. Note that
-          # addToApertureMacroTable() MODIFIES AM.name to the new M-name.
-          localMacroName = AM.name
-          AM = amacro.addToApertureMacroTable(AM)
-          knownMacroNames[localMacroName] = AM.name
-          RevGAMT[AM.hash()] = AM.name
-      else:
-        A = parseAperture(line, knownMacroNames)
-
-        # If this is an aperture definition, add the string representation
-        # to the dictionary. It might already exist.
-        if A:
-          AT[A.hash()] = A
 
-    fid.close()
+  AT = {}               # Aperture Table for all layers
+  layerHashes = []      # For each layer, list of (local code, aperture hash) pairs
+  for job, layername in layerList:
+    knownMacroNames = job.apmxlat[layername] = {}
+
+    for AM in job.apmdefs[layername]:
+      # Has this macro definition already been defined (perhaps by another name
+      # in another layer)?
+      # If this macro has already been encountered anywhere in any job,
+      # the GAMT will find its global macro name. Then, make the local
+      # association knownMacroNames[localMacroName] = globalMacroName.
+      name = GAMT.find(AM)
+      if name is None:
+        # No, so define the global macro and do the translation. Note that
+        # addToApertureMacroTable() MODIFIES the name to the new M-name so
+        # we give it a copy, leaving the local definition alone.
+        name = amacro.addToApertureMacroTable(copy.copy(AM)).name
+      knownMacroNames[AM.name] = name
+
+    hashes = []
+    for A in job.apdefs[layername]:
+      # Macro apertures refer to the GLOBAL, permanent macro name (e.g., 'M2')
+      if A.apname in ('Macro',):
+        A = Aperture(A.aptype, A.code, knownMacroNames[A.dimx])
+
+      # Add the string representation to the dictionary. It might already exist.
+      hash = A.hash()
+      AT[hash] = A
+      hashes.append((A.code, hash))
+
+    layerHashes.append(hashes)
 
   # Now, go through and assign sequential codes to all apertures
   code = 10
   for val in AT.values():
     key = 'D%d' % code
-    GAT[key] = val
-    val.code = key
+    GAT[key] = val.withCode(key)
     code += 1
 
+  # Finally, map the local aperture codes of each layer to global ones
+  RevGAT = GAT.index    # Maps aperture hash to global code
+  for (job, layername), hashes in zip(layerList, layerHashes):
+    xlat = job.apxlat[layername] = config.CodeTable()
+    for code, hash in hashes:
+      xlat[code] = RevGAT[hash]
+
   if 0:
     keylist = config.GAT.keys()
     keylist.sort()
@@ -276,49 +331,62 @@ def constructApertureTable(fileList):
       print '%s' % config.GAT[key]
     sys.exit(0)
 
-def findHighestApertureCode(keys):
-  "Find the highest integer value in a list of aperture codes: ['D10', 'D23', 'D35', ...]"
-
-  # Must sort keys by integer value, not string since 99 comes before 100
-  # as an integer but not a string.
-  keys = [int(K[1:]) for K in keys]
-  keys.sort()
-
-  return keys[-1]
-
 def addToApertureTable(AP):
-  GAT = config.GAT
-
-  lastCode = findHighestApertureCode(GAT.keys())
-  code = 'D%d' % (lastCode+1)
-  GAT[code] = AP
-  AP.code = code
+  "Add aperture AP to the GAT under a new code, one higher than the highest code so far"
+  code = config.GAT.newCode()
+  config.GAT[code] = AP.withCode(code)
 
   return code
   
 def findInApertureTable(AP):
   """Return 'D10', for example in response to query for an object
      of type Aperture()"""
-  hash = AP.hash()
-  for key, val in config.GAT.items():
-    if hash==val.hash():
-      return key
-
-  return None
+  return config.GAT.find(AP)
 
 def findOrAddAperture(AP):
-  """If the aperture exists in the GAT, modify the AP.code field to reflect the global code
-  and return the code. Otherwise, create a new aperture in the GAT and return the new code
-  for it."""
+  """If the aperture exists in the GAT, return its global code. Otherwise, create
+  a new aperture in the GAT and return the new code for it."""
   code = findInApertureTable(AP)
   if code:
-    AP.code = code
     return code
   else:
     return addToApertureTable(AP)
 
+# Codes of rotated apertures in the GAT, indexed by (code, turns) where code is
+# the aperture that was rotated and turns is the number of counterclockwise
+# quarter turns. This is filled in as jobs are rotated (see findRotatedAperture())
+# and is cleared along with the GAT.
+RotatedApertures = {}
+
+def findRotatedAperture(code, turns):
+  """Return the code of the aperture in the GAT that is aperture 'code' rotated
+  counterclockwise by the given number of quarter turns, adding the rotated
+  aperture (and aperture macro) to the GAT (and GAMT) if necessary"""
+  try:
+    return RotatedApertures[code, turns]
+  except KeyError:
+    pass
+
+  A = config.GAT[code]
+  if A.apname in ('Circle', 'Octagon') or (A.apname != 'Macro' and turns == 2):
+    # These apertures look the same after rotation
+    newcode = code
+  else:
+    APR = A.rotated(turns)
+    newcode = findOrAddAperture(APR)
+
+  RotatedApertures[code, turns] = newcode
+  return newcode
+
 if __name__=="__main__":
-  constructApertureTable(sys.argv[1:])
+  import jobs
+
+  layerList = []
+  J = jobs.Job('apertures')
+  for fname in sys.argv[1:]:
+    J.parseGerber(fname, fname)
+    layerList.append((J, fname))
+  constructApertureTable(layerList)
 
   keylist = config.GAMT.keys()
   keylist.sort()
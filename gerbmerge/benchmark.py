@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the time-critical parts of GerbMerge. Run from the
+gerbmerge directory, for example:
+
+    python benchmark.py parse ../testdata/hexapod.plc
+    python benchmark.py inlets 20
+
+Run it with no arguments for a list of benchmarks.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import sys
+import os
+import re
+import time
+import random
+import tempfile
+
+import config
+import aptable
+import jobs
+import cmdlist
+import tiling
+
+# Drawing commands of a Gerber file start with the first aperture selection
+tool_pat = re.compile(r'^(?:G54)?D\d+\*$')
+
+# Scale factors applied to the input file, i.e., how many copies of its
+# drawing commands end up in the file that is benchmarked.
+Scales = (1, 10, 100)
+
+# Each measurement is repeated this many times and the best time is reported
+Repeats = 3
+
+def bestTime(func, *args):
+  "Return the smallest wall-clock time in seconds taken by func(*args)"
+  best = None
+  for count in range(Repeats):
+    start = time.time()
+    func(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return max(best, 1e-6)
+
+def scaleGerber(fname, scale):
+  """Return the lines of Gerber file 'fname' with its drawing commands
+  (everything after the aperture definitions and before M02) repeated
+  'scale' times."""
+  fid = file(fname, 'rt')
+  lines = fid.readlines()
+  fid.close()
+
+  for ix in range(len(lines)):
+    if tool_pat.match(lines[ix].replace('\x0D', '')):
+      break
+  header, body = lines[:ix], lines[ix:]
+
+  footer = []
+  while body and body[-1].strip() in ('', 'M02*', 'M2*'):
+    footer.insert(0, body.pop())
+
+  return header + body*scale + footer
+
+def benchParse(fname):
+  "Report Gerber parsing speed in lines per second on scaled copies of a file"
+  print 'Parsing %s' % fname
+  for scale in Scales:
+    lines = scaleGerber(fname, scale)
+    fd, tmpname = tempfile.mkstemp('.ger')
+    os.write(fd, ''.join(lines))
+    os.close(fd)
+
+    try:
+      def parse():
+        J = jobs.Job('benchmark')
+        J.parseGerber(tmpname, '*benchmark', updateExtents=1)
+        aptable.constructApertureTable([(J, '*benchmark')])
+        J.translateApertures('*benchmark')
+
+      elapsed = bestTime(parse)
+    finally:
+      os.remove(tmpname)
+
+    print '  x%-4d %8d lines  %7.3f s  %10.0f lines/s' % (scale, len(lines), elapsed, len(lines)/elapsed)
+
+def listSize(commands):
+  "Return the memory in bytes taken by a list of commands as strings and tuples"
+  total = sys.getsizeof(commands)
+  seen = {}
+  for cmd in commands:
+    total += sys.getsizeof(cmd)
+    if type(cmd) is tuple:
+      for item in cmd:
+        # Small integers and True/False are shared by all commands
+        if id(item) not in seen and not (type(item) is int and -5 <= item <= 256) \
+           and type(item) is not bool:
+          total += sys.getsizeof(item)
+    seen[id(cmd)] = None
+  return total
+
+def benchMemory(fname):
+  "Report the memory taken by the commands of a Gerber layer, as lists of tuples and as arrays"
+  print 'Memory for commands in %s' % fname
+  J = jobs.Job('benchmark')
+  J.parseGerber(fname, '*benchmark', updateExtents=1)
+  L = J.commands['*benchmark']
+  listBytes = listSize(list(L))
+  arrayBytes = L.nbytes() + sys.getsizeof(L.names) + sum([sys.getsizeof(name) for name in L.names])
+  print '  %d commands' % len(L)
+  print '  list of tuples: %10d bytes  %6.1f bytes/command' % (listBytes, float(listBytes)/len(L))
+  print '  arrays:         %10d bytes  %6.1f bytes/command' % (arrayBytes, float(arrayBytes)/len(L))
+  print '  ratio:          %10.1f' % (float(listBytes)/arrayBytes)
+
+def loopShift(commands, x_shift, y_shift):
+  "Shift a list of commands one at a time, as Job.fixcoordinates() used to"
+  for index in range(len(commands)):
+    c = commands[index]
+    if type(c) is tuple:
+      command_list = list(c)
+      if (type(command_list[0]) is int) and (type(command_list[1]) is int):
+        command_list[0] += x_shift
+        command_list[1] += y_shift
+      commands[index] = tuple(command_list)
+
+def benchShift(fname):
+  "Report the speed of shifting all co-ordinates of scaled copies of a Gerber layer"
+  print 'Shifting %s' % fname
+  for scale in Scales:
+    fd, tmpname = tempfile.mkstemp('.ger')
+    os.write(fd, ''.join(scaleGerber(fname, scale)))
+    os.close(fd)
+
+    try:
+      J = jobs.Job('benchmark')
+      J.parseGerber(tmpname, '*benchmark', updateExtents=1)
+    finally:
+      os.remove(tmpname)
+
+    L = J.commands['*benchmark']
+    commands = list(L)
+    results = [('loop', bestTime(loopShift, commands, 1000, 1000))]
+
+    if cmdlist.numpy is not None:
+      results.append(('numpy', bestTime(L.shift, 1000, 1000)))
+
+    # Now without NumPy
+    saved, cmdlist.numpy = cmdlist.numpy, None
+    try:
+      results.append(('array', bestTime(L.shift, 1000, 1000)))
+    finally:
+      cmdlist.numpy = saved
+
+    print '  x%-4d %8d commands' % (scale, len(L)),
+    for name, elapsed in results:
+      print ' %s %8.4f s' % (name, elapsed),
+    print ' speedup %.0fx' % (results[0][1]/min([elapsed for name, elapsed in results[1:]]))
+
+def loopWriteGerber(fid, commands, DX, DY):
+  "Write a list of commands one at a time, as Job.writeGerber() used to"
+  for cmd in commands:
+    if type(cmd) is tuple:
+      if len(cmd)==3:
+        x, y, d = cmd
+        fid.write('X%07dY%07dD%02d*\n' % (x+DX, y+DY, d))
+      else:
+        x, y, I, J, d, s = cmd
+        fid.write('X%07dY%07dI%07dJ%07dD%02d*\n' % (x+DX, y+DY, I, J, d))
+    elif cmd[0]=='%':
+      fid.write('%s\n' % cmd)
+    else:
+      fid.write('%s*\n' % cmd)
+
+def templateWriteGerber(fid, L, DX, DY):
+  "Format a CommandList into a template and write it"
+  cmdlist.GerberTemplate(L).write(fid, DX, DY)
+
+def benchWrite(fname):
+  """Report Gerber writing speed in MB/s on scaled copies of a Gerber layer,
+  for the old one-command-at-a-time writer, for a template formatted and
+  written once, and for a template written again (i.e., another copy of a
+  repeated job)"""
+  print 'Writing %s' % fname
+  for scale in Scales:
+    fd, tmpname = tempfile.mkstemp('.ger')
+    os.write(fd, ''.join(scaleGerber(fname, scale)))
+    os.close(fd)
+
+    try:
+      J = jobs.Job('benchmark')
+      J.parseGerber(tmpname, '*benchmark', updateExtents=1)
+    finally:
+      os.remove(tmpname)
+
+    L = J.commands['*benchmark']
+    commands = list(L)
+    template = cmdlist.GerberTemplate(L)
+
+    fd, outname = tempfile.mkstemp('.ger')
+    os.close(fd)
+    try:
+      def timeWrite(func, *args):
+        def run():
+          fid = file(outname, 'wb')
+          func(fid, *args)
+          fid.close()
+        elapsed = bestTime(run)
+        fid = file(outname, 'rb')
+        data = fid.read()
+        fid.close()
+        return elapsed, data
+
+      results = [('loop',) + timeWrite(loopWriteGerber, commands, 1000, 1000),
+                 ('template',) + timeWrite(templateWriteGerber, L, 1000, 1000),
+                 ('reuse',) + timeWrite(template.write, 1000, 1000)]
+    finally:
+      os.remove(outname)
+
+    for name, elapsed, data in results[1:]:
+      if data != results[0][2]:
+        raise RuntimeError, 'Output of %s writer differs from loop writer' % name
+
+    size = len(results[0][2])
+    print '  x%-4d %8d commands %6.1f MB' % (scale, len(L), size/1e6),
+    for name, elapsed, data in results:
+      print ' %s %6.1f MB/s' % (name, size/1e6/elapsed),
+    print
+
+def loopRemoveInlets(T, minSize):
+  "Remove inlets from tiling T, searching again from the start after each change, as Tiling.removeInlets() used to"
+  pt = T.points
+  done = 0
+
+  while not done:
+    for ix in range(0, len(pt)-3):
+      if tiling.right_of(pt[ix],pt[ix+1]) and tiling.above(pt[ix+1],pt[ix+2]) and tiling.left_of(pt[ix+2],pt[ix+3]):
+        if pt[ix][1]-pt[ix+3][1] < minSize:
+          T.replacePoints(ix, ix+3, [(pt[ix][0],pt[ix+3][1])])
+          break
+
+      if tiling.left_of(pt[ix],pt[ix+1]) and tiling.below(pt[ix+1],pt[ix+2]) and tiling.right_of(pt[ix+2],pt[ix+3]):
+        if pt[ix+3][1]-pt[ix][1] < minSize:
+          T.replacePoints(ix+1, ix+4, [(pt[ix+3][0], pt[ix][1])])
+          break
+
+      if tiling.above(pt[ix],pt[ix+1]) and tiling.left_of(pt[ix+1],pt[ix+2]) and tiling.below(pt[ix+2],pt[ix+3]):
+        if pt[ix+3][0]-pt[ix][0] < minSize:
+          if pt[ix+3][1]>=pt[ix][1]:
+            T.replacePoints(ix, ix+3, [(pt[ix+3][0], pt[ix][1])])
+          else:
+            T.replacePoints(ix+1, ix+4, [(pt[ix][0], pt[ix+3][1])])
+          break
+    else:
+      done = 1
+
+def deepTiling(count, r):
+  """Return a tiling of count small jobs placed at random add-points without
+  removing inlets, so that its outline has many points and inlets"""
+  S = 2.0*count**0.5
+  T = tiling.Tiling(S, S)
+  for n in range(count):
+    X = r.uniform(0.3, 1.5)
+    Y = r.uniform(0.3, 1.5)
+    points = T.validAddPoints(X, Y)
+    if points:
+      T.addJob(r.choice(points), X, Y, None)
+  return T
+
+def benchInlets(count):
+  """Report the speed of removing inlets from tilings of scaled numbers of
+  jobs, searching from the start after each change and searching on from
+  the change"""
+  count = int(count)
+
+  # Normally set from the configuration file
+  config.Config['xspacing'] = config.Config['yspacing'] = 0.125
+
+  print 'Removing inlets from tilings of %d jobs and more' % count
+  for scale in Scales:
+    T = deepTiling(count*scale, random.Random(scale))
+
+    results = []
+    for name, func in (('loop', loopRemoveInlets), ('removeInlets', tiling.Tiling.removeInlets)):
+      copies = [T.clone() for n in range(Repeats)]
+      def run():
+        func(copies.pop(), 1.0)
+      elapsed = bestTime(run)
+
+      U = T.clone()
+      func(U, 1.0)
+      results.append((name, elapsed, U.points))
+
+    if results[1][2] != results[0][2]:
+      raise RuntimeError, 'Points left by removeInlets differ from loop'
+
+    print '  x%-4d %6d points -> %6d' % (scale, len(T.points), len(results[0][2])),
+    for name, elapsed, points in results:
+      print ' %s %8.4f s' % (name, elapsed),
+    print ' speedup %.0fx' % (results[0][1]/results[1][1])
+
+Benchmarks = {
+  'parse': (benchParse, '../testdata/hexapod.plc'),
+  'shift': (benchShift, '../testdata/hexapod.plc'),
+  'memory': (benchMemory, '../testdata/hexapod.cmp'),
+  'write': (benchWrite, '../testdata/hexapod.cmp'),
+  'inlets': (benchInlets, '20'),
+  }
+
+if __name__=="__main__":
+  if len(sys.argv) < 2 or not Benchmarks.has_key(sys.argv[1]):
+    names = Benchmarks.keys()
+    names.sort()
+    print 'Usage: benchmark.py %s [file]' % '|'.join(names)
+    sys.exit(1)
+
+  func, default = Benchmarks[sys.argv[1]]
+  if len(sys.argv) > 2:
+    func(sys.argv[2])
+  else:
+    func(default)
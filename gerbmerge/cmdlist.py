@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Compact storage for the commands of one Gerber layer of a job.
+
+Rather than a list of strings and tuples, commands are stored column-wise in
+arrays: an opcode per command, X/Y/I/J co-ordinates as 32-bit integers, the
+D01/D02/D03 code of drawing commands, and, for all other commands, an index
+into a table of interned strings. Iterating over a CommandList returns the
+commands in the form described in jobs.Job, so code that only reads commands
+need not know about the arrays.
+
+Appending to an array one item at a time is slow, so while a CommandList is
+being built its columns are ordinary lists. Call compact() once all commands
+have been appended to turn them into arrays.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import sys
+import array
+import itertools
+import types
+
+# NumPy is optional. It is only used to shift co-ordinates.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Opcodes
+DRAW = 0        # (X,Y,D)
+ARC = 1         # (X,Y,I,J,D,False), unsigned (I,J) offsets
+SARC = 2        # (X,Y,I,J,D,True), signed (I,J) offsets
+CODE = 3        # G-code (e.g., 'G36'), RS-274X command (e.g., '%LPD*%') or D01/D02/D03
+APERTURE = 4    # Aperture change (e.g., 'D12')
+
+class CommandList(object):
+  __slots__ = ('op', 'x', 'y', 'i', 'j', 'd', 'names', 'nameIndex')
+
+  def __init__(self, commands=()):
+    self.op = []
+    self.x = []
+    self.y = []
+    self.i = []
+    self.j = []
+    self.d = []       # D-code for drawing commands, index into names for others
+
+    # Interned strings for CODE and APERTURE commands. The index of each
+    # string in 'names' is kept in 'nameIndex'.
+    self.names = []
+    self.nameIndex = {}
+
+    if commands:
+      for cmd in commands:
+        self.append(cmd)
+      self.compact()
+
+  def compact(self):
+    "Turn columns that are lists into arrays"
+    if type(self.op) is list:
+      self.op = array.array('B', self.op)
+      self.x = array.array('i', self.x)
+      self.y = array.array('i', self.y)
+      self.i = array.array('i', self.i)
+      self.j = array.array('i', self.j)
+      if len(self.names) > 256:
+        self.d = array.array('i', self.d)
+      else:
+        self.d = array.array('B', self.d)
+
+  def __len__(self):
+    return len(self.op)
+
+  def intern(self, name):
+    "Return the index of string 'name' in the names table, adding it if necessary"
+    try:
+      return self.nameIndex[name]
+    except KeyError:
+      ix = self.nameIndex[name] = len(self.names)
+      self.names.append(name)
+      return ix
+
+  def appendDraw(self, x, y, d):
+    self.op.append(DRAW)
+    self.x.append(x)
+    self.y.append(y)
+    self.i.append(0)
+    self.j.append(0)
+    self.d.append(d)
+
+  def appendArc(self, x, y, I, J, d, signed):
+    if signed:
+      self.op.append(SARC)
+    else:
+      self.op.append(ARC)
+    self.x.append(x)
+    self.y.append(y)
+    self.i.append(I)
+    self.j.append(J)
+    self.d.append(d)
+
+  def appendCode(self, code):
+    "Append a G-code, RS-274X command or D01/D02/D03"
+    self.appendName(CODE, code)
+
+  def appendAperture(self, code):
+    "Append an aperture change"
+    self.appendName(APERTURE, code)
+
+  def appendName(self, op, name):
+    ix = self.intern(name)
+    if ix > 255 and type(self.d) is not list and self.d.typecode == 'B':
+      # More distinct strings than fit in a byte. Widen the column.
+      self.d = array.array('i', self.d)
+    self.op.append(op)
+    self.x.append(0)
+    self.y.append(0)
+    self.i.append(0)
+    self.j.append(0)
+    self.d.append(ix)
+
+  def append(self, cmd):
+    "Append a command given as a string or tuple, as described in jobs.Job"
+    if type(cmd) is types.TupleType:
+      if len(cmd)==3:
+        self.appendDraw(*cmd)
+      else:
+        self.appendArc(*cmd)
+    elif cmd[0]=='D' and int(cmd[1:])>=10:
+      self.appendAperture(cmd)
+    else:
+      self.appendCode(cmd)
+
+  def extend(self, commands):
+    for cmd in commands:
+      self.append(cmd)
+
+  def command(self, ix):
+    "Return command number 'ix' as a string or tuple"
+    op = self.op[ix]
+    if op==DRAW:
+      return (self.x[ix], self.y[ix], self.d[ix])
+    if op==ARC or op==SARC:
+      return (self.x[ix], self.y[ix], self.i[ix], self.j[ix], self.d[ix], op==SARC)
+    return self.names[self.d[ix]]
+
+  __getitem__ = command
+
+  def __iter__(self):
+    names = self.names
+    for op, x, y, i, j, d in itertools.izip(self.op, self.x, self.y, self.i, self.j, self.d):
+      if op==DRAW:
+        yield (x, y, d)
+      elif op==CODE or op==APERTURE:
+        yield names[d]
+      else:
+        yield (x, y, i, j, d, op==SARC)
+
+  def __eq__(self, other):
+    if isinstance(other, CommandList):
+      return list(self)==list(other)
+    return list(self)==other
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __repr__(self):
+    return 'CommandList(%r)' % list(self)
+
+  def renameApertures(self, xlat):
+    """Replace aperture codes in aperture change commands: each code that is a
+    key in dictionary xlat is replaced with the corresponding value. Since
+    aperture codes are interned, this does not depend on the number of commands.
+    The names table is replaced rather than modified, so snapshots taken
+    earlier are not affected."""
+    self.names = [xlat.get(name, name) for name in self.names]
+    self.buildNameIndex()
+
+  def snapshot(self):
+    """Return a CommandList that shares the arrays of this one but is not
+    affected by later renaming of apertures in this one"""
+    self.compact()
+    L = CommandList()
+    L.op, L.x, L.y, L.i, L.j, L.d = self.op, self.x, self.y, self.i, self.j, self.d
+    L.names = self.names
+    L.nameIndex = self.nameIndex
+    return L
+
+  def buildNameIndex(self):
+    "Construct nameIndex from names. Where a name appears more than once the first one is used."
+    self.nameIndex = {}
+    for ix in range(len(self.names)-1, -1, -1):
+      self.nameIndex[self.names[ix]] = ix
+
+  def aperturesUsed(self):
+    "Return the distinct aperture codes of aperture change commands, in order of first use"
+    names = self.names
+    used = {}
+    L = []
+    for op, d in itertools.izip(self.op, self.d):
+      if op==APERTURE and not used.has_key(names[d]):
+        used[names[d]] = None
+        L.append(names[d])
+    return L
+
+  def shift(self, dx, dy):
+    """Add (dx,dy) to the co-ordinates of all drawing commands. The X/Y columns
+    are unused for other commands so they are shifted along with the rest. The
+    columns are replaced rather than modified, so snapshots taken earlier are
+    not affected."""
+    self.compact()
+    if numpy is not None:
+      x = numpy.frombuffer(self.x, self.x.typecode) + dx
+      self.x = array.array('i', x.astype(self.x.typecode).tostring())
+      y = numpy.frombuffer(self.y, self.y.typecode) + dy
+      self.y = array.array('i', y.astype(self.y.typecode).tostring())
+    else:
+      self.x = array.array('i', map(dx.__add__, self.x))
+      self.y = array.array('i', map(dy.__add__, self.y))
+
+  def transformed(self, transform, xlat):
+    """Return a copy of this list with co-ordinates transformed and aperture codes
+    that are keys in dictionary xlat replaced with the corresponding values. The
+    transform (a,b,c,d,e,f) maps (X,Y) to (a*X+b*Y+c, d*X+e*Y+f), where (a,b,d,e)
+    is a rotation by a multiple of 90 degrees."""
+    self.compact()
+    a, b, c, d, e, f = transform
+
+    L = CommandList()
+    L.op = self.op[:]
+    L.d = self.d[:]
+    L.x = affine(self.x, self.y, a, b, c)
+    L.y = affine(self.x, self.y, d, e, f)
+
+    # (I,J) components are relative so they are only rotated. Signed offsets
+    # are rotated as vectors, while unsigned offsets are just swapped for odd
+    # numbers of quarter turns.
+    I = affine(self.i, self.j, a, b, 0)
+    J = affine(self.i, self.j, d, e, 0)
+    if a == 0:
+      UI, UJ = self.j, self.i
+    else:
+      UI, UJ = self.i, self.j
+    L.i = array.array('i', [(ui, si)[op==SARC] for op, ui, si in itertools.izip(self.op, UI, I)])
+    L.j = array.array('i', [(uj, sj)[op==SARC] for op, uj, sj in itertools.izip(self.op, UJ, J)])
+
+    L.names = [xlat.get(name, name) for name in self.names]
+    L.buildNameIndex()
+    return L
+
+  def nbytes(self):
+    "Return the approximate memory taken by the command arrays, in bytes"
+    self.compact()
+    total = 0
+    for column in (self.op, self.x, self.y, self.i, self.j, self.d):
+      total += len(column)*column.itemsize
+    return total
+
+  def __getstate__(self):
+    self.compact()
+    return (self.op.tostring(), self.x.tostring(), self.y.tostring(), \
+            self.i.tostring(), self.j.tostring(), self.d.typecode, self.d.tostring(), self.names)
+
+  def __setstate__(self, state):
+    op, x, y, i, j, dtype, d, names = state
+    self.op = array.array('B', op)
+    self.x = array.array('i', x)
+    self.y = array.array('i', y)
+    self.i = array.array('i', i)
+    self.j = array.array('i', j)
+    self.d = array.array(dtype, d)
+    self.names = names
+    self.buildNameIndex()
+
+# A GerberTemplate is the Gerber text of a CommandList with the X/Y
+# co-ordinates of drawing commands left as %07d fields, since they are the only
+# part of the text that depends on where a job is placed. Everything else,
+# including I/J offsets, D-codes and aperture changes, is formatted once. The
+# text is split into chunks of at most ChunkSize commands and each chunk is
+# filled in with a single '%' operation, so writing another copy of a job
+# (e.g., for Repeat) costs little more than adding the offset to the
+# co-ordinates.
+class GerberTemplate(object):
+  __slots__ = ('chunks',)
+
+  ChunkSize = 4096
+
+  def __init__(self, L):
+    L.compact()
+    self.chunks = []    # (format string, X co-ordinates, Y co-ordinates)
+
+    # Text of each interned name and of each kind of draw, formatted once
+    nameText = []
+    for name in L.names:
+      name = name.replace('%', '%%')
+      if name[0]=='%':
+        nameText.append(name + '\n')   # The command already has a * in it (e.g., "%LPD*%")
+      else:
+        nameText.append(name + '*\n')
+    drawText = {}
+
+    chunkSize = self.ChunkSize
+    parts = []
+    X = []
+    Y = []
+    for op, x, y, I, J, d in itertools.izip(L.op, L.x, L.y, L.i, L.j, L.d):
+      if op==DRAW:
+        try:
+          parts.append(drawText[d])
+        except KeyError:
+          parts.append(drawText.setdefault(d, 'X%%07dY%%07dD%02d*\n' % d))
+        X.append(x)
+        Y.append(y)
+      elif op>=CODE:
+        parts.append(nameText[d])
+      else:
+        parts.append('X%%07dY%%07dI%07dJ%07dD%02d*\n' % (I, J, d))   # I,J are relative
+        X.append(x)
+        Y.append(y)
+
+      if len(parts) == chunkSize:
+        self.addChunk(parts, X, Y)
+        parts = []
+        X = []
+        Y = []
+
+    if parts:
+      self.addChunk(parts, X, Y)
+
+  def addChunk(self, parts, X, Y):
+    self.chunks.append((''.join(parts), array.array('i', X), array.array('i', Y)))
+
+  def render(self, DX, DY):
+    "Generate the text of each chunk with (DX,DY) added to all X/Y co-ordinates"
+    for fmt, X, Y in self.chunks:
+      # Interleave the shifted co-ordinates without a Python-level loop
+      values = [0]*(2*len(X))
+      values[0::2] = map(DX.__add__, X)
+      values[1::2] = map(DY.__add__, Y)
+      yield fmt % tuple(values)
+
+  def write(self, fid, DX, DY):
+    fid.writelines(self.render(DX, DY))
+
+def affine(U, V, p, q, r):
+  "Return an array of p*u+q*v+r for u, v in arrays U and V, where one of p and q is 0"
+  if q == 0:
+    if p == 1:
+      return array.array('i', map(r.__add__, U))
+    return array.array('i', [p*u + r for u in U])
+  if q == 1:
+    return array.array('i', map(r.__add__, V))
+  return array.array('i', [q*v + r for v in V])
+
+if __name__=="__main__":
+  L = CommandList(['G75', '%LPD*%', 'D10', (0,0,2), (100,200,1), (5,6,7,8,1,True), 'D03'])
+  print list(L)
+  L.renameApertures({'D10': 'D15'})
+  L.shift(1000, 2000)
+  print list(L), L.aperturesUsed(), L.nbytes()
+  print list(L.transformed((0, -1, 3300, 1, 0, 1000), {'D15': 'D16'}))
+  sys.stdout.writelines(GerberTemplate(L).render(-1000, -2000))
+
+  # Shifting a list does not shift its snapshots, with or without NumPy
+  for numpy in (numpy, None):
+    L = CommandList([(0,0,2), (100,200,1), (5,6,7,8,1,True)])
+    S = L.snapshot()
+    L.shift(1000, 2000)
+    assert list(S) == [(0,0,2), (100,200,1), (5,6,7,8,1,True)]
+    assert list(L) == [(1000,2000,2), (1100,2200,1), (1005,2006,7,8,1,True)]
+  print 'All tests pass'
@@ -12,12 +12,20 @@ http://ruggedcircuits.com/gerbmerge
 """
 
 import sys
+import os
 import ConfigParser
 import re
 import string
+import itertools
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None    # Python 2.5 and earlier: files are always read one at a time
 
 import jobs
 import aptable
+import jobcache
 
 # Configuration dictionary. Specify floats as strings. Ints can be specified
 # as ints or strings.
@@ -58,11 +66,111 @@ MergeOutputFiles = {
   'toollist':     'merged.toollist.drl'
   }
 
+# A CodeTable is a dictionary indexed by aperture code (e.g., 'D10') or macro
+# name (e.g., 'M3') that keeps track of the highest code in use, so that a new
+# code can be allocated without looking at all of them, and of the code of each
+# value, so that a value can be found without comparing it to all of them. If
+# the same value is stored under more than one code, find() returns the one
+# stored first. The values of a plain CodeTable are themselves used as index
+# keys: the per-layer aperture translation tables (Job.apxlat) map local codes
+# to global codes this way.
+class CodeTable(dict):
+  Prefix = 'D'
+  FirstCode = 10    # Lower D-codes are not apertures
+
+  def __init__(self, items=()):
+    dict.__init__(self)
+    self.index = {}
+    self.nextCode = self.FirstCode
+    self.update(items)
+
+  def indexKey(self, value):
+    return value
+
+  def __setitem__(self, code, value):
+    if self.has_key(code):
+      self.unindex(code)
+    dict.__setitem__(self, code, value)
+    self.index.setdefault(self.indexKey(value), code)
+    try:
+      number = int(code[1:])
+    except ValueError:
+      return      # Not a code this table would allocate
+    if number >= self.nextCode:
+      self.nextCode = number+1
+
+  def __delitem__(self, code):
+    self.unindex(code)
+    dict.__delitem__(self, code)
+
+  def unindex(self, code):
+    key = self.indexKey(self[code])
+    if self.index.get(key) == code:
+      del self.index[key]
+      # Some other code may have the same value (rare)
+      for other, value in self.items():
+        if other != code and self.indexKey(value) == key:
+          self.index[key] = other
+          break
+
+  def clear(self):
+    dict.clear(self)
+    self.index.clear()
+    self.nextCode = self.FirstCode
+
+  def update(self, items=()):
+    if hasattr(items, 'items'):
+      items = items.items()
+    for code, value in items:
+      self[code] = value
+
+  def setdefault(self, code, value=None):
+    if not self.has_key(code):
+      self[code] = value
+    return self[code]
+
+  def pop(self, code, *default):
+    if self.has_key(code):
+      value = self[code]
+      del self[code]
+      return value
+    return dict.pop(self, code, *default)
+
+  def find(self, value):
+    "Return the code of the given value, or None if it is not in the table"
+    return self.index.get(self.indexKey(value))
+
+  def newCode(self):
+    "Return a code higher than all codes so far"
+    return '%s%d' % (self.Prefix, self.nextCode)
+
+  def add(self, value):
+    "Store the value under a new code, higher than all codes so far, and return the code"
+    code = self.newCode()
+    self[code] = value
+    return code
+
+# The GAT is a CodeTable of Aperture objects, which are found by their hash
+# (e.g., 'Circle (0.01000)') rather than by identity. Its index is thus the
+# reverse GAT, mapping hash to aperture code.
+class ApertureTable(CodeTable):
+  def indexKey(self, AP):
+    return AP.hash()
+
+# Likewise the GAMT is a CodeTable of ApertureMacro objects, found by their
+# hash (the macro primitives, not the name).
+class MacroTable(CodeTable):
+  Prefix = 'M'
+  FirstCode = 1
+
+  def indexKey(self, AM):
+    return AM.hash()
+
 # The global aperture table, indexed by aperture code (e.g., 'D10')
-GAT = {}
+GAT = ApertureTable()
 
 # The global aperture macro table, indexed by macro name (e.g., 'M3', 'M4R' for rotated macros)
-GAMT = {}
+GAMT = MacroTable()
 
 # The list of all jobs loaded, indexed by job name (e.g., 'PowerBoard')
 Jobs = {}
@@ -104,13 +212,25 @@ MinimumFeatureDimension = {}
 # forever until a KeyboardInterrupt is raised.
 SearchTimeout = 0
 
-# Construct the reverse-GAT/GAMT translation table, keyed by aperture/aperture macro
-# hash string. The value is the aperture code (e.g., 'D10') or macro name (e.g., 'M5').
-def buildRevDict(D):
-  RevD = {}
-  for key,val in D.items():
-    RevD[val.hash()] = key
-  return RevD
+# This configuration option is the number of worker processes used to read
+# Gerber and Excellon files. A value of 1 reads all files in this process,
+# one after the other.
+ReadProcesses = 1
+
+# This configuration option is the number of worker processes used to write
+# the merged output files. A value of 1 writes all files in this process.
+WriteProcesses = 1
+
+# This configuration option is the number of worker processes used for random
+# and exhaustive placement search. A value of 1 searches in this process.
+SearchWorkers = 1
+
+# This configuration option is the directory in which parsed Gerber and Excellon
+# files are cached, so that unchanged files need not be read again on the next
+# run. A value of None disables the cache. The least recently used entries are
+# removed when the cache grows beyond CacheSize bytes.
+CacheDir = os.path.join(os.path.expanduser('~'), '.gerbmerge', 'cache')
+CacheSize = 256*1024*1024
 
 def parseStringList(L):
   """Parse something like '*toplayer, *bottomlayer' into a list of names
@@ -192,6 +312,44 @@ def parseToolList(fname):
 
   return TL
 
+# Read a single Gerber or Excellon file of a job. The task is a tuple:
+#
+#   (jobname, layername, fname, ToolList, ExcellonDecimals, DefaultToolList, Decimals, CacheDir)
+#
+# where ToolList and ExcellonDecimals are the job's settings, DefaultToolList
+# and Decimals are the global tool list and ExcellonDecimals setting, and CacheDir
+# is the job cache directory (None to not use the cache). Since all that is
+# needed is passed in, this function may be run in a worker process. The
+# return value is a new Job object holding just this one layer, to be merged into
+# the real job with Job.mergeLayers().
+def readLayer(task):
+  global DefaultToolList
+
+  jobname, layername, fname, toolList, excellonDecimals, defaultToolList, decimals, cacheDir = task
+
+  if cacheDir:
+    key = jobcache.cacheKey(fname, task[1:2]+task[3:7])
+    J = jobcache.load(cacheDir, key, jobname)
+    if J is not None:
+      return J
+
+  J = jobs.Job(jobname)
+  if layername=='boardoutline':
+    J.parseGerber(fname, layername, updateExtents=1)
+  elif layername[0]=='*':
+    J.parseGerber(fname, layername, updateExtents=0)
+  else:
+    J.ToolList = toolList
+    J.ExcellonDecimals = excellonDecimals
+    DefaultToolList = defaultToolList
+    Config['excellondecimals'] = decimals
+    J.parseExcellon(fname)
+
+  if cacheDir:
+    jobcache.store(cacheDir, key, J)
+
+  return J
+
 # This function parses the job configuration file and does
 # everything needed to:
 #
@@ -200,7 +358,7 @@ def parseToolList(fname):
 #
 #   * Read Gerber/Excellon data and populate the Jobs dictionary
 #
-#   * Read Gerber/Excellon data and populate the global aperture
+#   * From the Gerber data, populate the global aperture
 #     table, GAT, and the global aperture macro table, GAMT
 #
 #   * read the tool list file and populate the DefaultToolList dictionary
@@ -271,10 +429,8 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
       if opt[0]=='*' or opt in ('boardoutline', 'drills', 'placement', 'toollist'):
         MergeOutputFiles[opt] = CP.get('MergeOutputFiles', opt)
 
-  # Now, we go through all jobs and collect Gerber layers
-  # so we can construct the Global Aperture Table.
-  apfiles = []
-
+  # Now, we go through all jobs and make sure they are complete, and
+  # collect the names of all Gerber layers.
   for jobname in CP.sections():
     if jobname=='Options': continue
     if jobname=='MergeOutputFiles': continue
@@ -288,25 +444,8 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
       raise RuntimeError, "Job '%s' does not have a drills layer specified" % jobname
 
     for layername in CP.options(jobname):
-      if layername[0]=='*' or layername=='boardoutline':
-        fname = CP.get(jobname, layername)
-        apfiles.append(fname)
-
-        if layername[0]=='*':
-          LayerList[layername]=1
-
-  # Now construct global aperture tables, GAT and GAMT. This step actually
-  # reads in the jobs for aperture data but doesn't store Gerber
-  # data yet.
-  aptable.constructApertureTable(apfiles)
-  del apfiles
-
-  if 0:
-    keylist = GAMT.keys()
-    keylist.sort()
-    for key in keylist:
-      print '%s' % GAMT[key]
-    sys.exit(0)
+      if layername[0]=='*':
+        LayerList[layername]=1
 
   # Parse the tool list
   if Config['toollist']:
@@ -319,18 +458,25 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
 
   Jobs.clear()
 
+  # Each Gerber file is read only once. Aperture definitions are kept local to
+  # each layer at first, so we collect all Gerber layers as (job, layername)
+  # tuples in the order they are read, to construct the global aperture tables
+  # once all jobs are in.
+  gerberLayers = []
+
   do_abort = 0
   errstr = 'ERROR'
   if Config['allowmissinglayers']:
     errstr = 'WARNING'
 
+  # First create all jobs and collect the files to read for each one as a list
+  # of tasks for readLayer().
+  jobList = []
   for jobname in CP.sections():
     if jobname=='Options': continue
     if jobname=='MergeOutputFiles': continue
     if jobname=='GerbMergeGUI': continue
 
-    print 'Reading data from', jobname, '...'
-
     J = jobs.Job(jobname)
 
     # Parse the job settings, like tool list, first, since we are not
@@ -354,35 +500,85 @@ def parseConfigFile(fname, Config=Config, Jobs=Jobs):
         except:
           raise RuntimeError, "Repeat count '%s' in config file is not a valid integer" % fname
 
+    tasks = []
     for layername in CP.options(jobname):
-      fname = CP.get(jobname, layername)
-
-      if layername=='boardoutline':
-        J.parseGerber(fname, layername, updateExtents=1)
-      elif layername[0]=='*':
-        J.parseGerber(fname, layername, updateExtents=0)
-      elif layername=='drills':
-        J.parseExcellon(fname)
+      if layername=='boardoutline' or layername[0]=='*' or layername=='drills':
+        fname = CP.get(jobname, layername)
+        tasks.append((jobname, layername, fname, J.ToolList, J.ExcellonDecimals, \
+                      DefaultToolList, Config['excellondecimals'], CacheDir))
+
+    jobList.append((J, tasks))
+
+  # Now read the files, either one after the other or in a pool of worker
+  # processes. Either way, the layers come back in the order of the tasks, so
+  # that the global aperture tables are constructed the same way every time.
+  allTasks = []
+  for J, tasks in jobList:
+    allTasks.extend(tasks)
+
+  pool = None
+  if ReadProcesses > 1 and multiprocessing is not None:
+    pool = multiprocessing.Pool(ReadProcesses)
+    layers = pool.imap(readLayer, allTasks)
+  else:
+    layers = itertools.imap(readLayer, allTasks)
 
-    # Emit warnings if some layers are missing
-    LL = LayerList.copy()
-    for layername in J.apxlat.keys():
-      assert LL.has_key(layername)
-      del LL[layername]
+  try:
+    for J, tasks in jobList:
+      jobname = J.name
+      print 'Reading data from', jobname, '...'
+
+      for task in tasks:
+        layername = task[1]
+        J.mergeLayers(layers.next())
+        if layername!='drills':
+          gerberLayers.append((J, layername))
+
+      # Emit warnings if some layers are missing
+      LL = LayerList.copy()
+      for layername in J.commands.keys():
+        assert LL.has_key(layername)
+        del LL[layername]
+
+      if LL:
+        if errstr=='ERROR':
+          do_abort=1
+
+        print '%s: Job %s is missing the following layers:' % (errstr, jobname)
+        for layername in LL.keys():
+          print '  %s' % layername
+
+      # Store the job in the global Jobs dictionary, keyed by job name
+      Jobs[jobname] = J
+  except:
+    if pool is not None:
+      pool.terminate()
+    raise
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  if CacheDir:
+    jobcache.evict(CacheDir, CacheSize)
 
-    if LL:
-      if errstr=='ERROR':
-        do_abort=1
+  if do_abort:
+    raise RuntimeError, 'Exiting since jobs are missing layers. Set AllowMissingLayers=1\nto override.'
 
-      print '%s: Job %s is missing the following layers:' % (errstr, jobname)
-      for layername in LL.keys():
-        print '  %s' % layername
+  # Now construct global aperture tables, GAT and GAMT, from the aperture
+  # definitions of all layers, then switch the aperture change commands of
+  # each layer over to the global aperture codes.
+  aptable.constructApertureTable(gerberLayers)
 
-    # Store the job in the global Jobs dictionary, keyed by job name
-    Jobs[jobname] = J
+  if 0:
+    keylist = GAMT.keys()
+    keylist.sort()
+    for key in keylist:
+      print '%s' % GAMT[key]
+    sys.exit(0)
 
-  if do_abort:
-    raise RuntimeError, 'Exiting since jobs are missing layers. Set AllowMissingLayers=1\nto override.'
+  for J, layername in gerberLayers:
+    J.translateApertures(layername)
 
 if __name__=="__main__":
   CP = parseConfigFile(sys.argv[1])
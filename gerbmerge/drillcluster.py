@@ -124,9 +124,9 @@ def remap(jobs, globalToolMap, debug = _DEBUG):
             # Append commands to existing commands if they exist
             if best_tool in new_commands:
                 ##debug_print( "Current commands: " + str( new_commands[best_tool] ) )
-                temp = new_commands[best_tool]
-                temp.extend( job.xcommands[tool] )
-                new_commands[best_tool] = temp
+                # Make a new list rather than extend the existing one, which
+                # may be shared with a rotated job (see jobs.RotatedJob)
+                new_commands[best_tool] = new_commands[best_tool] + job.xcommands[tool]
                 ##debug_print( "All commands: " + str( new_commands[best_tool] ) )
             else:
                 new_commands[best_tool] = job.xcommands[tool]
@@ -28,6 +28,11 @@ import os
 import getopt
 import re
 
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None    # Python 2.5 and earlier: files are always written one at a time
+
 import aptable
 import jobs
 import config
@@ -37,6 +42,8 @@ import strokes
 import tiling
 import tilesearch1
 import tilesearch2
+import tilesearch3
+import tilesearch4
 import placement
 import schwartz
 import util
@@ -49,6 +56,8 @@ VERSION_MINOR=8
 RANDOM_SEARCH = 1
 EXHAUSTIVE_SEARCH = 2
 FROM_FILE = 3
+ANNEAL_SEARCH = 4
+HEURISTIC_SEARCH = 5
 config.AutoSearchType = RANDOM_SEARCH
 config.RandomSearchExhaustiveJobs = 2
 config.PlacementFile = None
@@ -66,13 +75,23 @@ Options:
     -v, --version       -- Program version and contact information
     --random-search     -- Automatic placement using random search (default)
     --full-search       -- Automatic placement using exhaustive search
+    --anneal-search     -- Automatic placement using simulated annealing
+    --heuristic-search  -- Automatic placement using fast packing heuristics only
     --place-file=fn     -- Read placement from file
     --rs-fsjobs=N       -- When using random search, exhaustively search N jobs
                            for each random placement (default: N=2)
-    --search-timeout=T  -- When using random search, search for T seconds for best 
-                           random placement (default: T=0, search until stopped)
+    --search-timeout=T  -- When using random search or annealing, search for T
+                           seconds for best placement (default: T=0, search
+                           until stopped)
+    --workers=N         -- Run automatic placement search (random or exhaustive)
+                           in N processes in parallel (default: N=1)
     --no-trim-gerber    -- Do not attempt to trim Gerber data to extents of board
     --no-trim-excellon  -- Do not attempt to trim Excellon data to extents of board
+    --jobs=N            -- Read Gerber and Excellon files and write merged output
+                           files using N processes in parallel (default: N=1)
+    --cache-dir=dir     -- Cache parsed Gerber and Excellon files in directory 'dir'
+                           (default: ~/.gerbmerge/cache)
+    --no-cache          -- Do not use or update the cache of parsed files
     --octagons=fmt      -- Generate octagons in two different styles depending on
                            the value of 'fmt':
 
@@ -116,6 +135,15 @@ G70*
 
 writeGerberHeader = writeGerberHeader22degrees
 
+# The merged panel: job placement, extents, drill tools and the codes of
+# apertures used to draw cut lines, crop marks, fiducials and the fabrication
+# drawing. These are set up by merge() before any output file is written.
+Place = None
+OriginX = OriginY = MaxXExtent = MaxYExtent = None
+Tools = None
+drawing_code_cut = drawing_code_crop = drawing_code1 = None
+drawing_code_fiducial_copper = drawing_code_fiducial_soldermask = None
+
 def writeApertureMacros(fid, usedDict):
   keys = config.GAMT.keys()
   keys.sort()
@@ -201,6 +229,157 @@ def writeCropMarks(fid, drawing_code, OriginX, OriginY, MaxXExtent, MaxYExtent):
   fid.write('X%07dY%07dD01*\n' % (util.in2gerb(x+0.000), util.in2gerb(y+0.000)))
   fid.write('X%07dY%07dD01*\n' % (util.in2gerb(x+0.125), util.in2gerb(y+0.000)))
 
+# The functions below write the output files. merge() sets up the merged panel
+# and the global aperture and tool tables completely before any of them is
+# called, so they only read that state and may run in any order, including in
+# worker processes.
+
+def writeLayerFile(fullname, layername, apUsedDict, apmUsedDict):
+  "Write merged Gerber layer 'layername' using the given apertures and macros"
+  fid = file(fullname, 'wt')
+  writeGerberHeader(fid)
+
+  # Write only necessary macro and aperture definitions to Gerber file
+  writeApertureMacros(fid, apmUsedDict)
+  writeApertures(fid, apUsedDict)
+
+  #for row in Layout:
+  #  row.writeGerber(fid, layername)
+
+  #  # Do cut lines
+  #  if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
+  #    fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
+  #    row.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+  # Finally, write actual flash data. Copies of the same job share the
+  # formatted text of the layer.
+  templates = {}
+  for job in Place.jobs:
+  
+    updateGUI("Writing merged output files...")
+    job.writeGerber(fid, layername, templates)
+
+    if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
+      fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
+      job.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+  if config.Config['cropmarklayers']:
+    if layername in config.Config['cropmarklayers']:
+      writeCropMarks(fid, drawing_code_crop, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+  if config.Config['fiducialpoints']:
+    if ((layername=='*toplayer') or (layername=='*bottomlayer')):
+      writeFiducials(fid, drawing_code_fiducial_copper, OriginX, OriginY, MaxXExtent, MaxYExtent)
+    elif ((layername=='*topsoldermask') or (layername=='*bottomsoldermask')):
+      writeFiducials(fid, drawing_code_fiducial_soldermask, OriginX, OriginY, MaxXExtent, MaxYExtent)
+    
+  writeGerberFooter(fid)
+  fid.close()
+
+def writeOutlineFile(fullname):
+  "Write the board outline layer: a rectangle around the whole panel"
+  fid = file(fullname, 'wt')
+  writeGerberHeader(fid)
+
+  # Write width-1 aperture to file
+  AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
+  AP.writeDef(fid)
+
+  # Choose drawing aperture D10
+  fid.write('D10*\n')
+
+  # Draw the rectangle
+  fid.write('X%07dY%07dD02*\n' % (util.in2gerb(OriginX), util.in2gerb(OriginY)))        # Bottom-left
+  fid.write('X%07dY%07dD01*\n' % (util.in2gerb(OriginX), util.in2gerb(MaxYExtent)))     # Top-left
+  fid.write('X%07dY%07dD01*\n' % (util.in2gerb(MaxXExtent), util.in2gerb(MaxYExtent)))  # Top-right
+  fid.write('X%07dY%07dD01*\n' % (util.in2gerb(MaxXExtent), util.in2gerb(OriginY)))     # Bottom-right
+  fid.write('X%07dY%07dD01*\n' % (util.in2gerb(OriginX), util.in2gerb(OriginY)))        # Bottom-left
+
+  writeGerberFooter(fid)
+  fid.close()
+
+def writeScoringFile(fullname):
+  "Write the scoring layer"
+  fid = file(fullname, 'wt')
+  writeGerberHeader(fid)
+
+  # Write width-1 aperture to file
+  AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
+  AP.writeDef(fid)
+
+  # Choose drawing aperture D10
+  fid.write('D10*\n')
+
+  # Draw the scoring lines
+  scoring.writeScoring(fid, Place, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+  writeGerberFooter(fid)
+  fid.close()
+
+def writeFabDrawingFile(fullname):
+  "Write the fabrication drawing"
+  fid = file(fullname, 'wt')
+  writeGerberHeader(fid)
+  writeApertures(fid, {drawing_code1: None})
+  fid.write('%s*\n' % drawing_code1)    # Choose drawing aperture
+
+  fabdrawing.writeFabDrawing(fid, Place, Tools, OriginX, OriginY, MaxXExtent, MaxYExtent)
+
+  writeGerberFooter(fid)
+  fid.close()
+
+def writeDrillFile(fullname):
+  "Write the merged Excellon file"
+  fid = file(fullname, 'wt')
+
+  writeExcellonHeader(fid)
+
+  # Ensure each one of our tools is represented in the tool list specified
+  # by the user.
+  for tool in Tools:
+    try:
+      size = config.GlobalToolMap[tool]
+    except:
+      raise RuntimeError, "INTERNAL ERROR: Tool code %s not found in global tool map" % tool
+      
+    writeExcellonTool(fid, tool, size)
+
+    #for row in Layout:
+    #  row.writeExcellon(fid, size)
+    for job in Place.jobs:
+        job.writeExcellon(fid, size)
+  
+  writeExcellonFooter(fid)
+  fid.close()
+
+def writeOutputFile(task):
+  func, args = task
+  func(*args)
+
+def initWriter():
+  "Worker processes have no GUI to update"
+  global GUI
+  GUI = None
+
+def writeOutputFiles(tasks):
+  """Write output files given as a list of (function, arguments) tasks, either
+  one after the other or, if config.WriteProcesses > 1, in a pool of worker
+  processes. The workers rely on inheriting the merged panel from this process,
+  so files are always written here on platforms without fork() (e.g., Windows)."""
+  if config.WriteProcesses > 1 and len(tasks) > 1 and multiprocessing is not None \
+     and hasattr(os, 'fork'):
+    pool = multiprocessing.Pool(min(config.WriteProcesses, len(tasks)), initWriter)
+    try:
+      pool.map(writeOutputFile, tasks, 1)
+    except:
+      pool.terminate()
+      raise
+    pool.close()
+    pool.join()
+  else:
+    for task in tasks:
+      writeOutputFile(task)
+
 def disclaimer():
   print """
 ****************************************************
@@ -260,6 +439,10 @@ def tile_jobs(Jobs):
   PX,PY = config.Config['panelwidth'],config.Config['panelheight']
   if config.AutoSearchType==RANDOM_SEARCH:
     tile = tilesearch2.tile_search2(L, PX, PY)
+  elif config.AutoSearchType==ANNEAL_SEARCH:
+    tile = tilesearch3.tile_search3(L, PX, PY)
+  elif config.AutoSearchType==HEURISTIC_SEARCH:
+    tile = tilesearch4.tile_search4(L, PX, PY)
   else:
     tile = tilesearch1.tile_search1(L, PX, PY)
 
@@ -269,9 +452,12 @@ def tile_jobs(Jobs):
   return tile
 
 def merge(opts, args, gui = None):
+  global GUI, writeGerberHeader, Place, OriginX, OriginY, MaxXExtent, MaxYExtent, Tools
+  global drawing_code_cut, drawing_code_crop, drawing_code1
+  global drawing_code_fiducial_copper, drawing_code_fiducial_soldermask
+
   writeGerberHeader = writeGerberHeader22degrees
   
-  global GUI
   GUI = gui
   
   for opt, arg in opts:
@@ -286,6 +472,10 @@ def merge(opts, args, gui = None):
       config.AutoSearchType = RANDOM_SEARCH
     elif opt in ('--full-search',):
       config.AutoSearchType = EXHAUSTIVE_SEARCH
+    elif opt in ('--anneal-search',):
+      config.AutoSearchType = ANNEAL_SEARCH
+    elif opt in ('--heuristic-search',):
+      config.AutoSearchType = HEURISTIC_SEARCH
     elif opt in ('--rs-fsjobs',):
       config.RandomSearchExhaustiveJobs = int(arg)
     elif opt in ('--search-timeout',):
@@ -297,6 +487,14 @@ def merge(opts, args, gui = None):
       config.TrimGerber = 0
     elif opt in ('--no-trim-excellon',):
       config.TrimExcellon = 0
+    elif opt in ('--jobs',):
+      config.ReadProcesses = config.WriteProcesses = int(arg)
+    elif opt in ('--workers',):
+      config.SearchWorkers = int(arg)
+    elif opt in ('--cache-dir',):
+      config.CacheDir = arg
+    elif opt in ('--no-cache',):
+      config.CacheDir = None
     else:
       raise RuntimeError, "Unknown option: %s" % opt
 
@@ -425,6 +623,20 @@ def merge(opts, args, gui = None):
   updateGUI("Writing merged files...")
   print 'Writing merged output files ...'
 
+  # Each output file is a (function, arguments) task for writeOutputFiles().
+  # Everything that changes the global aperture and tool tables is done here,
+  # before any file is written, so that writing only reads them.
+  Tasks = []
+
+  # Copies of a job placed more than once share their commands, so the
+  # apertures of each job need only be examined (and replaced) once.
+  UniqueJobs = []
+  seen = {}
+  for joblayout in Place.jobs:
+    if not seen.has_key(joblayout.job):
+      seen[joblayout.job] = None
+      UniqueJobs.append(joblayout.job)
+
   for layername in config.LayerList.keys():
     lname = layername
     if lname[0]=='*':
@@ -435,14 +647,11 @@ def merge(opts, args, gui = None):
     except KeyError:
       fullname = 'merged.%s.ger' % lname
     OutputFiles.append(fullname)
-    #print 'Writing %s ...' % fullname
-    fid = file(fullname, 'wt')
-    writeGerberHeader(fid)
     
     # Determine which apertures and macros are truly needed
     apUsedDict = {}
     apmUsedDict = {}
-    for job in Place.jobs:
+    for job in UniqueJobs:
       apd, apmd = job.aperturesAndMacros(layername)
       apUsedDict.update(apd)
       apmUsedDict.update(apmd)
@@ -453,6 +662,7 @@ def merge(opts, args, gui = None):
       print '  Thickening', lname, 'feature dimensions ...'
       
       # Fix each aperture used in this layer
+      xlat = {}
       for ap in apUsedDict.keys():
         new = config.GAT[ap].getAdjusted( config.MinimumFeatureDimension[layername] )
         if not new: ## current aperture size met minimum requirement
@@ -461,18 +671,15 @@ def merge(opts, args, gui = None):
           new_code = aptable.findOrAddAperture(new) ## get name of existing aperture or create new one if needed
           del apUsedDict[ap]                        ## the old aperture is no longer used in this layer
           apUsedDict[new_code] = None               ## the new aperture will be used in this layer
+          xlat[ap] = new_code
      
-          # Replace all references to the old aperture with the new one
-          for joblayout in Place.jobs:
-            job = joblayout.job ##access job inside job layout 
-            temp = []
-            if job.hasLayer(layername):
-              for x in job.commands[layername]:
-                if x == ap:
-                  temp.append(new_code) ## replace old aperture with new one
-                else:
-                  temp.append(x)        ## keep old command
-              job.commands[layername] = temp
+      # Replace all references to the old apertures with the new ones. Adjusted
+      # apertures meet the minimum, so they are never adjusted again and one
+      # pass over each job does it.
+      if xlat:
+        for job in UniqueJobs:
+          if job.hasLayer(layername):
+            job.renameApertures(layername, xlat)
 
     if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
       apUsedDict[drawing_code_cut]=None
@@ -486,86 +693,19 @@ def merge(opts, args, gui = None):
       elif ((layername=='*topsoldermask') or (layername=='*bottomsoldermask')):
         apUsedDict[drawing_code_fiducial_soldermask] = None
 
-    # Write only necessary macro and aperture definitions to Gerber file
-    writeApertureMacros(fid, apmUsedDict)
-    writeApertures(fid, apUsedDict)
-
-    #for row in Layout:
-    #  row.writeGerber(fid, layername)
-
-    #  # Do cut lines
-    #  if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
-    #    fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
-    #    row.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-    # Finally, write actual flash data
-    for job in Place.jobs:
-    
-      updateGUI("Writing merged output files...")
-      job.writeGerber(fid, layername)
-
-      if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
-        fid.write('%s*\n' % drawing_code_cut)    # Choose drawing aperture
-        job.writeCutLines(fid, drawing_code_cut, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-    if config.Config['cropmarklayers']:
-      if layername in config.Config['cropmarklayers']:
-        writeCropMarks(fid, drawing_code_crop, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-    if config.Config['fiducialpoints']:
-      if ((layername=='*toplayer') or (layername=='*bottomlayer')):
-        writeFiducials(fid, drawing_code_fiducial_copper, OriginX, OriginY, MaxXExtent, MaxYExtent)
-      elif ((layername=='*topsoldermask') or (layername=='*bottomsoldermask')):
-        writeFiducials(fid, drawing_code_fiducial_soldermask, OriginX, OriginY, MaxXExtent, MaxYExtent)
-      
-    writeGerberFooter(fid)
-    fid.close()
+    Tasks.append((writeLayerFile, (fullname, layername, apUsedDict, apmUsedDict)))
 
   # Write board outline layer if selected
   fullname = config.Config['outlinelayerfile']
   if fullname and fullname.lower() != "none":
     OutputFiles.append(fullname)
-    #print 'Writing %s ...' % fullname
-    fid = file(fullname, 'wt')
-    writeGerberHeader(fid)
-
-    # Write width-1 aperture to file
-    AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
-    AP.writeDef(fid)
-
-    # Choose drawing aperture D10
-    fid.write('D10*\n')
-
-    # Draw the rectangle
-    fid.write('X%07dY%07dD02*\n' % (util.in2gerb(OriginX), util.in2gerb(OriginY)))        # Bottom-left
-    fid.write('X%07dY%07dD01*\n' % (util.in2gerb(OriginX), util.in2gerb(MaxYExtent)))     # Top-left
-    fid.write('X%07dY%07dD01*\n' % (util.in2gerb(MaxXExtent), util.in2gerb(MaxYExtent)))  # Top-right
-    fid.write('X%07dY%07dD01*\n' % (util.in2gerb(MaxXExtent), util.in2gerb(OriginY)))     # Bottom-right
-    fid.write('X%07dY%07dD01*\n' % (util.in2gerb(OriginX), util.in2gerb(OriginY)))        # Bottom-left
-
-    writeGerberFooter(fid)
-    fid.close()
+    Tasks.append((writeOutlineFile, (fullname,)))
 
   # Write scoring layer if selected
   fullname = config.Config['scoringfile']
   if fullname and fullname.lower() != "none":
     OutputFiles.append(fullname)
-    #print 'Writing %s ...' % fullname
-    fid = file(fullname, 'wt')
-    writeGerberHeader(fid)
-
-    # Write width-1 aperture to file
-    AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
-    AP.writeDef(fid)
-
-    # Choose drawing aperture D10
-    fid.write('D10*\n')
-
-    # Draw the scoring lines
-    scoring.writeScoring(fid, Place, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-    writeGerberFooter(fid)
-    fid.close()
+    Tasks.append((writeScoringFile, (fullname,)))
 
   # Get a list of all tools used by merging keys from each job's dictionary
   # of tools.
@@ -608,16 +748,7 @@ def merge(opts, args, gui = None):
       raise RuntimeError, "Only %d different tool sizes supported for fabrication drawing." % strokes.MaxNumDrillTools
 
     OutputFiles.append(fullname)
-    #print 'Writing %s ...' % fullname
-    fid = file(fullname, 'wt')
-    writeGerberHeader(fid)
-    writeApertures(fid, {drawing_code1: None})
-    fid.write('%s*\n' % drawing_code1)    # Choose drawing aperture
-
-    fabdrawing.writeFabDrawing(fid, Place, Tools, OriginX, OriginY, MaxXExtent, MaxYExtent)
-
-    writeGerberFooter(fid)
-    fid.close()
+    Tasks.append((writeFabDrawingFile, (fullname,)))
     
   # Finally, print out the Excellon
   try:
@@ -625,28 +756,9 @@ def merge(opts, args, gui = None):
   except KeyError:
     fullname = 'merged.drills.xln'
   OutputFiles.append(fullname)
-  #print 'Writing %s ...' % fullname
-  fid = file(fullname, 'wt')
-
-  writeExcellonHeader(fid)
-
-  # Ensure each one of our tools is represented in the tool list specified
-  # by the user.
-  for tool in Tools:
-    try:
-      size = config.GlobalToolMap[tool]
-    except:
-      raise RuntimeError, "INTERNAL ERROR: Tool code %s not found in global tool map" % tool
-      
-    writeExcellonTool(fid, tool, size)
+  Tasks.append((writeDrillFile, (fullname,)))
 
-    #for row in Layout:
-    #  row.writeExcellon(fid, size)
-    for job in Place.jobs:
-        job.writeExcellon(fid, size)
-  
-  writeExcellonFooter(fid)
-  fid.close()
+  writeOutputFiles(Tasks)
   
   updateGUI("Closing files...")
 
@@ -721,7 +833,7 @@ def updateGUI(text = None):
 
 if __name__=="__main__":
   try:
-    opts, args = getopt.getopt(sys.argv[1:], 'hv', ['help', 'version', 'octagons=', 'random-search', 'full-search', 'rs-fsjobs=', 'search-timeout=', 'place-file=', 'no-trim-gerber', 'no-trim-excellon'])
+    opts, args = getopt.getopt(sys.argv[1:], 'hv', ['help', 'version', 'octagons=', 'random-search', 'full-search', 'anneal-search', 'heuristic-search', 'rs-fsjobs=', 'search-timeout=', 'place-file=', 'no-trim-gerber', 'no-trim-excellon', 'jobs=', 'workers=', 'cache-dir=', 'no-cache'])
   except getopt.GetoptError:
     usage()
     
@@ -739,7 +851,7 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """ % (VERSION_MAJOR, VERSION_MINOR)
       sys.exit(0)
-    elif opt in ('--octagons', '--random-search','--full-search','--rs-fsjobs','--place-file','--no-trim-gerber','--no-trim-excellon', '--search-timeout'):
+    elif opt in ('--octagons', '--random-search','--full-search','--anneal-search','--heuristic-search','--rs-fsjobs','--place-file','--no-trim-gerber','--no-trim-excellon', '--search-timeout', '--jobs', '--workers', '--cache-dir', '--no-cache'):
       pass ## arguments are valid
     else:
       raise RuntimeError, "Unknown option: %s" % opt
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Persistent on-disk cache of parsed Gerber and Excellon files.
+
+Each entry holds the data read from one file by config.readLayer(): drawing
+commands, local aperture and aperture macro definitions, extents, drill hits
+and tool diameters. Entries are named by a hash of the file contents and of
+all settings that affect how the file is read, so a changed file or setting
+simply results in a new entry. Old entries are removed, least recently used
+first, when the cache grows beyond its maximum size.
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import sys
+import os
+import marshal
+import zlib
+
+try:
+  from hashlib import sha1
+except ImportError:
+  from sha import new as sha1     # Python 2.4
+
+import aptable
+import amacro
+import jobs
+import cmdlist
+
+# Change this whenever the format of cache entries or the way files are
+# parsed changes, so that old entries are no longer used.
+CacheVersion = 'GerbMerge job cache 2'
+
+# Cache entry file name extension
+CacheExt = '.gmc'
+
+def cacheKey(fname, settings):
+  """Return the name of the cache entry for file fname read with the given
+  settings, a tuple of layer name, job tool list, job ExcellonDecimals, default
+  tool list and global ExcellonDecimals (see config.readLayer())."""
+  layername, toolList, excellonDecimals, defaultToolList, decimals = settings
+
+  # Dictionaries are sorted so that the key does not depend on the order in
+  # which tools were listed.
+  if toolList:
+    toolList = toolList.items()
+    toolList.sort()
+  defaultToolList = defaultToolList.items()
+  defaultToolList.sort()
+
+  h = sha1(CacheVersion)
+  h.update(sys.version)   # marshal format may change between Python versions
+  h.update(sys.byteorder) # command arrays are stored in machine byte order
+  h.update(repr((layername, toolList, excellonDecimals, defaultToolList, decimals)))
+
+  fid = file(fname, 'rb')
+  while 1:
+    data = fid.read(1<<20)
+    if not data: break
+    h.update(data)
+  fid.close()
+
+  return h.hexdigest()
+
+def dumpJob(J):
+  "Return the layers read into Job J as a structure of built-in types for marshal"
+  layers = []
+  for layername in J.commands.keys():
+    apdefs = [(A.apname, A.code, A.dimx, A.dimy) for A in J.apdefs[layername]]
+    apmdefs = [(M.name, [(P.code, P.parms) for P in M.prim]) for M in J.apmdefs[layername]]
+    layers.append((layername, J.commands[layername].__getstate__(), J.apertures[layername], \
+                   apdefs, apmdefs))
+
+  return (layers, J.xcommands, J.xdiam, (J.minx, J.miny, J.maxx, J.maxy))
+
+def loadJob(jobname, data):
+  "Inverse of dumpJob(): return a new Job with the given name"
+  layers, xcommands, xdiam, extents = data
+
+  J = jobs.Job(jobname)
+  for layername, commands, apertures, apdefs, apmdefs in layers:
+    J.commands[layername] = cmdlist.CommandList()
+    J.commands[layername].__setstate__(commands)
+    J.apertures[layername] = apertures
+
+    J.apdefs[layername] = [aptable.makeAperture(apname, code, dimx, dimy) \
+                             for apname, code, dimx, dimy in apdefs]
+
+    J.apmdefs[layername] = []
+    for name, prims in apmdefs:
+      M = amacro.ApertureMacro(name)
+      for code, parms in prims:
+        P = amacro.ApertureMacroPrimitive()
+        P.code = code
+        P.parms = parms
+        M.add(P)
+      J.apmdefs[layername].append(M)
+
+  J.xcommands = xcommands
+  J.xdiam = xdiam
+  J.minx, J.miny, J.maxx, J.maxy = extents
+
+  return J
+
+def load(cacheDir, key, jobname):
+  "Return the cached Job for the given key, or None if it is not in the cache"
+  fullname = os.path.join(cacheDir, key + CacheExt)
+  try:
+    fid = file(fullname, 'rb')
+    data = fid.read()
+    fid.close()
+    J = loadJob(jobname, marshal.loads(zlib.decompress(data)))
+  except Exception:
+    return None     # Not cached, or unreadable. Either way, read the file again.
+
+  # Mark the entry as recently used
+  try:
+    os.utime(fullname, None)
+  except OSError:
+    pass
+
+  return J
+
+def store(cacheDir, key, J):
+  "Add Job J to the cache. Failures are ignored: the cache is only a shortcut."
+  fullname = os.path.join(cacheDir, key + CacheExt)
+  tmpname = '%s.%d.tmp' % (fullname, os.getpid())
+  try:
+    if not os.path.isdir(cacheDir):
+      os.makedirs(cacheDir)
+
+    data = zlib.compress(marshal.dumps(dumpJob(J)), 1)
+
+    # Write to a temporary file and rename it so that other processes reading
+    # the same file never see a partial entry.
+    fid = file(tmpname, 'wb')
+    fid.write(data)
+    fid.close()
+    os.rename(tmpname, fullname)
+  except (IOError, OSError, ValueError):
+    try:
+      os.remove(tmpname)
+    except OSError:
+      pass
+
+def evict(cacheDir, maxSize):
+  "Remove least recently used entries until the cache is at most maxSize bytes"
+  try:
+    names = os.listdir(cacheDir)
+  except OSError:
+    return
+
+  entries = []
+  total = 0
+  for name in names:
+    if not name.endswith(CacheExt): continue
+    fullname = os.path.join(cacheDir, name)
+    try:
+      st = os.stat(fullname)
+    except OSError:
+      continue
+    entries.append((st.st_mtime, st.st_size, fullname))
+    total += st.st_size
+
+  entries.sort()
+  for mtime, size, fullname in entries:
+    if total <= maxSize: break
+    try:
+      os.remove(fullname)
+      total -= size
+    except OSError:
+      pass
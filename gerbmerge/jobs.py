@@ -15,11 +15,11 @@ http://ruggedcircuits.com/gerbmerge
 import sys
 import re
 import string
-import __builtin__
 import copy
-import types
+import itertools
 
 import aptable
+import cmdlist
 import config
 import makestroke
 import amacro
@@ -40,18 +40,20 @@ import util
 apdef_pat = re.compile(r'^%AD(D\d+)([^*$]+)\*%$')     # Aperture definition
 apmdef_pat = re.compile(r'^%AM([^*$]+)\*$')           # Aperture macro definition
 comment_pat = re.compile(r'G0?4[^*]*\*')              # Comment (GerbTool comment omits the 0)
-tool_pat  = re.compile(r'(D\d+)\*')                   # Aperture selection
-gcode_pat = re.compile(r'G(\d{1,2})\*?')              # G-codes
-drawXY_pat = re.compile(r'X([+-]?\d+)Y([+-]?\d+)D0?([123])\*')  # Drawing command
-drawX_pat  = re.compile(r'X([+-]?\d+)D0?([123])\*')        # Drawing command, Y is implied
-drawY_pat  = re.compile(r'Y([+-]?\d+)D0?([123])\*')        # Drawing command, X is implied
+gcode_pat = re.compile(r'G(\d{1,2})')                 # G-codes
 format_pat = re.compile(r'%FS(L|T)?(A|I)(N\d+)?(X\d\d)(Y\d\d)\*%')  # Format statement
 layerpol_pat = re.compile(r'^%LP[CD]\*%')             # Layer polarity (D=dark, C=clear)
 
-# Circular interpolation drawing commands (from Protel)
-cdrawXY_pat = re.compile(r'X([+-]?\d+)Y([+-]?\d+)I([+-]?\d+)J([+-]?\d+)D0?([123])\*')
-cdrawX_pat  = re.compile(r'X([+-]?\d+)I([+-]?\d+)J([+-]?\d+)D0?([123])\*')  # Y is implied
-cdrawY_pat  = re.compile(r'Y([+-]?\d+)I([+-]?\d+)J([+-]?\d+)D0?([123])\*')  # X is implied
+# Drawing command. X or Y may be omitted if they are the same as before, and
+# the (I,J) pair is present for circular interpolation (from Protel).
+draw_pat = re.compile(r'^(?:X([+-]?\d+))?(?:Y([+-]?\d+))?(?:I([+-]?\d+)J([+-]?\d+))?D0?([123])\*$')
+
+# Gerber files are split into blocks in a single pass. A block is either an
+# RS-274X parameter block like "%ADD10C,0.0060*%" (which may span several lines,
+# as for aperture macros), or a '*'-terminated data block like "X004768Y008755D02*".
+# Anything else (e.g., a data block with no terminating '*') is returned as
+# a block of its own so it can be reported as uninterpretable.
+block_pat = re.compile(r'\s*(%[^%]*%|[^*%\s][^*]*\*|\*|\S+)')
 
 IgnoreList = ( \
   # These are for Eagle, and RS274X files in general
@@ -99,7 +101,13 @@ XIgnoreList = ( \
 # The board outline and Excellon filenames must be given separately.
 # The board outline file determines the extents of the job.
 
-class Job:
+class Job(object):
+  # Jobs are copied and rotated many times during placement, so keep them
+  # small and catch misspelled attributes.
+  __slots__ = ('name', 'maxx', 'maxy', 'minx', 'miny', 'apxlat', 'apmxlat', \
+               'apdefs', 'apmdefs', 'commands', 'apertures', 'xcommands', 'xdiam', \
+               'ToolList', 'Repeat', 'ExcellonDecimals')
+
   def __init__(self, name):
     self.name = name
 
@@ -127,7 +135,17 @@ class Job:
     #       apxlat['BottomCopper']['AND10'] = 'M5'
     self.apmxlat = {}
 
-    # Commands are one of:
+    # Aperture and aperture macro definitions LOCAL to each layer, in the
+    # order in which they appear in the Gerber file. These dictionaries are
+    # indexed by layer name and each entry is a list of Aperture or ApertureMacro
+    # objects with local codes and names (e.g., 'D10', 'THD10X'). They are turned
+    # into the GAT/GAMT and the apxlat/apmxlat tables above by
+    # aptable.constructApertureTable() once all jobs have been read in.
+    self.apdefs = {}
+    self.apmdefs = {}
+
+    # Commands are stored in a cmdlist.CommandList for each layer. Iterating over
+    # it returns each command as one of:
     #     A. strings for:
     #           - aperture changes like "D12"
     #           - G-code commands like "G36"
@@ -140,13 +158,17 @@ class Job:
     #        the (I,J) tuple is a SIGNED offset (for multi-quadrant circular interpolation)
     #        else the tuple is unsigned.
     #
+    # Aperture changes are stored with LOCAL aperture codes while reading the
+    # Gerber file and are translated to global codes afterwards (see
+    # translateApertures()).
+    #
     # This variable is, as for apxlat, a dictionary keyed by layer name.
     self.commands = {}
 
     # This dictionary stores all GLOBAL apertures actually needed by this
     # layer, i.e., apertures specified prior to draw commands.  The dictionary
     # is indexed by layer name, and each dictionary entry is a list of aperture
-    # code strings, like 'D12'. This dictionary helps us to figure out the
+    # code strings, like 'D12', each listed once. This dictionary helps us to figure out the
     # minimum number of apertures that need to be written out in the Gerber
     # header of the merged file. Once again, the list of apertures refers to
     # GLOBAL aperture codes in the GAT, not ones local to this layer.
@@ -179,6 +201,23 @@ class Job:
     # to be combined.
     self.ExcellonDecimals = 0     # 0 means global value prevails
 
+  def mergeLayers(self, job):
+    """Take over the layers that were read into another Job object for the same
+       board (see config.readLayer()), along with the extents they determine"""
+    for layername in job.commands.keys():
+      self.commands[layername] = job.commands[layername]
+      self.apertures[layername] = job.apertures[layername]
+      self.apdefs[layername] = job.apdefs[layername]
+      self.apmdefs[layername] = job.apmdefs[layername]
+
+    self.xcommands.update(job.xcommands)
+    self.xdiam.update(job.xdiam)
+
+    self.minx = min(self.minx, job.minx)
+    self.miny = min(self.miny, job.miny)
+    self.maxx = max(self.maxx, job.maxx)
+    self.maxy = max(self.maxy, job.maxy)
+
   def width_in(self):
     "Return width in INCHES"
     return float(self.maxx-self.minx)*0.00001
@@ -207,60 +246,53 @@ class Job:
     self.miny += y_shift
     self.maxy += y_shift
 
-    # Shift all commands
-    for layer, command in self.commands.iteritems():
-    
-      # Loop through each command in each layer
-      for index in range( len(command) ):
-        c = command[index]
-        
-        # Shift X and Y coordinate of command
-        if type(c) == types.TupleType:                      ## ensure that command is of type tuple
-          command_list = list(c)                            ## convert tuple to list
-          if  (type( command_list[0] ) == types.IntType) \
-          and (type( command_list[1] ) == types.IntType):  ## ensure that first two elemenst are integers
-            command_list[0] += x_shift
-            command_list[1] += y_shift
-          command[index] = tuple(command_list)              ## convert list back to tuple
-          
-      self.commands[layer] = command                        ## set modified command
+    # Shift all commands, a layer at a time (see cmdlist.CommandList.shift())
+    for command in self.commands.itervalues():
+      command.shift(x_shift, y_shift)
      
-    # Shift all excellon commands
-    for tool, command in self.xcommands.iteritems():
-    
-      # Loop through each command in each layer
-      for index in range( len(command) ):
-        c = command[index]
-        
-        # Shift X and Y coordinate of command
-        command_list = list(c)                              ## convert tuple to list
-        if ( type( command_list[0] ) == types.IntType ) \
-        and ( type( command_list[1] ) == types.IntType ):  ## ensure that first two elemenst are integers
-          command_list[0] += x_shift / 10
-          command_list[1] += y_shift / 10
-        command[index] = tuple(command_list)                ## convert list back to tuple
-        
-      self.xcommands[tool] = command                        ## set modified command
+    # Shift all excellon commands. Excellon data is in 2.4 format.
+    dx = x_shift / 10
+    dy = y_shift / 10
+    for tool, command in self.xcommands.items():
+      self.xcommands[tool] = [(x+dx, y+dy) for x, y in command]
 
   def parseGerber(self, fullname, layername, updateExtents = 0):
-    """Do the dirty work. Read the Gerber file given the
-       global aperture table GAT and global aperture macro table GAMT"""
-
-    GAT = config.GAT
-    GAMT = config.GAMT
-    # First construct reverse GAT/GAMT, mapping definition to code
-    RevGAT = config.buildRevDict(GAT)     # RevGAT[hash] = aperturename
-    RevGAMT = config.buildRevDict(GAMT)   # RevGAMT[hash] = aperturemacroname
+    """Do the dirty work. Read the Gerber file, keeping aperture and aperture
+       macro definitions and aperture change commands LOCAL to the file. Call
+       translateApertures() once the global aperture tables are constructed."""
 
     #print 'Reading data from %s ...' % fullname
 
+    # Read the whole file and split it into blocks in one go. Get rid of CR
+    # characters (0x0D) first.
     fid = file(fullname, 'rt')
+    data = fid.read()
+    fid.close()
+    data = data.replace('\x0D', '')
+
     currtool = None
 
-    self.apxlat[layername] = {}
-    self.apmxlat[layername] = {}
-    self.commands[layername] = []
-    self.apertures[layername] = []
+    apdefs = self.apdefs[layername] = []
+    apmdefs = self.apmdefs[layername] = []
+    commands = self.commands[layername] = cmdlist.CommandList()
+    apertures = self.apertures[layername] = []
+
+    appendDraw = commands.appendDraw
+    appendArc = commands.appendArc
+    appendCode = commands.appendCode
+
+    # Plain drawing commands are by far the most common, so they are appended
+    # to the columns of the command list directly (see cmdlist.py).
+    opAppend = commands.op.append
+    xAppend = commands.x.append
+    yAppend = commands.y.append
+    iAppend = commands.i.append
+    jAppend = commands.j.append
+    dAppend = commands.d.append
+
+    # Local aperture codes and aperture macro names defined so far in this file
+    localAps = {}
+    localMacroNames = {}
 
     # These divisors are used to scale (X,Y) co-ordinates. We store
     # everything as integers in hundred-thousandths of an inch (i.e., M.5
@@ -298,78 +330,54 @@ class Job:
     # to manually insert the point X000000Y00000 into the command stream.
     firstFlash = True
 
-    for line in fid:
-      # Get rid of CR characters (0x0D) and leading/trailing blanks
-      line = string.replace(line, '\x0D', '').strip()
-
-      # Old location of format_pat search. Now moved down into the sub-line parse loop below.
+    for block in block_pat.findall(data):
+      c = block[0]
+
+      # RS-274X parameter blocks. These only appear in the file header (apart
+      # from layer polarity changes) so they are handled line-wise, as they are
+      # written in the file.
+      if c == '%':
+        # Layer polarity statement? If so, echo it. These will be distinguished from
+        # D-code and G-code commands by the fact that the first character of the
+        # string is '%'.
+        if layerpol_pat.match(block):
+          appendCode(block)
+          continue
 
-      # RS-274X statement? If so, echo it. Currently, only the "LP" statement is expected
-      # (from Protel, of course). These will be distinguished from D-code and G-code
-      # commands by the fact that the first character of the string is '%'.
-      match = layerpol_pat.match(line)
-      if match:
-        self.commands[layername].append(line)
-        continue
-        
-      # See if this is an aperture definition, and if so, map it.
-      match = apdef_pat.match(line)
-      if match:
-        if currtool:
-          raise RuntimeError, "File %s has an aperture definition that comes after drawing commands." % fullname
-
-        A = aptable.parseAperture(line, self.apmxlat[layername])
-        if not A:
-          raise RuntimeError, "Unknown aperture definition in file %s" % fullname
-
-        hash = A.hash()
-        if not RevGAT.has_key(hash):
-          #print line
-          #print self.apmxlat
-          #print RevGAT
-          raise RuntimeError, 'File %s has aperture definition "%s" not in global aperture table.' % (fullname, hash)
-
-        # This says that all draw commands with this aperture code will
-        # be replaced by aperture self.apxlat[layername][code].
-        self.apxlat[layername][A.code] = RevGAT[hash]
-        continue
+        # See if this is an aperture definition, and if so, map it.
+        if apdef_pat.match(block):
+          if currtool:
+            raise RuntimeError, "File %s has an aperture definition that comes after drawing commands." % fullname
 
-      # Ignore %AMOC8* from Eagle for now as it uses a macro parameter, which
-      # is not yet supported in GerbMerge.
-      if line[:7]=='%AMOC8*':
-        continue
+          A = aptable.parseAperture(block, localMacroNames)
+          if not A:
+            raise RuntimeError, "Unknown aperture definition in file %s" % fullname
 
-      # See if this is an aperture macro definition, and if so, map it.
-      M = amacro.parseApertureMacro(line,fid)
-      if M:
-        if currtool:
-          raise RuntimeError, "File %s has an aperture macro definition that comes after drawing commands." % fullname
+          apdefs.append(A)
+          localAps[A.code] = A
+          continue
 
-        hash = M.hash()
-        if not RevGAMT.has_key(hash):
-          raise RuntimeError, 'File %s has aperture macro definition not in global aperture macro table:\n%s' % (fullname, hash)
+        # Ignore %AMOC8* from Eagle for now as it uses a macro parameter, which
+        # is not yet supported in GerbMerge.
+        if block[:7]=='%AMOC8*':
+          continue
 
-        # This says that all aperture definition commands that reference this macro name
-        # will be replaced by aperture macro name self.apmxlat[layername][macroname].
-        self.apmxlat[layername][M.name] = RevGAMT[hash]
-        continue
+        # See if this is an aperture macro definition, and if so, map it. The
+        # macro primitives follow on separate lines up to the closing '%'.
+        lines = block.split('\n')
+        M = amacro.parseApertureMacro(lines[0], lines[1:])
+        if M:
+          if currtool:
+            raise RuntimeError, "File %s has an aperture macro definition that comes after drawing commands." % fullname
 
-      # From this point on we may have more than one match on this line, e.g.:
-      #   G54D11*X22400Y22300D02*X22500Y22200D01*
-      sub_line = line
-      while sub_line:
-        # Handle "comment" G-codes first
-        match = comment_pat.match(sub_line)
-        if match:
-          sub_line = sub_line[match.end():]
+          apmdefs.append(M)
+          localMacroNames[M.name] = M.name
           continue
 
-        # See if this is a format statement, and if so, map it. In version 1.3 this was moved down
-        # from the line-only parse checks above (see comment) to handle OrCAD lines like
-        # G74*%FSLAN2X34Y34*%
-        match = format_pat.match(sub_line)   # Used to be format_pat.search
+        # See if this is a format statement, and if so, map it. OrCAD issues these
+        # on the same line as other commands, like G74*%FSLAN2X34Y34*%
+        match = format_pat.match(block)
         if match:
-          sub_line = sub_line[match.end():]
           for item in match.groups():
             if item is None: continue   # Optional group didn't match
 
@@ -392,117 +400,49 @@ class Job:
               y_div = 10.0**(5-fracpart)
           continue
 
-        # Parse and interpret G-codes
-        match = gcode_pat.match(sub_line)
-        if match:
-          sub_line = sub_line[match.end():]
-          gcode = int(match.group(1))
-
-          # Determine if this is a G-Code that should be ignored because it has no effect
-          # (e.g., G70 specifies "inches" which is already in effect).
-          if gcode in [54, 70, 90]:
-            continue
-
-          # Determine if this is a G-Code that we have to emit because it matters.
-          if gcode in [1, 2, 3, 36, 37, 74, 75]:
-            self.commands[layername].append("G%02d" % gcode)
-
-            # Determine if this is a G-code that sets a new mode
-            if gcode in [1, 36, 37]:
-              last_gmode = gcode
-
-            # Remember last G74/G75 code so we know whether to do signed or unsigned I/J
-            # offsets.
-            if gcode==74:
-              circ_signed = False
-            elif gcode==75:
-              circ_signed = True
-              
-            continue
-
-          raise RuntimeError, "G-Code 'G%02d' is not supported" % gcode
-
-        # See if this is a tool change (aperture change) command
-        match = tool_pat.match(sub_line)
-        if match:
-          currtool = match.group(1)
-
-          # Protel likes to issue random D01, D02, and D03 commands instead of aperture
-          # codes. We can ignore D01 because it simply means to move to the current location
-          # while drawing. Well, that's drawing a point. We can ignore D02 because it means
-          # to move to the current location without drawing. Truly pointless. We do NOT want
-          # to ignore D03 because it implies a flash. Protel very inefficiently issues a D02
-          # move to a location without drawing, then a single-line D03 to flash. However, a D02
-          # terminates a polygon in G36 mode, so keep D02's in this case.
-          if currtool=='D01' or (currtool=='D02' and (last_gmode != 36)):
-            sub_line = sub_line[match.end():]
-            continue
-
-          if (currtool == 'D03') or (currtool=='D02' and (last_gmode == 36)):
-            self.commands[layername].append(currtool)
-            sub_line = sub_line[match.end():]
-            continue
-
-          # Map it using our translation table
-          if not self.apxlat[layername].has_key(currtool):
-            raise RuntimeError, 'File %s has tool change command "%s" with no corresponding translation' % (fullname, currtool)
-
-          currtool = self.apxlat[layername][currtool]
-
-          # Add it to the list of things to write out
-          self.commands[layername].append(currtool)
-
-          # Add it to the list of all apertures needed by this layer
-          self.apertures[layername].append(currtool)
-
-          # Move on to next match, if any
-          sub_line = sub_line[match.end():]
-          continue
-
-        # Is it a simple draw command?
-        I = J = None  # For circular interpolation drawing commands
-        match = drawXY_pat.match(sub_line)
-        isLastShorthand = False    # By default assume we don't make use of last_x and last_y
-        if match:
-          x, y, d = map(__builtin__.int, match.groups())
+        # If it's none of the above, it had better be on our ignore list.
+        for pat in IgnoreList:
+          if pat.match(block):
+            break
         else:
-          match = drawX_pat.match(sub_line)
-          if match:
-            x, d = map(__builtin__.int, match.groups())
-            y = last_y
-            isLastShorthand = True  # Indicate we're making use of last_x/last_y
+          raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, block)
+        continue
+
+      # From this point on we may have more than one command in a block, e.g.
+      # G54D11* or G01X22500Y22200D01*, so dispatch on the leading character
+      # until the block is used up.
+      while block:
+        c = block[0]
+
+        # Drawing commands are by far the most common so check for them first.
+        # Blocks beginning with I or J (i.e., with both X and Y omitted) are not
+        # supported and end up on the "uninterpretable" pile below.
+        if c == 'X' or c == 'Y':
+          match = draw_pat.match(block)
+          if match is None:
+            raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, block)
+
+          x, y, I, J, d = match.groups()
+          d = int(d)
+
+          isLastShorthand = False    # By default assume we don't make use of last_x and last_y
+          if x is None:
+            x = last_x
+            isLastShorthand = True   # Indicate we're making use of last_x/last_y
           else:
-            match = drawY_pat.match(sub_line)
-            if match:
-              y, d = map(__builtin__.int, match.groups())
-              x = last_x
-              isLastShorthand = True  # Indicate we're making use of last_x/last_y
-
-        # Maybe it's a circular interpolation draw command with IJ components
-        if match is None:
-          match = cdrawXY_pat.match(sub_line)
-          if match:
-            x, y, I, J, d = map(__builtin__.int, match.groups())
+            x = int(x)
+          if y is None:
+            y = last_y
+            isLastShorthand = True
           else:
-            match = cdrawX_pat.match(sub_line)
-            if match:
-              x, I, J, d = map(__builtin__.int, match.groups())
-              y = last_y
-              isLastShorthand = True  # Indicate we're making use of last_x/last_y
-            else:
-              match = cdrawY_pat.match(sub_line)
-              if match:
-                y, I, J, d = map(__builtin__.int, match.groups())
-                x = last_x
-                isLastShorthand = True  # Indicate we're making use of last_x/last_y
+            y = int(y)
 
-        if match:
           if currtool is None:
             # It's OK if this is an exposure-off movement command (specified with D02).
             # It's also OK if we're in the middle of a G36 polygon fill as we're only defining
             # the polygon extents.
             if (d != 2) and (last_gmode != 36):
-              raise RuntimeError, 'File %s has draw command %s with no aperture chosen' % (fullname, sub_line)
+              raise RuntimeError, 'File %s has draw command %s with no aperture chosen' % (fullname, block)
 
           # Save last_x/y BEFORE scaling to 2.5 format else subsequent single-ordinate
           # flashes (e.g., Y with no X) will be scaled twice!
@@ -513,7 +453,7 @@ class Job:
           # or Yxxxxx) then prepend the point X0000Y0000 into the commands as it is actually the starting
           # point of our layer. We prepend the command X0000Y0000D02, i.e., a move to (0,0) without drawing.
           if (isLastShorthand and firstFlash):
-            self.commands[layername].append((0,0,2))
+            appendDraw(0,0,2)
             if updateExtents:
               self.minx = min(self.minx,0)
               self.maxx = max(self.maxx,0)
@@ -523,11 +463,16 @@ class Job:
           x = int(round(x*x_div))
           y = int(round(y*y_div))
           if I is not None:
-            I = int(round(I*x_div))
-            J = int(round(J*y_div))
-            self.commands[layername].append((x,y,I,J,d,circ_signed))
+            I = int(round(int(I)*x_div))
+            J = int(round(int(J)*y_div))
+            appendArc(x,y,I,J,d,circ_signed)
           else:
-            self.commands[layername].append((x,y,d))
+            opAppend(cmdlist.DRAW)
+            xAppend(x)
+            yAppend(y)
+            iAppend(0)
+            jAppend(0)
+            dAppend(d)
           firstFlash = False
 
           # Update dimensions...this is complicated for circular interpolation commands
@@ -538,28 +483,108 @@ class Job:
             if x > self.maxx: self.maxx = x
             if y < self.miny: self.miny = y
             if y > self.maxy: self.maxy = y
+          break
 
-          # Move on to next match, if any
-          sub_line = sub_line[match.end():]
-          continue
+        # See if this is a tool change (aperture change) command
+        if c == 'D':
+          if block[-1] != '*' or not block[1:-1].isdigit():
+            raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, block)
+          currtool = block[:-1]
 
-        # If it's none of the above, it had better be on our ignore list.
-        for pat in IgnoreList:
-          match = pat.match(sub_line)
-          if match:
+          # Protel likes to issue random D01, D02, and D03 commands instead of aperture
+          # codes. We can ignore D01 because it simply means to move to the current location
+          # while drawing. Well, that's drawing a point. We can ignore D02 because it means
+          # to move to the current location without drawing. Truly pointless. We do NOT want
+          # to ignore D03 because it implies a flash. Protel very inefficiently issues a D02
+          # move to a location without drawing, then a single-line D03 to flash. However, a D02
+          # terminates a polygon in G36 mode, so keep D02's in this case.
+          if currtool=='D01' or (currtool=='D02' and (last_gmode != 36)):
             break
-        else:
-          raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, line)
 
-        sub_line = sub_line[match.end():]
-      # end while still things to match on this line
-    # end of for each line in file
+          if (currtool == 'D03') or (currtool=='D02' and (last_gmode == 36)):
+            appendCode(currtool)
+            break
+
+          # It must be an aperture defined in this file. It is mapped to the
+          # global aperture table later, in translateApertures().
+          if not localAps.has_key(currtool):
+            raise RuntimeError, 'File %s has tool change command "%s" with no corresponding translation' % (fullname, currtool)
+
+          # Add it to the list of things to write out
+          commands.appendAperture(currtool)
+
+          # Add it to the list of all apertures needed by this layer
+          if currtool not in apertures:
+            apertures.append(currtool)
+          break
+
+        if c == 'G':
+          # Handle "comment" G-codes first
+          if comment_pat.match(block):
+            break
+
+          # Parse and interpret G-codes
+          match = gcode_pat.match(block)
+          if match is None:
+            raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, block)
+          gcode = int(match.group(1))
+
+          # Move on to the rest of the block, if any (e.g., the D11* in G54D11*)
+          block = block[match.end():]
+          if block == '*':
+            block = ''
+
+          # Determine if this is a G-Code that should be ignored because it has no effect
+          # (e.g., G70 specifies "inches" which is already in effect).
+          if gcode in [54, 70, 90]:
+            continue
+
+          # Determine if this is a G-Code that we have to emit because it matters.
+          if gcode in [1, 2, 3, 36, 37, 74, 75]:
+            appendCode("G%02d" % gcode)
+
+            # Determine if this is a G-code that sets a new mode
+            if gcode in [1, 36, 37]:
+              last_gmode = gcode
+
+            # Remember last G74/G75 code so we know whether to do signed or unsigned I/J
+            # offsets.
+            if gcode==74:
+              circ_signed = False
+            elif gcode==75:
+              circ_signed = True
+
+            continue
+
+          raise RuntimeError, "G-Code 'G%02d' is not supported" % gcode
+
+        # If it's none of the above, it had better be on our ignore list. That's
+        # an end-of-program (M02) or an empty statement.
+        if block in ('M02*', 'M2*', '*'):
+          break
+
+        raise RuntimeError, 'File %s has uninterpretable line:\n  %s' % (fullname, block)
+      # end while still things to match in this block
+    # end of for each block in file
+
+    commands.compact()
 
-    fid.close()
     if 0:
       print layername
       print self.commands[layername]
 
+  def translateApertures(self, layername):
+    """Replace local aperture codes in the aperture change commands of a layer
+       with global ones, using the apxlat table for the layer"""
+    xlat = self.apxlat[layername]
+
+    self.commands[layername].renameApertures(xlat)
+    apertures = []
+    for ap in self.apertures[layername]:
+      if xlat[ap] not in apertures:
+        apertures.append(xlat[ap])
+    self.apertures[layername] = apertures
+
   def parseExcellon(self, fullname):
     #print 'Reading data from %s ...' % fullname
 
@@ -698,8 +723,19 @@ class Job:
   def hasLayer(self, layername):
     return self.commands.has_key(layername)
 
-  def writeGerber(self, fid, layername, Xoff, Yoff):
-    "Write out the data such that the lower-left corner of this job is at the given (X,Y) position, in inches"
+  def layerCommands(self, layername):
+    "Return the CommandList of a layer, for writing it out"
+    return self.commands[layername]
+
+  def drillHits(self, tool):
+    "Return a list of the (X,Y) plunge commands for a tool, for writing them out"
+    return self.xcommands.get(tool, [])
+
+  def writeGerber(self, fid, layername, Xoff, Yoff, templates=None):
+    """Write out the data such that the lower-left corner of this job is at the given (X,Y) position, in inches.
+    The text of the layer is formatted once into a cmdlist.GerberTemplate. If
+    a 'templates' dictionary is given, the template is kept in it (keyed by
+    this job) and used again for other copies of this job in the same file."""
     
     # Maybe we don't have this layer
     if not self.hasLayer(layername): return
@@ -717,22 +753,17 @@ class Job:
     # of one job to the beginning of the next when a layer is repeated
     # due to panelizing.
     fid.write('X%07dY%07dD02*\n' % (X, Y))
-    for cmd in self.commands[layername]:
-      if type(cmd) is types.TupleType:
-        if len(cmd)==3:
-          x, y, d = cmd
-          fid.write('X%07dY%07dD%02d*\n' % (x+DX, y+DY, d))
-        else:
-          x, y, I, J, d, s = cmd
-          fid.write('X%07dY%07dI%07dJ%07dD%02d*\n' % (x+DX, y+DY, I, J, d)) # I,J are relative
-      else:
-        # It's an aperture change, G-code, or RS274-X command that begins with '%'. If
-        # it's an aperture code, the aperture has already been translated
-        # to the global aperture table during the parse phase.
-        if cmd[0]=='%':
-          fid.write('%s\n' % cmd)  # The command already has a * in it (e.g., "%LPD*%")
-        else:
-          fid.write('%s*\n' % cmd)
+
+    # Aperture codes have already been translated to the global aperture
+    # table during the parse phase.
+    if templates is None:
+      template = cmdlist.GerberTemplate(self.layerCommands(layername))
+    else:
+      try:
+        template = templates[self]
+      except KeyError:
+        template = templates[self] = cmdlist.GerberTemplate(self.layerCommands(layername))
+    template.write(fid, DX, DY)
 
   def findTools(self, diameter):
     "Find the tools, if any, with the given diameter in inches. There may be more than one!"
@@ -769,10 +800,9 @@ class Job:
 
     # Boogie
     for ltool in ltools:
-      if self.xcommands.has_key(ltool):
-        for cmd in self.xcommands[ltool]:
-          x, y = cmd
-          fid.write(fmtstr % (x+DX, y+DY))
+      for cmd in self.drillHits(ltool):
+        x, y = cmd
+        fid.write(fmtstr % (x+DX, y+DY))
 
   def writeDrillHits(self, fid, diameter, toolNum, Xoff, Yoff):
     """Write a drill hit pattern. diameter is tool diameter in inches, while toolNum is
@@ -792,10 +822,9 @@ class Job:
     ltools = self.findTools(diameter)
 
     for ltool in ltools:
-      if self.xcommands.has_key(ltool):
-        for cmd in self.xcommands[ltool]:
-          x, y = cmd
-          makestroke.drawDrillHit(fid, 10*x+DX, 10*y+DY, toolNum)
+      for cmd in self.drillHits(ltool):
+        x, y = cmd
+        makestroke.drawDrillHit(fid, 10*x+DX, 10*y+DY, toolNum)
 
   def aperturesAndMacros(self, layername):
     "Return dictionaries whose keys are all necessary aperture names and macro names for this layer"
@@ -811,12 +840,15 @@ class Job:
     else:
       return {}, {}
 
-  def makeLocalApertureCode(self, layername, AP):
-    "Find or create a layer-specific aperture code to represent the global aperture given"
-    if AP.code not in self.apxlat[layername].values():
-      lastCode = aptable.findHighestApertureCode(self.apxlat[layername].keys())
-      localCode = 'D%d' % (lastCode+1)
-      self.apxlat[layername][localCode] = AP.code
+  def renameApertures(self, layername, xlat):
+    "Replace aperture codes of the given layer that are keys in dictionary xlat with the corresponding values"
+    self.commands[layername].renameApertures(xlat)
+
+  def makeLocalApertureCode(self, layername, code):
+    "Find or create a layer-specific aperture code to represent the given global aperture code"
+    xlat = self.apxlat[layername]
+    if xlat.find(code) is None:
+      xlat.add(code)
 
   def inBorders(self, x, y):
     return (x >= self.minx) and (x <= self.maxx) and (y >= self.miny) and (y <= self.maxy)
@@ -824,23 +856,21 @@ class Job:
   def trimGerberLayer(self, layername):
     "Modify drawing commands that are outside job dimensions"
 
-    newcmds = []
+    newcmds = cmdlist.CommandList()
     lastInBorders = True
     lastx, lasty, lastd = self.minx, self.miny, 2   # (minx,miny,exposure off)
     bordersRect = (self.minx, self.miny, self.maxx, self.maxy)
     lastAperture = None
 
-    for cmd in self.commands[layername]:
-      if type(cmd) == types.TupleType:
-        # It is a data command: tuple (X, Y, D), all integers, or (X, Y, I, J, D), all integers.
-        if len(cmd)==3:
-          x, y, d = cmd
-          # I=J=None   # In case we support circular interpolation in the future
-        else:
+    L = self.commands[layername]
+    names = L.names
+    for op, x, y, I, J, d in itertools.izip(L.op, L.x, L.y, L.i, L.j, L.d):
+      if op < cmdlist.CODE:
+        # It is a data command: (X, Y, D), all integers, or (X, Y, I, J, D), all integers.
+        if op != cmdlist.DRAW:
           # We don't do anything with circular interpolation for now, so just issue
           # the command and be done with it.
-          # x, y, I, J, d, s = cmd
-          newcmds.append(cmd)
+          newcmds.appendArc(x, y, I, J, d, op==cmdlist.SARC)
           continue
 
         newInBorders = self.inBorders(x,y)
@@ -871,7 +901,7 @@ class Job:
           if lastAperture.isRectangle():
             apertureRect = lastAperture.rectangleAsRect(x,y)
             if geometry.isRect1InRect2(apertureRect, bordersRect):
-              newcmds.append(cmd)
+              newcmds.appendDraw(x, y, d)
             else:
               newRect = geometry.intersectExtents(apertureRect, bordersRect)
 
@@ -890,16 +920,16 @@ class Job:
                   global_code = aptable.findOrAddAperture(newAP)
 
                   # We need an unused local aperture code to correspond to this newly-created global one.
-                  self.makeLocalApertureCode(layername, newAP)
+                  self.makeLocalApertureCode(layername, global_code)
 
                   # Make sure to indicate that the new aperture is one that is used by this layer
                   if global_code not in self.apertures[layername]:
                     self.apertures[layername].append(global_code)
 
                   # Switch to new aperture code, flash new aperture, switch back to previous aperture code
-                  newcmds.append(global_code)
-                  newcmds.append((newX, newY, 3))
-                  newcmds.append(lastAperture.code)
+                  newcmds.appendAperture(global_code)
+                  newcmds.appendDraw(newX, newY, 3)
+                  newcmds.appendAperture(lastAperture.code)
                 else:
                   pass    # Ignore this flash...area in common is too thin
               else:
@@ -907,7 +937,7 @@ class Job:
           elif self.inBorders(x, y):
             # Aperture is not a rectangle and its center is somewhere within our
             # borders. Flash it and ignore part outside borders (for now).
-            newcmds.append(cmd)
+            newcmds.appendDraw(x, y, d)
           else:
             pass    # Ignore this flash
 
@@ -916,7 +946,7 @@ class Job:
         # and sets the start point for a line draw to a new location.
         elif d==2:
           if self.inBorders(x, y):
-            newcmds.append(cmd)
+            newcmds.appendDraw(x, y, d)
 
         else:
           # This is an exposure on (draw line) command. Now things get interesting.
@@ -954,7 +984,7 @@ class Job:
           # All of the above are for linear interpolation. Circular interpolation
           # is ignored for now.
           if lastInBorders and newInBorders:    # Case D
-            newcmds.append(cmd)
+            newcmds.appendDraw(x, y, d)
 
           else:
             # segmentXbox() returns a list of 0, 1, or 2 points describing the intersection
@@ -970,20 +1000,20 @@ class Job:
             elif len(pointsL)==1:     # Cases B and C
               pt1 = pointsL[0]
               if newInBorders:      # Case B
-                newcmds.append((pt1[0], pt1[1], 2))   # Go to intersection point, exposure off
-                newcmds.append(cmd)                   # Go to destination point, exposure on
+                newcmds.appendDraw(pt1[0], pt1[1], 2) # Go to intersection point, exposure off
+                newcmds.appendDraw(x, y, d)           # Go to destination point, exposure on
               else:                 # Case C
-                newcmds.append((pt1[0], pt1[1], 1))   # Go to intersection point, exposure on
-                newcmds.append((x, y, 2))             # Go to destination point, exposure off
+                newcmds.appendDraw(pt1[0], pt1[1], 1) # Go to intersection point, exposure on
+                newcmds.appendDraw(x, y, 2)           # Go to destination point, exposure off
                 d = 2                                 # Make next 'lastd' represent exposure off
 
             else:                 # Case A, two points of intersection
               pt1 = pointsL[0]
               pt2 = pointsL[1]
 
-              newcmds.append((pt1[0], pt1[1], 2))   # Go to first intersection point, exposure off
-              newcmds.append((pt2[0], pt2[1], 1))   # Draw to second intersection point, exposure on
-              newcmds.append((x, y, 2))             # Go to destination point, exposure off
+              newcmds.appendDraw(pt1[0], pt1[1], 2) # Go to first intersection point, exposure off
+              newcmds.appendDraw(pt2[0], pt2[1], 1) # Draw to second intersection point, exposure on
+              newcmds.appendDraw(x, y, 2)           # Go to destination point, exposure off
               d = 2                                 # Make next 'lastd' represent exposure off
 
         lastx, lasty, lastd = x, y, d
@@ -991,10 +1021,11 @@ class Job:
       else:
         # It's a string indicating an aperture change, G-code, or RS-274X
         # command (e.g., "D13", "G75", "%LPD*%")
-        newcmds.append(cmd)
-        if cmd[0]=='D' and int(cmd[1:])>=10:  # Don't interpret D01, D02, D03
-          lastAperture = config.GAT[cmd]
+        newcmds.appendName(op, names[d])
+        if op==cmdlist.APERTURE:    # Don't interpret D01, D02, D03
+          lastAperture = config.GAT[names[d]]
 
+    newcmds.compact()
     self.commands[layername] = newcmds
 
   def trimGerber(self):
@@ -1016,7 +1047,9 @@ class Job:
 
 # This class encapsulates a Job object, providing absolute
 # positioning information.
-class JobLayout:
+class JobLayout(object):
+  __slots__ = ('job', 'x', 'y')
+
   def __init__(self, job):
     self.job = job
     self.x = None
@@ -1025,9 +1058,9 @@ class JobLayout:
   def canonicalize(self):       # Must return a JobLayout object as a list
     return [self]
 
-  def writeGerber(self, fid, layername):
+  def writeGerber(self, fid, layername, templates=None):
     assert self.x is not None
-    self.job.writeGerber(fid, layername, self.x, self.y)
+    self.job.writeGerber(fid, layername, self.x, self.y, templates)
 
   def aperturesAndMacros(self, layername):
     return self.job.aperturesAndMacros(layername)
@@ -1122,167 +1155,180 @@ class JobLayout:
     tools = self.job.findTools(diameter)
     total = 0
     for tool in tools:
-      try:
-        total += len(self.job.xcommands[tool])
-      except:
-        pass
+      total += len(self.job.drillHits(tool))
 
     return total
 
   def jobarea(self):
     return self.job.jobarea()
 
-def rotateJob(job, degrees = 90, firstpass = True):
-  """Create a new job from an existing one, rotating by specified degrees in 90 degree passes"""
-  GAT = config.GAT
-  GAMT = config.GAMT
-  ##print "rotating job:", job.name, degrees, firstpass
-  if firstpass:
-    if degrees == 270:
-        J = Job(job.name+'*rotated270')
-    elif degrees == 180:
-        J = Job(job.name+'*rotated180')
+# A RotatedJob is a Job rotated counterclockwise by a multiple of 90 degrees
+# about its lower-left corner, which stays in place. Only the rotated extents
+# and aperture translation tables are computed up front. The commands and drill
+# hits of the original job are transformed as they are written out, and a full
+# rotated copy of them is made only when something asks for the 'commands' or
+# 'xcommands' of the rotated job, e.g., trimming or minimum feature thickening.
+#
+# The layers and drill hits of the original job are captured when the
+# RotatedJob is created, so that later changes to the original job (e.g.,
+# minimum feature thickening or drill clustering, which replace its apertures
+# and tool lists) do not leak into the rotated job, just as for a full copy.
+class RotatedJob(Job):
+  __slots__ = ('layers', 'hits', 'transform', 'toolChangeReplace', 'layerReplace', \
+               '_commands', '_apertures', '_xcommands')
+
+  def __init__(self, job, turns):
+    Job.__init__(self, '%s*rotated%d' % (job.name, 90*turns))
+
+    self.layers = {}
+    for layername, L in job.commands.items():
+      self.layers[layername] = L.snapshot()
+    self.hits = job.xcommands.copy()
+
+    # Nothing has been transformed yet
+    self._commands = None
+    self._apertures = None
+    self._xcommands = None
+
+    # Keep the origin (lower-left) in the same place
+    width = job.maxx-job.minx
+    height = job.maxy-job.miny
+    self.minx = job.minx
+    self.miny = job.miny
+    if turns & 1:
+      self.maxx = job.minx + height
+      self.maxy = job.miny + width
     else:
-        J = Job(job.name+'*rotated90')
-  else:
-    J = Job(job.name)
-
-  # Keep the origin (lower-left) in the same place
-  J.maxx = job.minx + job.maxy-job.miny
-  J.maxy = job.miny + job.maxx-job.minx
-  J.minx = job.minx
-  J.miny = job.miny
-
-  RevGAT = config.buildRevDict(GAT)   # RevGAT[hash] = aperturename
-  RevGAMT = config.buildRevDict(GAMT) # RevGAMT[hash] = aperturemacroname
-
-  # Keep list of tool diameters and default tool list
-  J.xdiam = job.xdiam
-  J.ToolList = job.ToolList
-  J.Repeat = job.Repeat
-
-  # D-code translation table is the same, except we have to rotate
-  # those apertures which have an orientation: rectangles, ovals, and macros.
-
-  ToolChangeReplace = {}
-  for layername in job.apxlat.keys():
-    J.apxlat[layername] = {}
-
-    for ap in job.apxlat[layername].keys():
-      code = job.apxlat[layername][ap]
-      A = GAT[code]
-
-      if A.apname in ('Circle', 'Octagon'):
-        # This aperture is fine. Copy it over.
-        J.apxlat[layername][ap] = code
-        continue
-
-      # Must rotate the aperture
-      APR = A.rotated(RevGAMT)
-
-      # Does it already exist in the GAT?
-      hash = APR.hash()
-      try:
-        # Yup...add it to apxlat
-        newcode = RevGAT[hash]
-      except KeyError:
-        # Must add new aperture to GAT
-        newcode = aptable.addToApertureTable(APR)
-
-        # Rebuild RevGAT
-        #RevGAT = config.buildRevDict(GAT)
-        RevGAT[hash] = newcode
-
-      J.apxlat[layername][ap] = newcode
-
-      # Must also replace all tool change commands from
-      # old code to new command.
-      ToolChangeReplace[code] = newcode
-
-  # Now we copy commands, rotating X,Y positions.
-  # Rotations will occur counterclockwise about the
-  # point (minx,miny). Then, we shift to the right
-  # by the height so that the lower-left point of
-  # the rotated job continues to be (minx,miny).
-  #
-  # We also have to take aperture change commands and
-  # replace them with the new aperture code if we have
-  # a rotation.
-  offset = job.maxy-job.miny
-  for layername in job.commands.keys():
-    J.commands[layername] = []
-    J.apertures[layername] = []
-
-    for cmd in job.commands[layername]:
-      # Is it a drawing command?
-      if type(cmd) is types.TupleType:
-        if len(cmd)==3:
-          x, y, d = map(__builtin__.int, cmd)
-          II=JJ=None
-        else:
-          x, y, II, JJ, d, signed = map(__builtin__.int, cmd)   # J is already used as Job object
+      self.maxx = job.maxx
+      self.maxy = job.maxy
+
+    # Keep list of tool diameters and default tool list
+    self.xdiam = job.xdiam
+    self.ToolList = job.ToolList
+    self.Repeat = job.Repeat
+
+    # D-code translation table is the same, except we have to rotate
+    # those apertures which have an orientation: rectangles, ovals, and macros.
+    # Aperture change commands must be changed accordingly.
+    self.toolChangeReplace = {}
+    self.layerReplace = {}      # Per-layer replacements, see renameApertures()
+    for layername in job.apxlat.keys():
+      self.apxlat[layername] = config.CodeTable()
+
+      for ap, code in job.apxlat[layername].items():
+        newcode = aptable.findRotatedAperture(code, turns)
+        self.apxlat[layername][ap] = newcode
+        if newcode != code:
+          self.toolChangeReplace[code] = newcode
+
+    # Rotations occur counterclockwise about the point (minx,miny), followed
+    # by a shift so that the lower-left point of the rotated job continues
+    # to be (minx,miny). The transform (a,b,c,d,e,f) maps (X,Y) to
+    # (a*X+b*Y+c, d*X+e*Y+f).
+    minx = job.minx
+    miny = job.miny
+    if turns == 1:      # (X,Y) --> (-Y,X)
+      self.transform = (0, -1, minx+miny+height, 1, 0, miny-minx)
+    elif turns == 2:    # (X,Y) --> (-X,-Y)
+      self.transform = (-1, 0, 2*minx+width, 0, -1, 2*miny+height)
+    else:               # (X,Y) --> (Y,-X)
+      self.transform = (0, 1, minx-miny, -1, 0, miny+minx+width)
+
+  def getCommands(self):
+    if self._commands is None:
+      self._commands = {}
+      for layername in self.layers.keys():
+        self._commands[layername] = self.layers[layername].transformed(self.transform, self.replacements(layername))
+    return self._commands
+
+  def setCommands(self, commands):
+    self._commands = commands
+
+  commands = property(getCommands, setCommands)
+
+  def getApertures(self):
+    if self._apertures is None:
+      if self._commands is not None:
+        self._apertures = {}
+        for layername in self._commands.keys():
+          self._apertures[layername] = self._commands[layername].aperturesUsed()
       else:
-        # No, must be a string indicating aperture change, G-code, or RS274-X command.
-        if cmd[0] in ('G', '%'):
-          # G-codes and RS274-X commands are just copied verbatim and not affected by rotation
-          J.commands[layername].append(cmd)
-          continue
-
-        # It's a D-code. See if we need to replace aperture changes with a rotated aperture.
-        # But only for D-codes >= 10.
-        if int(cmd[1:]) < 10:
-          J.commands[layername].append(cmd)
-          continue
-
-        try:
-          newcmd = ToolChangeReplace[cmd]
-          J.commands[layername].append(newcmd)
-          J.apertures[layername].append(newcmd)
-        except KeyError:
-          J.commands[layername].append(cmd)
-          J.apertures[layername].append(cmd)
-        continue
+        # Only the aperture codes are needed so leave the commands alone
+        self._apertures = {}
+        for layername in self.layers.keys():
+          L = []
+          for ap in self.layers[layername].aperturesUsed():
+            ap = self.toolChangeReplace.get(ap, ap)
+            if ap not in L:
+              L.append(ap)
+          self._apertures[layername] = L
+    return self._apertures
+
+  def setApertures(self, apertures):
+    self._apertures = apertures
+
+  apertures = property(getApertures, setApertures)
+
+  def getXcommands(self):
+    if self._xcommands is None:
+      self._xcommands = {}
+      for tool in self.hits.keys():
+        self._xcommands[tool] = transformHits(self.hits[tool], self.transform)
+    return self._xcommands
+
+  def setXcommands(self, xcommands):
+    self._xcommands = xcommands
+
+  xcommands = property(getXcommands, setXcommands)
 
-      # (X,Y) --> (-Y,X) effects a 90-degree counterclockwise shift
-      # Adding 'offset' to -Y maintains the lower-left origin of (minx,miny).
-      newx = -(y - job.miny) + job.minx + offset
-      newy = (x-job.minx) + job.miny
-
-      # For circular interpolation commands, (I,J) components are always relative
-      # so we do not worry about offsets, just reverse their sense, i.e., I becomes J
-      # and J becomes I. For 360-degree circular interpolation, I/J are signed and we
-      # must map (I,J) --> (-J,I).
-      if II is not None:
-        if signed:
-          J.commands[layername].append((newx, newy, -JJ, II, d, signed))
-        else:
-          J.commands[layername].append((newx, newy, JJ, II, d, signed))
-      else:
-        J.commands[layername].append((newx,newy,d))
-
-    if 0:
-      print job.minx, job.miny, offset
-      print layername
-      print J.commands[layername]
-
-  # Finally, rotate drills. Offset is in hundred-thousandths (2.5) while Excellon
-  # data is in 2.4 format.
-  for tool in job.xcommands.keys():
-    J.xcommands[tool] = []
-
-    for x,y in job.xcommands[tool]:
-      newx = -(10*y - job.miny) + job.minx + offset
-      newy =  (10*x - job.minx) + job.miny
-
-      newx = int(round(newx/10.0))
-      newy = int(round(newy/10.0))
-
-      J.xcommands[tool].append((newx,newy))
-
-  # Rotate some more if required
-  degrees -= 90
-  if degrees > 0:
-    return rotateJob(J, degrees, False)
-  else:
-    ##print "rotated:", J.name
-    return J
+  def hasLayer(self, layername):
+    if self._commands is not None:
+      return self._commands.has_key(layername)
+    return self.layers.has_key(layername)
+
+  def layerCommands(self, layername):
+    if self._commands is not None:
+      return self._commands[layername]
+    return self.layers[layername].transformed(self.transform, self.replacements(layername))
+
+  def replacements(self, layername):
+    "Return the aperture code replacements for the commands of the original job in the given layer"
+    return self.layerReplace.get(layername, self.toolChangeReplace)
+
+  def renameApertures(self, layername, xlat):
+    if self._commands is not None:
+      Job.renameApertures(self, layername, xlat)
+      return
+
+    # Not transformed yet, so fold the renaming into the replacements made
+    # when the commands are transformed
+    old = self.replacements(layername)
+    new = {}
+    for code, newcode in old.items():
+      new[code] = xlat.get(newcode, newcode)
+    for code, newcode in xlat.items():
+      if not old.has_key(code):
+        new[code] = newcode
+    self.layerReplace[layername] = new
+
+  def drillHits(self, tool):
+    if self._xcommands is not None:
+      return self._xcommands.get(tool, [])
+    return transformHits(self.hits.get(tool, []), self.transform)
+
+def transformHits(hits, transform):
+  """Return a list of Excellon (X,Y) plunge commands transformed as described
+  for RotatedJob. The transform is in hundred-thousandths (2.5) while Excellon
+  data is in 2.4 format."""
+  a, b, c, d, e, f = transform
+  return [(int(round((10*(a*x + b*y) + c)/10.0)), int(round((10*(d*x + e*y) + f)/10.0))) \
+            for x, y in hits]
+
+def rotateJob(job, degrees = 90):
+  """Create a new job from an existing one, rotated counterclockwise by the given
+  multiple of 90 degrees. The lower-left corner of the job stays in place."""
+  turns = (degrees/90) % 4
+  if degrees % 90 or not turns:
+    raise RuntimeError, "Jobs can only be rotated by 90, 180 or 270 degrees, not %s" % degrees
+
+  return RotatedJob(job, turns)
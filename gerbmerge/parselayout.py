@@ -91,9 +91,9 @@ class Panel:                 # Meant to be subclassed as either a Row() or Col()
       height = max(height,job.height_in())
     return height
 
-  def writeGerber(self, fid, layername):
+  def writeGerber(self, fid, layername, templates=None):
     for job in self.jobs:
-      job.writeGerber(fid, layername)
+      job.writeGerber(fid, layername, templates)
     
   def writeExcellon(self, fid, tool):
     for job in self.jobs:
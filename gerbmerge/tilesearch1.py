@@ -10,10 +10,20 @@ http://ruggedcircuits.com/gerbmerge
 """
 
 import sys
+import os
 import time
+import signal
+import Queue
+import traceback
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None    # Python 2.5 and earlier: always search in one process
 
 import config
 import tiling
+import tilesearch4
 
 import gerbmerge
 
@@ -22,25 +32,129 @@ _CkpointTime = 0.0         # Next time to print stats
 _Placements = 0L           # Number of placements attempted
 _PossiblePermutations = 0L # Number of different ways of ordering jobs
 _Permutations = 0L         # Number of different job orderings already computed
+_Pruned = 0L               # Number of partial tilings abandoned because they cannot beat the best tiling
 _TBestTiling = None        # Best tiling so far
 _TBestScore  = float(sys.maxint) # Smallest area so far
 _PrintStats = 1            # Print statistics every 3 seconds
+_Shared = None             # State shared with the other processes of a parallel search (see _SharedState)
+_SharedScore = float(sys.maxint) # Smallest area found by any process of a parallel search
+_UsedArea = 0.0            # Area of all jobs, for printing the utilization of a parallel search
+_SearchJobs = None         # Jobs of a parallel search, in a worker process
+_SearchPanel = None        # Panel (X,Y) size of a parallel search, in a worker process
+_Table = None              # Transposition table (see TranspositionTable), or None
+_TableHits = 0L            # Number of partial tilings whose subtree was found in _Table
+_TableMisses = 0L          # Number of partial tilings looked up in _Table and searched
+_Found = 0L                # Number of times _TBestTiling was set
+
+# A partial tiling is abandoned when its lower bound on area exceeds the best
+# score by more than this fraction, which allows for rounding errors. Tilings
+# that tie with the best score are still explored, since one of them may have
+# fewer corners.
+_BoundSlack = 1e-9
+
+# Many different orders of placing jobs lead to the same partial tiling, i.e.,
+# the same outline and bounds with the same jobs left to place. Once the
+# subtree below such a tiling has been searched, the transposition table
+# records what was found there, so that the subtree need not be searched
+# again. Only tilings with at least TableJobs jobs left are recorded, since
+# smaller subtrees are searched about as quickly as they are looked up.
+# At most TableSize tilings are recorded.
+TableJobs = 2
+TableSize = 20000
+
+class TranspositionTable:
+  """A bounded dictionary of searched subtrees. Entries are kept in two
+  generations: new entries and those found again go into the current one,
+  and when it is half of the table size the older generation is dropped and
+  the current one takes its place. The entries removed are therefore those
+  not used for longest."""
+  def __init__(self, size):
+    self.size = size
+    self.recent = {}
+    self.older = {}
+
+  def get(self, key):
+    "Return the entry for key, or None"
+    entry = self.recent.get(key)
+    if entry is None:
+      entry = self.older.get(key)
+      if entry is not None:
+        self.put(key, entry)
+    return entry
+
+  def put(self, key, entry):
+    "Add or replace the entry for key"
+    self.recent[key] = entry
+    if 2*len(self.recent) >= self.size:
+      self.older = self.recent
+      self.recent = {}
+
+def resetTable():
+  "Start a search with an empty transposition table"
+  global _Table, _TableHits, _TableMisses
+
+  _Table = TranspositionTable(TableSize)
+  _TableHits = 0L
+  _TableMisses = 0L
+
+def printTableStats():
+  "Print the number of partial tilings found and not found in the transposition table"
+  print "Transposition table: %ld hits / %ld misses" % (_TableHits, _TableMisses)
+
+def _tableKey(Jobs, TSoFar):
+  """Return the key of partial tiling TSoFar with jobs Jobs left to place in
+  the transposition table. Only the outline of the placed jobs is used, as new
+  jobs are only placed against it. Copies of the same job are the same job."""
+  remaining = [id(job) for Xdim,Ydim,job,rjob in Jobs]
+  remaining.sort()
+  return (tuple(TSoFar.points), tuple(remaining), TSoFar.extents[-1][:4])
+
+def _offer(TSoFar, completion):
+  """Make the tiling given by TSoFar and a completion recorded in the
+  transposition table the best tiling if it is better"""
+  global _TBestTiling, _TBestScore, _Found
+
+  score, points, placed = completion
+  if score < _TBestScore or (score == _TBestScore and len(points)-2 < _TBestTiling.corners()):
+    T = TSoFar.clone()
+    T.points = list(points)
+    for job in placed:
+      T.appendJob(job)
+
+    if _Shared is not None and score < _TBestScore:
+      _Shared.improve(score)
+    _TBestTiling,_TBestScore = T,score
+    _Found += 1
 
 def printTilingStats():
-  global _CkpointTime
+  global _CkpointTime, _SharedScore
+
+  if _Shared is not None:
+    # A worker process of a parallel search only reports its progress, and
+    # finds out about better tilings found by other workers
+    _CkpointTime = time.time() + 0.25
+    _Shared.publish()
+    _SharedScore = _Shared.bestScore.value
+    return
+
   _CkpointTime = time.time() + 3
 
-  if _TBestTiling:
+  if _TBestTiling and _TBestScore <= _SharedScore:
     area = _TBestTiling.area()
     utilization = _TBestTiling.usedArea() / area * 100.0
+  elif _SharedScore < float(sys.maxint):
+    # A worker of a parallel search has a better tiling that has not been
+    # sent back yet
+    area = _SharedScore
+    utilization = _UsedArea / area * 100.0
   else:
     area = 999999.0
     utilization = 0.0
 
   percent = 100.0*_Permutations/_PossiblePermutations
 
-  print "\r  %5.2f%% complete / %ld/%ld Perm/Place / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" % \
-        (percent, _Permutations, _Placements, area, utilization),
+  print "\r  %5.2f%% complete / %ld/%ld/%ld Perm/Place/Pruned / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" % \
+        (percent, _Permutations, _Placements, _Pruned, area, utilization),
 
   if gerbmerge.GUI is not None:
     sys.stdout.flush()
@@ -51,32 +165,57 @@ def bestTiling():
 def _tile_search1(Jobs, TSoFar, firstAddPoint, cfg=config.Config):
   """This recursive function does the following with an existing tiling TSoFar:
      
-     * For each 4-tuple (Xdim,Ydim,job,rjob) in Jobs, the non-rotated 'job' is selected
+     * For each 4-tuple (Xdim,Ydim,job,rjob) in Jobs, the non-rotated 'job' is selected.
+       Copies of a job that has already been selected are skipped, as they
+       would only lead to the same tilings again.
      
      * For the non-rotated job, the list of valid add-points is found
 
-     * For each valid add-point, the job is placed at this point in a new,
-       cloned tiling.
+     * For each valid add-point, the job is placed at this point in the
+       tiling.
 
      * The function then calls its recursively with the remaining list of
        jobs.
 
      * The rotated job is then selected and the list of valid add-points is
-       found. Again, for each valid add-point the job is placed there in
-       a new, cloned tiling.
+       found (unless the job is square). Again, for each valid add-point the
+       job is placed there.
 
      * Once again, the function calls itself recursively with the remaining
        list of jobs.
 
+     * After each recursive call the job is removed again by undoing all
+       changes made to the tiling since it was placed. TSoFar is therefore
+       returned to the caller unchanged, and only the best tilings found
+       are copied.
+
      * The best tiling encountered from all recursive calls is returned.
 
+     * Before any of this, a lower bound on the area of all tilings that can
+       be made by adding Jobs to TSoFar is computed. If it is larger than the
+       best score so far, there is nothing to be gained and the function
+       returns at once (branch and bound). In a parallel search, the best
+       score of any worker process is used.
+
+     * Then TSoFar is looked up in the transposition table. If the same
+       partial tiling was reached before, the best tiling found from it then
+       is used and the function returns at once. Each entry is a 2-tuple
+       (bestScore, completion) where bestScore was the best score when the
+       search from the partial tiling began, and completion is None or a
+       3-tuple (score, points, jobs) with the area and outline of the best
+       tiling found from it, and the jobs added to get it. Any tiling from
+       the partial tiling with a score below bestScore was then found, so
+       if the completion's score is below bestScore it is the best there is,
+       and if not there is none better than bestScore.
+
      If TSoFar is None it means this combination of jobs is not tileable.
 
      The side-effect of this function is to set _TBestTiling and _TBestScore
      to the best tiling encountered so far. _TBestTiling could be None if
      no valid tilings have been found so far.
   """
-  global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PrintStats
+  global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _Pruned, _PrintStats
+  global _TableHits, _TableMisses, _Found
 
   if not TSoFar:
     return (None, float(sys.maxint))
@@ -88,26 +227,67 @@ def _tile_search1(Jobs, TSoFar, firstAddPoint, cfg=config.Config):
     score = TSoFar.area()
 
     if score < _TBestScore:
-      _TBestTiling,_TBestScore = TSoFar,score
+      _TBestTiling,_TBestScore = TSoFar.clone(),score
+      _Found += 1
+      if _Shared is not None:
+        _Shared.improve(score)
     elif score == _TBestScore:
       if TSoFar.corners() < _TBestTiling.corners():
-        _TBestTiling,_TBestScore = TSoFar,score
+        _TBestTiling,_TBestScore = TSoFar.clone(),score
+        _Found += 1
 
     _Placements += 1
     if firstAddPoint:
       _Permutations += 1
     return
 
+  bestScore = _TBestScore
+  if _SharedScore < bestScore:
+    bestScore = _SharedScore
+  if TSoFar.lowerBound(Jobs) > bestScore*(1+_BoundSlack):
+    _Pruned += 1
+    if firstAddPoint:
+      # All orderings and rotations of the remaining jobs have been pruned off
+      _Permutations += permutations(Jobs)
+    return
+
+  key = None
+  if _Table is not None and len(Jobs) >= TableJobs and TSoFar.jobs:
+    key = _tableKey(Jobs, TSoFar)
+    entry = _Table.get(key)
+    if entry is not None:
+      limit, completion = entry
+      if completion is not None and completion[0] < limit:
+        _offer(TSoFar, completion)
+        hit = 1
+      else:
+        hit = bestScore <= limit    # Nothing here beats the best score
+
+      if hit:
+        _TableHits += 1
+        if firstAddPoint:
+          _Permutations += permutations(Jobs)
+        return
+
+    _TableMisses += 1
+    found = _Found
+
   xspacing = cfg['xspacing']
   yspacing = cfg['yspacing']
 
+  mark = TSoFar.checkpoint()
   minInletSize = tiling.minDimension(Jobs)
   TSoFar.removeInlets(minInletSize)
+  placed = TSoFar.checkpoint()
 
+  tried = {}
   for job_ix in range(len(Jobs)):
     # Pop off the next job and construct remaining_jobs, a sub-list
     # of Jobs with the job we've just popped off excluded.
     Xdim,Ydim,job,rjob = Jobs[job_ix]
+    if tried.has_key(id(job)):
+      continue      # Another copy of this job (Repeat=N) was placed here already
+    tried[id(job)] = None
     remaining_jobs = Jobs[:job_ix]+Jobs[job_ix+1:]
 
     if 0:
@@ -131,39 +311,34 @@ def _tile_search1(Jobs, TSoFar, firstAddPoint, cfg=config.Config):
     # update the best-tiling-so-far as we do so.
     if addpoints1:
       for ix in addpoints1:
-        # Clone the tiling we're starting with and add the job at this
-        # add-point.
-        T = TSoFar.clone()
-        T.addJob(ix, Xdim+xspacing, Ydim+yspacing, job)
+        # Add the job at this add-point
+        TSoFar.addJob(ix, Xdim+xspacing, Ydim+yspacing, job)
 
         # Recursive call with the remaining jobs and this new tiling. The
         # point behind the last parameter is simply so that _Permutations is
         # only updated once for each permutation, not once per add-point.
-        # A permutation is some ordering of jobs (N! choices) and some
-        # ordering of non-rotated and rotated within that ordering (2**N
-        # possibilities per ordering).
-        _tile_search1(remaining_jobs, T, firstAddPoint and ix==addpoints1[0])
+        # A permutation is some ordering of jobs and some choice of
+        # non-rotated and rotated within that ordering (see permutations()).
+        _tile_search1(remaining_jobs, TSoFar, firstAddPoint and ix==addpoints1[0])
+        TSoFar.undo(placed)
     elif firstAddPoint:
       # Premature prune due to not being able to put this job anywhere. We
-      # have pruned off 2^M permutations where M is the length of the remaining
-      # jobs.
-      _Permutations += 2L**len(remaining_jobs)
+      # have pruned off all permutations of the remaining jobs.
+      _Permutations += permutations(remaining_jobs)
 
     if addpoints2:
       for ix in addpoints2:
-        # Clone the tiling we're starting with and add the job at this
-        # add-point. Remember that the job is rotated so swap X and Y
-        # dimensions.
-        T = TSoFar.clone()
-        T.addJob(ix, Ydim+xspacing, Xdim+yspacing, rjob)
+        # Add the job at this add-point. Remember that the job is rotated so
+        # swap X and Y dimensions.
+        TSoFar.addJob(ix, Ydim+xspacing, Xdim+yspacing, rjob)
 
         # Recursive call with the remaining jobs and this new tiling.
-        _tile_search1(remaining_jobs, T, firstAddPoint and ix==addpoints2[0])
-    elif firstAddPoint:
+        _tile_search1(remaining_jobs, TSoFar, firstAddPoint and ix==addpoints2[0])
+        TSoFar.undo(placed)
+    elif firstAddPoint and Xdim != Ydim:
       # Premature prune due to not being able to put this job anywhere. We
-      # have pruned off 2^M permutations where M is the length of the remaining
-      # jobs.
-      _Permutations += 2L**len(remaining_jobs)
+      # have pruned off all permutations of the remaining jobs.
+      _Permutations += permutations(remaining_jobs)
 
     # If we've been at this for 3 seconds, print some status information
     if _PrintStats and time.time() > _CkpointTime:
@@ -172,11 +347,24 @@ def _tile_search1(Jobs, TSoFar, firstAddPoint, cfg=config.Config):
       # Check for timeout
       if (config.SearchTimeout > 0) and (time.time() - _StartTime > config.SearchTimeout):
         raise KeyboardInterrupt 
+
+      # Check for the end of a parallel search
+      if _Shared is not None and _Shared.stop.is_set():
+        raise KeyboardInterrupt
         
     gerbmerge.updateGUI("Performing automatic layout...")        
         
   # end for each job in job list
 
+  TSoFar.undo(mark)
+
+  if key is not None:
+    # If a best tiling was found since this search began, it was found here
+    completion = None
+    if _Found > found:
+      completion = (_TBestScore, tuple(_TBestTiling.points), _TBestTiling.jobs[len(TSoFar.jobs):])
+    _Table.put(key, (bestScore, completion))
+
 def factorial(N):
   if (N <= 1): return 1L
 
@@ -187,28 +375,329 @@ def factorial(N):
 
   return prod
 
+def permutations(Jobs):
+  """Return the number of different ways of ordering the jobs in Jobs, a list of
+  4-tuples (Xdim,Ydim,job,rjob), and of choosing the rotation of each job.
+  Copies of the same job are interchangeable, and square jobs are never rotated."""
+  copies = {}
+  rotations = 0
+  for Xdim,Ydim,job,rjob in Jobs:
+    copies[id(job)] = copies.get(id(job), 0) + 1
+    if Xdim != Ydim:
+      rotations += 1
+
+  N = factorial(len(Jobs))
+  for count in copies.values():
+    N /= factorial(count)
+  return N * 2L**rotations
+
 def initialize(printStats=1):
-  global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PossiblePermutations, _PrintStats
+  global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PossiblePermutations, _Pruned, _PrintStats
+  global _SharedScore
 
   _PrintStats = printStats
   _Placements = 0L
   _Permutations = 0L
+  _Pruned = 0L
+  _TBestTiling = None
+  _TBestScore = float(sys.maxint)
+  _SharedScore = float(sys.maxint)
+
+# With config.SearchWorkers > 1, the search tree is split at its first levels
+# into subtrees, each given by the placements that lead to it, and these are
+# searched by worker processes. The workers share the smallest area found so
+# far for pruning, and their counts of permutations, placements, pruned
+# tilings and transposition table hits and misses so that this process can
+# print the progress of the whole search. Each worker has its own transposition
+# table. Each subtree's best tiling is sent back to this process packed with
+# tiling.packTiling(). The subtrees are combined in order, so the result is
+# the same as that of a search in one process.
+
+# Subtrees are split off at this many levels, or fewer if there are few jobs
+SplitLevels = 2
+
+class _SharedState:
+  "State shared by the worker processes of a parallel search"
+  def __init__(self, workers, bestScore):
+    self.bestScore = multiprocessing.Value('d', bestScore)
+    self.counts = multiprocessing.Array('l', 5*workers, lock=False)  # Permutations, placements, pruned tilings, table hits and misses of each worker
+    self.nextSlot = multiprocessing.Value('i', 0)
+    self.next = multiprocessing.Value('i', 0)   # Index of the next subtree to search
+    self.stop = multiprocessing.Event()
+    self.slot = None    # Index into self.counts of this worker
+
+  def attach(self):
+    "Called once in each worker process to claim a slot in self.counts"
+    self.nextSlot.get_lock().acquire()
+    try:
+      self.slot = 5*self.nextSlot.value
+      self.nextSlot.value += 1
+    finally:
+      self.nextSlot.get_lock().release()
+
+  def nextSubtree(self):
+    "Return the index of the next subtree to search and move on to the one after"
+    self.next.get_lock().acquire()
+    try:
+      index = self.next.value
+      self.next.value += 1
+    finally:
+      self.next.get_lock().release()
+    return index
+
+  def improve(self, score):
+    "Record a tiling with area score found by this worker"
+    self.bestScore.get_lock().acquire()
+    try:
+      if score < self.bestScore.value:
+        self.bestScore.value = score
+    finally:
+      self.bestScore.get_lock().release()
+
+  def publish(self):
+    "Record the counts of this worker"
+    self.counts[self.slot:self.slot+5] = [_Permutations, _Placements, _Pruned, _TableHits, _TableMisses]
+
+  def totals(self):
+    "Return the total permutations, placements, pruned tilings, table hits and misses of all workers"
+    counts = self.counts[:]
+    return tuple([sum(counts[ix::5]) for ix in range(5)])
+
+def _splitSearch(Jobs, TSoFar, firstAddPoint, levels, path, subtrees, cfg=config.Config):
+  """Append to subtrees a (path, firstAddPoint) pair for each subtree of the
+  search of Jobs added to TSoFar, 'levels' levels down. Each path is a list of
+  (job_ix, rotated, ix) placements. The subtrees are visited in the same order
+  and counted in the same way as by _tile_search1(). TSoFar is left unchanged."""
+  global _Permutations
+
+  if not Jobs or not levels:
+    subtrees.append((path, firstAddPoint))
+    return
+
+  xspacing = cfg['xspacing']
+  yspacing = cfg['yspacing']
+
+  mark = TSoFar.checkpoint()
+  TSoFar.removeInlets(tiling.minDimension(Jobs))
+  placed = TSoFar.checkpoint()
+
+  tried = {}
+  for job_ix in range(len(Jobs)):
+    Xdim,Ydim,job,rjob = Jobs[job_ix]
+    if tried.has_key(id(job)):
+      continue
+    tried[id(job)] = None
+    remaining_jobs = Jobs[:job_ix]+Jobs[job_ix+1:]
+
+    for rotated in (0, 1):
+      if rotated:
+        if Xdim == Ydim:
+          break
+        X,Y = Ydim+xspacing, Xdim+yspacing
+      else:
+        X,Y = Xdim+xspacing, Ydim+yspacing
+
+      addpoints = TSoFar.validAddPoints(X,Y)
+      if not addpoints and firstAddPoint:
+        _Permutations += permutations(remaining_jobs)
+
+      for ix in addpoints:
+        TSoFar.addJob(ix, X, Y, rotated and rjob or job)
+        _splitSearch(remaining_jobs, TSoFar, firstAddPoint and ix==addpoints[0], levels-1, \
+                     path + [(job_ix, rotated, ix)], subtrees)
+        TSoFar.undo(placed)
+
+  TSoFar.undo(mark)
+
+def _searchWorker(shared, subtrees, Jobs, X, Y, results):
+  """Body of a worker process of a parallel search: search the subtrees not yet
+  taken by another worker until all are done or the search is stopped. Each
+  subtree's best tiling, packed with tiling.packTiling(), is sent back as
+  (index, tiling). (None, None) is sent last, or (None, traceback) if the
+  search failed."""
+  global _Shared, _SearchJobs, _SearchPanel, _CkpointTime
+
+  # Ctrl-C is handled by the main process, which then tells the workers to stop
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  gerbmerge.GUI = None
+
+  error = None
+  try:
+    try:
+      _Shared = shared
+      _Shared.attach()
+      _SearchJobs = Jobs
+      _SearchPanel = (X, Y)
+      initialize(1)
+      _CkpointTime = 0.0
+
+      while not shared.stop.is_set():
+        index = shared.nextSubtree()
+        if index >= len(subtrees):
+          break
+        results.put((index, _searchSubtree(subtrees[index])))
+    except:
+      error = traceback.format_exc()
+  finally:
+    # The main process waits for this, so it must be sent however the search ended
+    results.put((None, error))
+
+def _receive(results, procs, block):
+  """Return the next message sent by the worker processes procs on the queue
+  results, or None if there is none yet. If block is true, wait a while for
+  one. Raises RuntimeError if every worker has exited and nothing is left to
+  receive, as a worker that was killed never sends its last message."""
+  try:
+    if block:
+      return results.get(timeout=1)
+    return results.get_nowait()
+  except Queue.Empty:
+    for P in procs:
+      if P.is_alive():
+        return None
+
+  # A worker may have sent its last message just before exiting
+  try:
+    return results.get_nowait()
+  except Queue.Empty:
+    raise RuntimeError, "A search worker process exited without sending its results"
+
+def _searchSubtree(subtree):
+  """Search one subtree in a worker process and return its best tiling, or the
+  best tiling found before the search was stopped, packed with tiling.packTiling()"""
+  global _TBestTiling, _TBestScore, _SharedScore
+
+  path, firstAddPoint = subtree
+  Jobs = _SearchJobs
+  X, Y = _SearchPanel
+  T = tiling.Tiling(X, Y)
+  for job_ix, rotated, ix in path:
+    T.removeInlets(tiling.minDimension(Jobs))
+    Xdim,Ydim,job,rjob = Jobs[job_ix]
+    if rotated:
+      T.addJob(ix, Ydim+config.Config['xspacing'], Xdim+config.Config['yspacing'], rjob)
+    else:
+      T.addJob(ix, Xdim+config.Config['xspacing'], Ydim+config.Config['yspacing'], job)
+    Jobs = Jobs[:job_ix]+Jobs[job_ix+1:]
+
   _TBestTiling = None
   _TBestScore = float(sys.maxint)
+  _SharedScore = _Shared.bestScore.value
+  try:
+    _tile_search1(Jobs, T, firstAddPoint)
+  except KeyboardInterrupt:
+    pass
+  _Shared.publish()
+
+  return tiling.packTiling(_TBestTiling, _SearchJobs)
+
+def _parallel_tile_search1(Jobs, X, Y, workers):
+  """Search for the best tiling in worker processes, until done or stopped by
+  Ctrl-C or by the search timeout (both raise KeyboardInterrupt), and set
+  _TBestTiling to the best tiling found."""
+  global _CkpointTime, _TBestTiling, _TBestScore, _SharedScore, _UsedArea
+
+  _UsedArea = 0.0
+  for Xdim,Ydim,job,rjob in Jobs:
+    _UsedArea += job.jobarea()
+
+  subtrees = []
+  _splitSearch(Jobs, tiling.Tiling(X,Y), 1, min(SplitLevels, len(Jobs)-1), [], subtrees)
+  splitPermutations = _Permutations
+
+  shared = _SharedState(workers, _TBestScore)
+  results = multiprocessing.Queue()
+  procs = []
+  for worker in range(workers):
+    P = multiprocessing.Process(target=_searchWorker, args=(shared, subtrees, Jobs, X, Y, results))
+    P.daemon = True
+    P.start()
+    procs.append(P)
+
+  def update():
+    "Add up the progress of all workers"
+    global _Permutations, _Placements, _Pruned, _TableHits, _TableMisses, _SharedScore
+    perms, _Placements, _Pruned, _TableHits, _TableMisses = shared.totals()
+    _Permutations = splitPermutations + perms
+    _SharedScore = shared.bestScore.value
+
+  found = {}        # Best tiling of each subtree searched, by index
+  errors = []       # Tracebacks of failed workers
+  running = workers
+  try:
+    try:
+      while running and not errors:
+        # Sleep rather than wait on the queue, so that Ctrl-C is seen at once
+        time.sleep(0.05)
+        while running:
+          message = _receive(results, procs, 0)
+          if message is None:
+            break
+          index, data = message
+          if index is None:
+            running -= 1
+            if data is not None:
+              errors.append(data)
+          else:
+            found[index] = data
+
+        if time.time() > _CkpointTime:
+          update()
+          printTilingStats()
+
+          # Check for timeout
+          if (config.SearchTimeout > 0) and (time.time() - _StartTime > config.SearchTimeout):
+            raise KeyboardInterrupt 
+
+        gerbmerge.updateGUI("Performing automatic layout...")
+    finally:
+      # Tell the workers to stop and wait for the best tilings of the subtrees
+      # they were searching
+      shared.stop.set()
+      while running:
+        message = _receive(results, procs, 1)
+        if message is None:
+          continue
+        index, data = message
+        if index is None:
+          running -= 1
+          if data is not None:
+            errors.append(data)
+        else:
+          found[index] = data
+
+      for P in procs:
+        P.join()
+      update()
+
+      if errors:
+        raise RuntimeError, "A search worker process failed:\n%s" % errors[0]
+
+      # Combine the subtrees in the order in which they would have been searched
+      indices = found.keys()
+      indices.sort()
+      for index in indices:
+        T = tiling.unpackTiling(found[index], Jobs, X, Y)
+        if T:
+          score = T.area()
+          if score < _TBestScore or (score == _TBestScore and T.corners() < _TBestTiling.corners()):
+            _TBestTiling,_TBestScore = T,score
+  finally:
+    _SharedScore = float(sys.maxint)
 
 def tile_search1(Jobs, X, Y):
   """Wrapper around _tile_search1 to handle keyboard interrupt, etc."""
   global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore, _Permutations, _PossiblePermutations
 
   initialize()
+  resetTable()
 
   _StartTime = time.time()
   _CkpointTime = _StartTime + 3
-  # There are (2**N)*(N!) possible permutations where N is the number of jobs.
-  # This is assuming all jobs are unique and each job has a rotation (i.e., is not
-  # square). Practically, these assumptions make no difference because the software
-  # currently doesn't optimize for cases of repeated jobs.
-  _PossiblePermutations = (2L**len(Jobs))*factorial(len(Jobs))
+  # There are (2**N)*(N!) possible permutations where N is the number of jobs,
+  # if all jobs are different and none of them is square. Copies of the same
+  # job and rotations of square jobs are not tried, so there are fewer.
+  _PossiblePermutations = permutations(Jobs)
   #print "Possible permutations:", _PossiblePermutations
 
   print '='*70
@@ -227,8 +716,22 @@ def tile_search1(Jobs, X, Y):
   print "Press Ctrl-C to stop and use the best placement so far."
   print "Estimated maximum possible utilization is %.1f%%." % (tiling.maxUtilization(Jobs)*100)
 
+  # Only tilings better than the one found by the packing heuristics are kept,
+  # so partial placements that cannot beat it are pruned from the start
+  _TBestTiling, _TBestScore = tilesearch4.startingTiling(Jobs, X, Y)
+
+  # Worker processes rely on inheriting the jobs from this process, so the
+  # search always runs here on platforms without fork() (e.g., Windows).
+  parallel = config.SearchWorkers > 1 and len(Jobs) > 2 and multiprocessing is not None \
+             and hasattr(os, 'fork')
+  if parallel:
+    print "Searching with %d worker processes." % config.SearchWorkers
+
   try:
-    _tile_search1(Jobs, tiling.Tiling(X,Y), 1)
+    if parallel:
+      _parallel_tile_search1(Jobs, X, Y, config.SearchWorkers)
+    else:
+      _tile_search1(Jobs, tiling.Tiling(X,Y), 1)
     printTilingStats()
     print
   except KeyboardInterrupt:
@@ -238,6 +741,8 @@ def tile_search1(Jobs, X, Y):
 
   computeTime = time.time() - _StartTime
   print "Computed %ld placements in %d seconds / %.1f placements/second" % (_Placements, computeTime, _Placements/computeTime)
+  print "Pruned %ld partial placements that could not beat the best placement" % _Pruned
+  printTableStats()
   print '='*70
 
   return _TBestTiling
@@ -10,12 +10,20 @@ http://ruggedcircuits.com/gerbmerge
 """
 
 import sys
+import os
 import time
 import random
+import traceback
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None    # Python 2.5 and earlier: always search in one process
 
 import config
 import tiling
 import tilesearch1
+import tilesearch4
 
 import gerbmerge
 
@@ -25,16 +33,19 @@ _Placements = 0L           # Number of placements attempted
 _TBestTiling = None        # Best tiling so far
 _TBestScore  = float(sys.maxint) # Smallest area so far
 
-def printTilingStats():
+def printTilingStats(area=None, utilization=None):
+  """Print the progress of the search, with the area and utilization of the
+  best tiling so far if they are not given"""
   global _CkpointTime
   _CkpointTime = time.time() + 3
 
-  if _TBestTiling:
-    area = _TBestTiling.area()
-    utilization = _TBestTiling.usedArea() / area * 100.0
-  else:
-    area = 999999.0
-    utilization = 0.0
+  if area is None:
+    if _TBestTiling:
+      area = _TBestTiling.area()
+      utilization = _TBestTiling.usedArea() / area * 100.0
+    else:
+      area = 999999.0
+      utilization = 0.0
 
   print "\r  %ld placements / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" % \
         (_Placements, area, utilization),
@@ -42,6 +53,58 @@ def printTilingStats():
   if gerbmerge.GUI is not None:
     sys.stdout.flush()
 
+def _randomTiling(Jobs, X, Y, r, M, bestScore, cfg=config.Config):
+  """Return a random tiling of all jobs in Jobs on an X-by-Y panel, or None if
+  the jobs did not fit or the tiling could not have had an area below bestScore.
+  The first M jobs, in random order, are placed randomly and the others are
+  placed by exhaustive search."""
+  xspacing = cfg['xspacing']
+  yspacing = cfg['yspacing']
+
+  N = len(Jobs)
+  T = tiling.Tiling(X,Y)
+  joborder = [Jobs[ix] for ix in r.sample(range(N), N)]
+
+  minInletSize = tiling.minDimension(Jobs)
+
+  for count in range(M):
+    Xdim,Ydim,job,rjob = joborder[count]
+    
+    T.removeInlets(minInletSize)
+
+    if r.choice([0,1]):
+      addpoints = T.validAddPoints(Xdim+xspacing,Ydim+yspacing)
+      if not addpoints:
+        return None
+
+      pt = r.choice(addpoints)
+      T.addJob(pt, Xdim+xspacing, Ydim+yspacing, job)
+    else:
+      addpoints = T.validAddPoints(Ydim+xspacing,Xdim+yspacing)
+      if not addpoints:
+        return None
+
+      pt = r.choice(addpoints)
+      T.addJob(pt, Ydim+xspacing, Xdim+yspacing, rjob)
+
+    # Abandon this trial once it cannot beat the best tiling so far
+    if T.lowerBound(joborder[count+1:]) > bestScore*(1+tilesearch1._BoundSlack):
+      return None
+
+  # Do exhaustive search on remaining jobs
+  if N-M:
+    tilesearch1.initialize(0)
+    tilesearch1._tile_search1(joborder[M:], T, 1)
+    T = tilesearch1.bestTiling()
+
+  return T
+
+def _isBetter(T, score, BestTiling, BestScore):
+  "True if tiling T with area score is better than BestTiling with area BestScore"
+  if score < BestScore:
+    return 1
+  return score == BestScore and T.corners() < BestTiling.corners()
+
 def _tile_search2(Jobs, X, Y, cfg=config.Config):
   global _CkpointTime, _Placements, _TBestTiling, _TBestScore
 
@@ -53,54 +116,14 @@ def _tile_search2(Jobs, X, Y, cfg=config.Config):
   M = N - config.RandomSearchExhaustiveJobs
   M = max(M,0)
 
-  xspacing = cfg['xspacing']
-  yspacing = cfg['yspacing']
-  
   # Must escape with Ctrl-C
   while 1:
-    T = tiling.Tiling(X,Y)
-    joborder = r.sample(range(N), N)
-
-    minInletSize = tiling.minDimension(Jobs)
-
-    for ix in joborder[:M]:
-      Xdim,Ydim,job,rjob = Jobs[ix]
-      
-      T.removeInlets(minInletSize)
-
-      if r.choice([0,1]):
-        addpoints = T.validAddPoints(Xdim+xspacing,Ydim+yspacing)
-        if not addpoints:
-          break
-
-        pt = r.choice(addpoints)
-        T.addJob(pt, Xdim+xspacing, Ydim+yspacing, job)
-      else:
-        addpoints = T.validAddPoints(Ydim+xspacing,Xdim+yspacing)
-        if not addpoints:
-          break
-
-        pt = r.choice(addpoints)
-        T.addJob(pt, Ydim+xspacing, Xdim+yspacing, rjob)
-    else:
-      # Do exhaustive search on remaining jobs
-      if N-M:
-        remainingJobs = []
-        for ix in joborder[M:]:
-          remainingJobs.append(Jobs[ix])
+    T = _randomTiling(Jobs, X, Y, r, M, _TBestScore)
 
-        tilesearch1.initialize(0)
-        tilesearch1._tile_search1(remainingJobs, T, 1)
-        T = tilesearch1.bestTiling()
-
-      if T:
-        score = T.area()
-
-        if score < _TBestScore:
-          _TBestTiling,_TBestScore = T,score
-        elif score == _TBestScore:
-          if T.corners() < _TBestTiling.corners():
-            _TBestTiling,_TBestScore = T,score
+    if T:
+      score = T.area()
+      if _isBetter(T, score, _TBestTiling, _TBestScore):
+        _TBestTiling,_TBestScore = T,score
 
     _Placements += 1
       
@@ -116,6 +139,133 @@ def _tile_search2(Jobs, X, Y, cfg=config.Config):
   
   # end while 1
 
+# With config.SearchWorkers > 1, random trials are run by that many worker
+# processes, each with its own random number generator. The workers share the
+# smallest area found so far, so that each can abandon trials that cannot beat
+# the best tiling of any worker, and count their trials in a shared array. When
+# told to stop, each worker sends its best tiling back to this process, packed
+# with tiling.packTiling() since the job objects in the worker are copies of
+# those in this process. If a worker fails, it sends the traceback instead so
+# that the search fails rather than waits for it forever. Each worker has its own transposition table for the
+# exhaustive search of the last jobs, and counts its hits and misses in
+# another shared array.
+
+def _searchWorker(Jobs, X, Y, seed, worker, bestScore, placements, tableCounts, stop, results):
+  """Body of a worker process: run random trials until told to stop, then send
+  back (worker, best tiling, None), or (worker, best tiling, traceback) if the
+  trials failed"""
+  gerbmerge.GUI = None
+
+  BestTiling, BestScore = None, float(sys.maxint)
+  error = None
+  try:
+    try:
+      r = random.Random(seed)
+      M = max(len(Jobs) - config.RandomSearchExhaustiveJobs, 0)
+
+      while not stop.is_set():
+        T = _randomTiling(Jobs, X, Y, r, M, bestScore.value)
+
+        if T:
+          score = T.area()
+          if _isBetter(T, score, BestTiling, BestScore):
+            BestTiling, BestScore = T, score
+
+            bestScore.get_lock().acquire()
+            try:
+              if score < bestScore.value:
+                bestScore.value = score
+            finally:
+              bestScore.get_lock().release()
+
+        placements[worker] += 1
+        tableCounts[2*worker:2*worker+2] = [tilesearch1._TableHits, tilesearch1._TableMisses]
+    except KeyboardInterrupt:
+      pass
+    except:
+      error = traceback.format_exc()
+  finally:
+    # The main process waits for this, so it must be sent however the trials ended
+    results.put((worker, tiling.packTiling(BestTiling, Jobs), error))
+
+def _parallel_tile_search2(Jobs, X, Y, workers):
+  """Run random trials in the given number of worker processes until stopped by
+  Ctrl-C or by the search timeout (both raise KeyboardInterrupt), and set
+  _TBestTiling to the best tiling found by any of them."""
+  global _CkpointTime, _Placements, _TBestTiling, _TBestScore
+
+  bestScore = multiprocessing.Value('d', _TBestScore)
+  placements = multiprocessing.Array('l', workers, lock=False)
+  tableCounts = multiprocessing.Array('l', 2*workers, lock=False)   # Table hits and misses of each worker
+  stop = multiprocessing.Event()
+  results = multiprocessing.Queue()
+
+  seed = random.getrandbits(32)
+  procs = []
+  for worker in range(workers):
+    P = multiprocessing.Process(target=_searchWorker, \
+                                args=(Jobs, X, Y, seed+worker, worker, bestScore, placements, tableCounts, stop, results))
+    P.daemon = True
+    P.start()
+    procs.append(P)
+
+  usedArea = 0.0
+  for Xdim,Ydim,job,rjob in Jobs:
+    usedArea += job.jobarea()
+
+  found = []        # (best tiling, traceback) of each worker that has stopped
+  try:
+    # A worker only sends its results when told to stop, so anything received
+    # before then is from a worker that failed
+    while not found:
+      time.sleep(0.1)
+      _Placements = sum(placements)
+
+      # Print the best area so far. The best tiling itself stays in its worker
+      # until the search ends.
+      if time.time() > _CkpointTime:
+        area = bestScore.value
+        if area < float(sys.maxint):
+          printTilingStats(area, usedArea / area * 100.0)
+        else:
+          printTilingStats(999999.0, 0.0)
+
+        # Check for timeout
+        if (config.SearchTimeout > 0) and ((time.time() - _StartTime) > config.SearchTimeout):
+          raise KeyboardInterrupt 
+
+      gerbmerge.updateGUI("Performing automatic layout...")
+
+      message = tilesearch1._receive(results, procs, 0)
+      if message is not None:
+        found.append(message[1:])
+  finally:
+    # Collect the best tiling of each worker, whether stopped by timeout or Ctrl-C
+    stop.set()
+    while len(found) < workers:
+      message = tilesearch1._receive(results, procs, 1)
+      if message is not None:
+        found.append(message[1:])
+
+    errors = []
+    for data, error in found:
+      if error is not None:
+        errors.append(error)
+      T = tiling.unpackTiling(data, Jobs, X, Y)
+      if T:
+        score = T.area()
+        if _isBetter(T, score, _TBestTiling, _TBestScore):
+          _TBestTiling,_TBestScore = T,score
+
+    for P in procs:
+      P.join()
+    _Placements = sum(placements)
+    tilesearch1._TableHits = sum(tableCounts[0::2])
+    tilesearch1._TableMisses = sum(tableCounts[1::2])
+
+    if errors:
+      raise RuntimeError, "A search worker process failed:\n%s" % errors[0]
+
 def tile_search2(Jobs, X, Y):
   """Wrapper around _tile_search2 to handle keyboard interrupt, etc."""
   global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore
@@ -125,14 +275,28 @@ def tile_search2(Jobs, X, Y):
   _Placements = 0L
   _TBestTiling = None
   _TBestScore = float(sys.maxint)
+  tilesearch1.resetTable()
 
   print '='*70
   print "Starting random placement trials. You must press Ctrl-C to"
   print "stop the process and use the best placement so far."
   print "Estimated maximum possible utilization is %.1f%%." % (tiling.maxUtilization(Jobs)*100)
 
+  # Only tilings better than the one found by the packing heuristics are kept,
+  # so trials that cannot beat it are abandoned from the start
+  _TBestTiling, _TBestScore = tilesearch4.startingTiling(Jobs, X, Y)
+
+  # Worker processes rely on inheriting the jobs from this process, so the
+  # search always runs here on platforms without fork() (e.g., Windows).
+  parallel = config.SearchWorkers > 1 and multiprocessing is not None and hasattr(os, 'fork')
+  if parallel:
+    print "Searching with %d worker processes." % config.SearchWorkers
+
   try:
-    _tile_search2(Jobs, X, Y)
+    if parallel:
+      _parallel_tile_search2(Jobs, X, Y, config.SearchWorkers)
+    else:
+      _tile_search2(Jobs, X, Y)
     printTilingStats()
     print
   except KeyboardInterrupt:
@@ -142,6 +306,8 @@ def tile_search2(Jobs, X, Y):
 
   computeTime = time.time() - _StartTime
   print "Computed %ld placements in %d seconds / %.1f placements/second" % (_Placements, computeTime, _Placements/computeTime)
+  if config.RandomSearchExhaustiveJobs >= tilesearch1.TableJobs:
+    tilesearch1.printTableStats()
   print '='*70
 
   return _TBestTiling
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Tile search using simulated annealing. A tiling is described by the order
+in which jobs are placed and by the rotation of each job. Starting from the
+jobs in the given order, small changes are made to this description (two jobs
+swapped, a job moved or a job rotated) and the resulting tiling is kept if it
+is smaller or, with a probability that falls as the search goes on, even if
+it is larger, so that the search can leave a poor arrangement behind.
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import sys
+import time
+import math
+import random
+
+import config
+import tiling
+import tilesearch4
+
+import gerbmerge
+
+_StartTime = 0.0           # Start time of tiling
+_CkpointTime = 0.0         # Next time to print stats
+_Placements = 0L           # Number of placements attempted
+_TBestTiling = None        # Best tiling so far
+_TBestScore  = float(sys.maxint) # Smallest area so far
+
+# The temperature starts at this fraction of the area of the best tiling so
+# far, and is multiplied by Cooling after every change. When it drops below
+# MinTemperature (again as a fraction of the best area) the search starts
+# again from the best tiling so far.
+InitialTemperature = 0.03
+Cooling = 0.998
+MinTemperature = 0.0005
+
+# A job that does not fit on the panel adds this many times its area (with
+# spacing) to the score of a tiling, so that the search is led towards
+# tilings in which all jobs fit.
+UnplacedPenalty = 4.0
+
+def printTilingStats():
+  global _CkpointTime
+  _CkpointTime = time.time() + 3
+
+  if _TBestTiling:
+    area = _TBestTiling.area()
+    utilization = _TBestTiling.usedArea() / area * 100.0
+  else:
+    area = 999999.0
+    utilization = 0.0
+
+  print "\r  %ld placements / Smallest area: %.1f sq. in. / Best utilization: %.1f%%" % \
+        (_Placements, area, utilization),
+
+  if gerbmerge.GUI is not None:
+    sys.stdout.flush()
+
+def placeJobs(Jobs, order, rotations, X, Y, cfg=config.Config):
+  """Place the jobs in Jobs, a list of 4-tuples (Xdim,Ydim,job,rjob), on an X-by-Y
+  panel one at a time in the given order (a list of indices into Jobs). Job
+  Jobs[ix] is placed rotated if rotations[ix] is true. Each job is placed at
+  the add-point that keeps the tiling smallest. If it does not fit in the given
+  orientation, the other one is tried.
+
+  Returns a 2-tuple (T, unplaced) where T is the tiling and unplaced is the
+  total area (with spacing) of jobs that did not fit anywhere."""
+  xspacing = cfg['xspacing']
+  yspacing = cfg['yspacing']
+
+  # Smallest dimension of the jobs still to be placed, for removing inlets
+  minInletSizes = [float(sys.maxint)]*(len(order)+1)
+  for count in range(len(order)-1, -1, -1):
+    Xdim,Ydim,job,rjob = Jobs[order[count]]
+    minInletSizes[count] = min(minInletSizes[count+1], Xdim, Ydim)
+
+  T = tiling.Tiling(X,Y)
+  unplaced = 0.0
+  for count in range(len(order)):
+    Xdim,Ydim,job,rjob = Jobs[order[count]]
+    T.removeInlets(minInletSizes[count])
+
+    choices = [(Xdim+xspacing, Ydim+yspacing, job), (Ydim+xspacing, Xdim+yspacing, rjob)]
+    if Xdim == Ydim:
+      del choices[1]
+    elif rotations[order[count]]:
+      choices.reverse()
+
+    for W,H,J in choices:
+      # Try each add-point and undo the placement again, keeping the best
+      best = None
+      mark = T.checkpoint()
+      for ix in T.validAddPoints(W,H):
+        T.addJob(ix, W, H, J)
+        score = T.area()
+        T.undo(mark)
+        if best is None or score < best[0]:
+          best = (score, ix)
+
+      if best is not None:
+        T.addJob(best[1], W, H, J)
+        break
+    else:
+      unplaced += choices[0][0]*choices[0][1]
+
+  T.log = None    # Changes need not be recorded any more
+  return T, unplaced
+
+def _change(order, rotations, r):
+  "Return a new (order, rotations) pair with one random change"
+  order = order[:]
+  rotations = rotations[:]
+  N = len(order)
+
+  move = r.randrange(3)
+  if move==0 and N > 1:
+    # Swap two jobs
+    i, j = r.sample(range(N), 2)
+    order[i], order[j] = order[j], order[i]
+  elif move==1 and N > 1:
+    # Move a job to another place in the order
+    i, j = r.sample(range(N), 2)
+    order.insert(j, order.pop(i))
+  else:
+    # Rotate a job
+    ix = r.randrange(N)
+    rotations[ix] = not rotations[ix]
+
+  return order, rotations
+
+def _score(T, unplaced):
+  "Score of a tiling from placeJobs(): its area, plus a penalty for jobs that did not fit"
+  if T.jobs:
+    return T.area() + UnplacedPenalty*unplaced
+  return float(sys.maxint)
+
+def _keep(T, unplaced):
+  "Make T the best tiling so far if all jobs were placed and it is the smallest"
+  global _TBestTiling, _TBestScore
+
+  if not unplaced:
+    area = T.area()
+    if area < _TBestScore:
+      _TBestTiling,_TBestScore = T,area
+    elif area == _TBestScore:
+      if T.corners() < _TBestTiling.corners():
+        _TBestTiling,_TBestScore = T,area
+
+def _tile_search3(Jobs, X, Y):
+  global _CkpointTime, _Placements
+
+  r = random.Random()
+  N = len(Jobs)
+
+  order = range(N)
+  rotations = [0]*N
+  T, unplaced = placeJobs(Jobs, order, rotations, X, Y)
+  _keep(T, unplaced)
+  score = _score(T, unplaced)
+  best = (order, rotations, score)
+  temperature = InitialTemperature*score
+
+  # Must escape with Ctrl-C
+  while 1:
+    newOrder, newRotations = _change(order, rotations, r)
+    T, unplaced = placeJobs(Jobs, newOrder, newRotations, X, Y)
+    newScore = _score(T, unplaced)
+    _Placements += 1
+
+    # Keep the best complete tiling even if the move to it is not accepted
+    # below: the penalty for unplaced jobs can give the current tiling a
+    # lower score than a complete one
+    _keep(T, unplaced)
+
+    # Always accept a better tiling, and a worse one with a probability that
+    # falls as the temperature drops
+    if newScore <= score or r.random() < math.exp((score-newScore)/temperature):
+      order, rotations, score = newOrder, newRotations, newScore
+
+      if score < best[2]:
+        best = (order, rotations, score)
+
+    # Once cooled, start again from the best tiling so far
+    temperature *= Cooling
+    if temperature < MinTemperature*best[2]:
+      order, rotations, score = best
+      temperature = InitialTemperature*score
+
+    # If we've been at this for 3 seconds, print some status information
+    if time.time() > _CkpointTime:
+      printTilingStats()
+
+      # Check for timeout
+      if (config.SearchTimeout > 0) and ((time.time() - _StartTime) > config.SearchTimeout):
+        raise KeyboardInterrupt
+
+    gerbmerge.updateGUI("Performing automatic layout...")
+
+  # end while 1
+
+def tile_search3(Jobs, X, Y):
+  """Wrapper around _tile_search3 to handle keyboard interrupt, etc."""
+  global _StartTime, _CkpointTime, _Placements, _TBestTiling, _TBestScore
+
+  _StartTime = time.time()
+  _CkpointTime = _StartTime + 3
+  _Placements = 0L
+  _TBestTiling = None
+  _TBestScore = float(sys.maxint)
+
+  print '='*70
+  print "Starting placement using simulated annealing. You must press Ctrl-C"
+  print "to stop the process and use the best placement so far."
+  print "Estimated maximum possible utilization is %.1f%%." % (tiling.maxUtilization(Jobs)*100)
+
+  _TBestTiling, _TBestScore = tilesearch4.startingTiling(Jobs, X, Y)
+
+  try:
+    _tile_search3(Jobs, X, Y)
+    printTilingStats()
+    print
+  except KeyboardInterrupt:
+    printTilingStats()
+    print
+    print "Interrupted."
+
+  computeTime = time.time() - _StartTime
+  print "Computed %ld placements in %d seconds / %.1f placements/second" % (_Placements, computeTime, _Placements/computeTime)
+  print '='*70
+
+  return _TBestTiling
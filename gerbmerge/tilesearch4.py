@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""Tile search using constructive packing heuristics. Each heuristic places
+the jobs one at a time by a fixed rule and never goes back, so a placement is
+found in a fraction of a second. The heuristics are:
+
+  - Shelf packing (first fit decreasing height): jobs are laid flat and put
+    in rows ("shelves"), tallest first, each in the first row it fits in.
+
+  - Skyline packing (bottom-left): the top edge of the jobs placed so far is
+    kept as a skyline and each job, largest first, goes where its top edge
+    is lowest, leftmost if there is a tie.
+
+  - MaxRects packing (best short side fit): the free space is kept as a list
+    of (possibly overlapping) maximal free rectangles and each job, largest
+    first, goes into the free rectangle that it fills most closely.
+
+Each heuristic is run for a range of panel widths (and heights, for MaxRects)
+and the smallest tiling found is used. The result can be used as the
+placement itself (--heuristic-search) or as a starting point for the other
+searches, which then only look for tilings that improve on it.
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import sys
+import time
+import math
+
+import config
+import tiling
+
+# Number of different widths (and heights) to try between the smallest
+# sensible size and the panel size
+Sizes = 8
+
+def _cells(Jobs, cfg=config.Config):
+  """Return a list of (W, H, job, rjob) cells for Jobs, a list of 4-tuples
+  (Xdim,Ydim,job,rjob), i.e., the dimensions of each job with spacing added"""
+  xspacing = cfg['xspacing']
+  yspacing = cfg['yspacing']
+  return [(Xdim+xspacing, Ydim+yspacing, job, rjob) for Xdim,Ydim,job,rjob in Jobs]
+
+def _orient(cell, rotated, cfg=config.Config):
+  """Return (W, H, job) for a cell placed with or without rotation. Rotating a
+  job swaps its dimensions, but the spacing is still added in X and Y."""
+  W, H, job, rjob = cell
+  if not rotated:
+    return W, H, job
+  xspacing = cfg['xspacing']
+  yspacing = cfg['yspacing']
+  return H-yspacing+xspacing, W-xspacing+yspacing, rjob
+
+def shelfPack(cells, PW, PH):
+  """Pack cells on shelves in a PW-by-PH area. Return a list of
+  ((Xbl,Ybl),(Xtr,Ytr),Job) placements, or None if the cells do not fit."""
+  items = []
+  for cell in cells:
+    # Lay each job flat unless it is then too wide
+    W, H, job = _orient(cell, 0)
+    if H > W:
+      RW, RH, rjob = _orient(cell, 1)
+      if RW <= PW:
+        W, H, job = RW, RH, rjob
+    items.append((H, W, job))
+  items.sort(lambda a,b: cmp(b[0], a[0]) or cmp(b[1], a[1]))
+
+  placed = []
+  shelves = []      # List of [Ybl, height, width used]
+  top = 0.0
+  for H, W, job in items:
+    if W > PW:
+      return None
+    for shelf in shelves:
+      if shelf[2] + W <= PW:
+        break
+    else:
+      if top + H > PH:
+        return None
+      shelf = [top, H, 0.0]
+      shelves.append(shelf)
+      top += H
+
+    x, y = shelf[2], shelf[0]
+    placed.append(((x,y), (x+W,y+H), job))
+    shelf[2] += W
+
+  return placed
+
+def skylinePack(cells, PW, PH):
+  """Pack cells bottom-left against a skyline in a PW-by-PH area. Return a list
+  of ((Xbl,Ybl),(Xtr,Ytr),Job) placements, or None if the cells do not fit."""
+  items = cells[:]
+  items.sort(lambda a,b: cmp(max(b[0],b[1]), max(a[0],a[1])) or cmp(b[0]*b[1], a[0]*a[1]))
+
+  placed = []
+  skyline = [(0.0, 0.0, PW)]     # List of (X, Y, width) segments from left to right
+  for cell in items:
+    best = None
+    for rotated in (0, 1):
+      if rotated and cell[0]-config.Config['xspacing'] == cell[1]-config.Config['yspacing']:
+        break       # Square job
+      W, H, job = _orient(cell, rotated)
+
+      for ix in range(len(skyline)):
+        x = skyline[ix][0]
+        if x + W > PW:
+          break
+
+        # The job rests on the highest segment below it
+        y = 0.0
+        right = x + W
+        jx = ix
+        while jx < len(skyline) and skyline[jx][0] < right:
+          y = max(y, skyline[jx][1])
+          jx += 1
+
+        if y + H <= PH and (best is None or (y+H, x) < best[:2]):
+          best = (y+H, x, y, W, H, job)
+
+    if best is None:
+      return None
+
+    top, x, y, W, H, job = best
+    placed.append(((x,y), (x+W,top), job))
+
+    # Replace the skyline under the job by its top edge
+    right = x + W
+    newSkyline = []
+    for sx, sy, sw in skyline:
+      if sx + sw <= x or sx >= right:
+        newSkyline.append((sx, sy, sw))
+        continue
+      if sx < x:
+        newSkyline.append((sx, sy, x-sx))
+      if sx + sw > right:
+        newSkyline.append((right, sy, sx+sw-right))
+    newSkyline.append((x, top, W))
+    newSkyline.sort()
+
+    # Merge neighbouring segments at the same height
+    skyline = [newSkyline[0]]
+    for sx, sy, sw in newSkyline[1:]:
+      px, py, pw = skyline[-1]
+      if py == sy:
+        skyline[-1] = (px, py, pw+sw)
+      else:
+        skyline.append((sx, sy, sw))
+
+  return placed
+
+def maxRectsPack(cells, PW, PH):
+  """Pack cells in a PW-by-PH area using maximal free rectangles and the best
+  short side fit rule. Return a list of ((Xbl,Ybl),(Xtr,Ytr),Job) placements,
+  or None if the cells do not fit."""
+  items = cells[:]
+  items.sort(lambda a,b: cmp(b[0]*b[1], a[0]*a[1]))
+
+  placed = []
+  free = [(0.0, 0.0, PW, PH)]     # List of (Xbl, Ybl, Xtr, Ytr) free rectangles
+  for cell in items:
+    best = None
+    for rotated in (0, 1):
+      if rotated and cell[0]-config.Config['xspacing'] == cell[1]-config.Config['yspacing']:
+        break       # Square job
+      W, H, job = _orient(cell, rotated)
+
+      for fx0, fy0, fx1, fy1 in free:
+        dx = fx1 - fx0 - W
+        dy = fy1 - fy0 - H
+        if dx >= 0 and dy >= 0:
+          score = (min(dx,dy), max(dx,dy), fy0, fx0)
+          if best is None or score < best[0]:
+            best = (score, fx0, fy0, W, H, job)
+
+    if best is None:
+      return None
+
+    score, x0, y0, W, H, job = best
+    x1 = x0 + W
+    y1 = y0 + H
+    placed.append(((x0,y0), (x1,y1), job))
+
+    # Split every free rectangle that overlaps the job into the (up to 4)
+    # maximal rectangles around the job
+    kept = []
+    split = []
+    for fx0, fy0, fx1, fy1 in free:
+      if fx0 >= x1 or fx1 <= x0 or fy0 >= y1 or fy1 <= y0:
+        kept.append((fx0, fy0, fx1, fy1))
+        continue
+      if fx0 < x0:
+        split.append((fx0, fy0, x0, fy1))
+      if fx1 > x1:
+        split.append((x1, fy0, fx1, fy1))
+      if fy0 < y0:
+        split.append((fx0, fy0, fx1, y0))
+      if fy1 > y1:
+        split.append((fx0, y1, fx1, fy1))
+
+    # Remove new free rectangles contained in others. The rectangles that
+    # were not split are still maximal, as new ones lie inside old ones.
+    free = kept
+    for ix in range(len(split)):
+      r = split[ix]
+      for s in kept:
+        if s[0] <= r[0] and s[1] <= r[1] and s[2] >= r[2] and s[3] >= r[3]:
+          break
+      else:
+        for jx in range(len(split)):
+          s = split[jx]
+          if jx != ix and s[0] <= r[0] and s[1] <= r[1] and s[2] >= r[2] and s[3] >= r[3] \
+             and (s != r or jx < ix):
+            break
+        else:
+          free.append(r)
+
+  return placed
+
+def makeTiling(placed, X, Y):
+  """Return a tiling of an X-by-Y panel with the given list of ((Xbl,Ybl),(Xtr,Ytr),Job)
+  placements. The outline of the tiling is a staircase that encloses all jobs."""
+  T = tiling.Tiling(X, Y)
+  for job in placed:
+    T.appendJob(job)
+
+  # Height of the staircase to the left of each right edge of a job
+  edges = {}
+  for bl,tr,job in placed:
+    edges[tr[0]] = max(edges.get(tr[0], 0.0), tr[1])
+  rights = edges.keys()
+  rights.sort()
+  rights.reverse()
+
+  steps = []        # List of (X, height) from right to left
+  height = 0.0
+  for x in rights:
+    if edges[x] > height:
+      height = edges[x]
+      steps.append((x, height))
+  steps.reverse()
+
+  points = [(0,Y)]
+  left = 0
+  for x, height in steps:
+    points.append((left, height))
+    points.append((x, height))
+    left = x
+  points.append((left, 0))
+  points.append((X, 0))
+
+  # Remove repeated points where the staircase meets the panel edges
+  T.points = [points[0]]
+  for p in points[1:]:
+    if p != T.points[-1]:
+      T.points.append(p)
+  return T
+
+Packers = (('Shelf', shelfPack), ('Skyline', skylinePack), ('MaxRects', maxRectsPack))
+
+def packings(Jobs, X, Y, cfg=config.Config):
+  """Return a list of (name, tiling) pairs with the smallest tiling of Jobs,
+  a list of 4-tuples (Xdim,Ydim,job,rjob), on an X-by-Y panel found by each
+  heuristic. The tiling is None if a heuristic could not fit all jobs."""
+  cells = _cells(Jobs)
+  if not cells:
+    return []
+
+  # Sizes are those of the area taken by cells, i.e., the panel plus spacing
+  PW = X + cfg['xspacing']
+  PH = Y + cfg['yspacing']
+
+  cellArea = 0.0
+  minSide = 0.0
+  for W,H,job,rjob in cells:
+    cellArea += W*H
+    minSide = max(minSide, min(W,H))
+
+  # Try widths from that of a square holding all cells up to the panel width
+  smallest = min(max(math.sqrt(cellArea), minSide), PW)
+  widths = [smallest + (PW-smallest)*count/Sizes for count in range(Sizes+1)]
+
+  results = []
+  for name, packer in Packers:
+    best = None
+    for width in widths:
+      if packer is maxRectsPack:
+        # Free rectangles are used anywhere in the area given, so the height
+        # must also be limited to get a small tiling
+        smallestH = min(cellArea/width, PH)
+        heights = [smallestH + (PH-smallestH)*count/Sizes for count in range(Sizes+1)]
+      else:
+        heights = [PH]
+
+      for height in heights:
+        placed = packer(cells, width, height)
+        if placed:
+          T = makeTiling(placed, X, Y)
+          area = T.area()
+          if best is None or area < best[0]:
+            best = (area, T)
+          if packer is maxRectsPack:
+            break     # Use the lowest height that all cells fit in
+
+    if best:
+      results.append((name, best[1]))
+    else:
+      results.append((name, None))
+
+  return results
+
+def bestTiling(Jobs, X, Y):
+  "Return the smallest tiling of Jobs on an X-by-Y panel found by any heuristic, or None"
+  best = None
+  for name, T in packings(Jobs, X, Y):
+    if T and (best is None or T.area() < best.area()):
+      best = T
+  return best
+
+def startingTiling(Jobs, X, Y):
+  """Return a 2-tuple (T, score) with the best heuristic tiling and its area, for
+  other searches to start from, or (None, sys.maxint) if the jobs do not fit"""
+  T = bestTiling(Jobs, X, Y)
+  if T is None:
+    return None, float(sys.maxint)
+
+  area = T.area()
+  print "Packing heuristics found a placement of %.1f sq. in. / Utilization: %.1f%%" % \
+        (area, T.usedArea()/area*100.0)
+  return T, area
+
+def tile_search4(Jobs, X, Y):
+  """Find a tiling using each packing heuristic and return the smallest"""
+  print '='*70
+  print "Starting placement using packing heuristics."
+  print "Estimated maximum possible utilization is %.1f%%." % (tiling.maxUtilization(Jobs)*100)
+
+  startTime = time.time()
+  best = None
+  for name, T in packings(Jobs, X, Y):
+    if T:
+      area = T.area()
+      print "  %-8s: Area: %.1f sq. in. / Utilization: %.1f%%" % (name, area, T.usedArea()/area*100.0)
+      if best is None or area < best.area():
+        best = T
+    else:
+      print "  %-8s: Jobs do not fit on panel" % name
+
+  print "Computed placements in %.3f seconds" % (time.time() - startTime)
+  print '='*70
+
+  return best
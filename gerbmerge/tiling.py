@@ -40,6 +40,15 @@ def below(p1,p2):
   return p1[1]<p2[1] and p1[0]==p2[0]
 
 class Tiling:
+  # The panel is divided into a grid of cells about CellSize inches square and
+  # each cell keeps a tuple of the jobs that touch it, so that overlap tests
+  # need only look at jobs near the new one. Tuples are never modified, only
+  # replaced, so a clone can share them with the original. With only a few
+  # jobs placed it is quicker to test them all, so the grid is only built
+  # once there are GridJobs jobs.
+  CellSize = 2.0
+  GridJobs = 24
+
   def __init__(self, Xmax, Ymax):
     # Make maximum dimensions bigger by inter-job spacing so that
     # we allow jobs (which are seated at the lower left of their cells)
@@ -54,6 +63,24 @@ class Tiling:
                      # The actual job has dimensions (Xtr-Xbl-Config['xspacing'],Ytr-Ybl-Config['yspacing'])
                      # and is located at the lower-left of the cell.
 
+    self.cols = max(1, int(self.xmax/self.CellSize))
+    self.rows = max(1, int(self.ymax/self.CellSize))
+    self.cellw = self.xmax/self.cols
+    self.cellh = self.ymax/self.rows
+    self.grid = None   # Jobs touching each cell, row by row, or None if not built yet
+
+    self.extents = []  # One 6-tuple (minX, minY, maxX, maxY, cellArea, usedArea) for
+                       # each job in self.jobs: the bounds of the cells of that
+                       # job and all before it, the total area of those cells
+                       # and the total area of just the jobs. The last entry
+                       # describes the whole tiling, so area() need not look
+                       # at every job.
+
+    self.log = None  # Journal of changes for undo(), once checkpoint() is called.
+                     # Entries are (start, stop, oldPoints), meaning
+                     # self.points[start:stop] replaced oldPoints, or None
+                     # for a job appended to self.jobs.
+
   def canonicalize(self, OriginX, OriginY):
     """Return a list of JobLayout objects, after setting each job's (X,Y) origin"""
     L = []
@@ -71,8 +98,45 @@ class Tiling:
     T = Tiling(self.xmax-config.Config['xspacing'], self.ymax-config.Config['yspacing'])
     T.points = self.points[:]
     T.jobs = self.jobs[:]
+    T.extents = self.extents[:]
+    if self.grid is not None:
+      T.grid = self.grid[:]
     return T
 
+  def checkpoint(self):
+    """Start recording changes to the tiling, if not already doing so, and
+    return a mark that can be passed to undo() to return to the current state."""
+    if self.log is None:
+      self.log = []
+    return len(self.log)
+
+  def undo(self, mark):
+    "Undo all changes made since checkpoint() returned mark, most recent first"
+    log = self.log
+    points = self.points
+    while len(log) > mark:
+      entry = log.pop()
+      if entry is not None:
+        start,stop,old = entry
+        points[start:stop] = old
+      else:
+        job = self.jobs.pop()
+        self.extents.pop()
+        if self.grid is not None:
+          if len(self.jobs) < self.GridJobs:
+            self.grid = None
+          else:
+            # The job is the most recent addition to each of its cells
+            grid = self.grid
+            for cell in self.cells(job[0], job[1]):
+              grid[cell] = grid[cell][:-1]
+
+  def replacePoints(self, start, end, new):
+    "Replace self.points[start:end] with the list of points new, recording the change for undo()"
+    if self.log is not None:
+      self.log.append((start, start+len(new), self.points[start:end]))
+    self.points[start:end] = new
+
   def dump(self, fid=sys.stdout):
     fid.write("Points:\n  ")
     count = 0
@@ -131,14 +195,72 @@ class Tiling:
       if p_bl[0]<0 or p_tr[1]>self.ymax:
         return 1
 
-    for t_bl,t_tr,Job in self.jobs:
-      if p_bl[0]<t_tr[0] and p_tr[0]>t_bl[0] \
-                         and                 \
-         p_bl[1]<t_tr[1] and p_tr[1]>t_bl[1]:
-        return 1         
+    grid = self.grid
+    if grid is None:
+      for t_bl,t_tr,Job in self.jobs:
+        if p_bl[0]<t_tr[0] and p_tr[0]>t_bl[0] \
+                           and                 \
+           p_bl[1]<t_tr[1] and p_tr[1]>t_bl[1]:
+          return 1         
+      return 0
+
+    # Any point that is inside both the new job and an existing one is in a
+    # grid cell that both touch, so only the jobs in the cells touched by
+    # the new job need to be tested.
+    G = self.cols
+    x0 = int(p_bl[0]/self.cellw)
+    x1 = int(p_tr[0]/self.cellw)
+    if x1 >= G: x1 = G-1
+    y0 = int(p_bl[1]/self.cellh)
+    y1 = int(p_tr[1]/self.cellh)
+    if y1 >= self.rows: y1 = self.rows-1
+    for row in range(y0*G, y1*G+1, G):
+      for cell in range(row+x0, row+x1+1):
+        for t_bl,t_tr,Job in grid[cell]:
+          if p_bl[0]<t_tr[0] and p_tr[0]>t_bl[0] \
+                             and                 \
+             p_bl[1]<t_tr[1] and p_tr[1]>t_bl[1]:
+            return 1         
 
     return 0
 
+  def cells(self, bl, tr):
+    "Return the indices into self.grid of all cells touched by the rectangle from bl to tr"
+    G = self.cols
+    x0 = min(int(bl[0]/self.cellw), G-1)
+    x1 = min(int(tr[0]/self.cellw), G-1)
+    y0 = min(int(bl[1]/self.cellh), self.rows-1)
+    y1 = min(int(tr[1]/self.cellh), self.rows-1)
+    return [row+col for row in range(y0*G, y1*G+1, G) for col in range(x0, x1+1)]
+
+  def appendJob(self, job, cfg=config.Config):
+    """Append job, a ((Xbl,Ybl),(Xtr,Ytr),Job) tuple, to self.jobs and to all grid
+    cells it touches, recording the change for undo(). The grid is built when
+    the number of jobs reaches GridJobs."""
+    bl,tr = job[0],job[1]
+    W = tr[0]-bl[0]
+    H = tr[1]-bl[1]
+    if self.extents:
+      minX,minY,maxX,maxY,cellArea,usedArea = self.extents[-1]
+      self.extents.append((min(minX,bl[0]), min(minY,bl[1]), max(maxX,tr[0]), max(maxY,tr[1]), \
+                           cellArea + W*H, usedArea + (W-cfg['xspacing'])*(H-cfg['yspacing'])))
+    else:
+      self.extents.append((bl[0], bl[1], tr[0], tr[1], W*H, (W-cfg['xspacing'])*(H-cfg['yspacing'])))
+
+    self.jobs.append(job)
+    if self.log is not None:
+      self.log.append(None)
+
+    if self.grid is not None:
+      grid = self.grid
+      for cell in self.cells(job[0], job[1]):
+        grid[cell] = grid[cell] + (job,)
+    elif len(self.jobs) >= self.GridJobs:
+      grid = self.grid = [()]*(self.cols*self.rows)
+      for job in self.jobs:
+        for cell in self.cells(job[0], job[1]):
+          grid[cell] = grid[cell] + (job,)
+
   def isL(self, ix):
     """True if self.points[ix] represents an L-shaped corner where there
        is free space above and to the right, like this:
@@ -204,10 +326,10 @@ mirrored-L corner __  |      |
 
     # Do farther-on points first so we can delete things right from the list
     if self.points[ix+3]==self.points[ix+4]:
-      del self.points[ix+3:ix+5]
+      self.replacePoints(ix+3, ix+5, [])
 
     if self.points[ix]==self.points[ix+1]:
-      del self.points[ix:ix+2]
+      self.replacePoints(ix, ix+2, [])
 
   # Experimental
   def removeInlets(self, minSize):
@@ -239,19 +361,20 @@ mirrored-L corner __  |      |
        can be deleted to form corners where new jobs can be placed.
     """
     pt = self.points
-    done = 0
-
-    while not done:
-      # Repeat this loop each time there is a change
-      for ix in range(0, len(pt)-3):
 
+    # Each change only affects the points from ix onwards, and no inlet was
+    # found before ix, so the search goes on from the first sequence that
+    # includes a changed point rather than from the start.
+    start = 0
+    while 1:
+      for ix in xrange(start, len(pt)-3):
         # Check for horizontal left-going inlet
         if right_of(pt[ix],pt[ix+1]) and above(pt[ix+1],pt[ix+2]) and left_of(pt[ix+2],pt[ix+3]):
           # Make sure minSize requirement is met
           if pt[ix][1]-pt[ix+3][1] < minSize:
             # Get rid of middle two points, extend Y-value of highest point down to lowest point
-            pt[ix] = (pt[ix][0],pt[ix+3][1])
-            del pt[ix+1:ix+3]
+            self.replacePoints(ix, ix+3, [(pt[ix][0],pt[ix+3][1])])
+            start = max(ix-3, 0)
             break
 
         # Check for horizontal right-going inlet
@@ -259,8 +382,8 @@ mirrored-L corner __  |      |
           # Make sure minSize requirement is met
           if pt[ix+3][1]-pt[ix][1] < minSize:
             # Get rid of middle two points, exten Y-value of highest point down to lowest point
-            pt[ix+3] = (pt[ix+3][0], pt[ix][1])
-            del pt[ix+1:ix+3]
+            self.replacePoints(ix+1, ix+4, [(pt[ix+3][0], pt[ix][1])])
+            start = max(ix-3, 0)
             break
 
         # Check for vertical inlets
@@ -269,14 +392,13 @@ mirrored-L corner __  |      |
           if pt[ix+3][0]-pt[ix][0] < minSize:
             # Is right side lower or higher?
             if pt[ix+3][1]>=pt[ix][1]:   # higher?
-              pt[ix] = (pt[ix+3][0], pt[ix][1]) # Move first point to the right
+              self.replacePoints(ix, ix+3, [(pt[ix+3][0], pt[ix][1])]) # Move first point to the right
             else:                        # lower?
-              pt[ix+3] = (pt[ix][0], pt[ix+3][1]) # Move last point to the left
-            del pt[ix+1:ix+3]
+              self.replacePoints(ix+1, ix+4, [(pt[ix][0], pt[ix+3][1])]) # Move last point to the left
+            start = max(ix-3, 0)
             break
-
       else:
-        done = 1
+        break
 
   def addLJob(self, ix, X, Y, Job, cfg=config.Config):
     """Add a job to the tiling at L-point self.points[ix] with actual dimensions X-by-Y.
@@ -287,8 +409,8 @@ mirrored-L corner __  |      |
     x,y = self.points[ix]
     x_tr = x+X
     y_tr = y+Y
-    self.points[ix:ix+1] = [(x,y_tr), (x_tr,y_tr), (x_tr,y)]
-    self.jobs.append( ((x,y),(x_tr,y_tr),Job) )
+    self.replacePoints(ix, ix+1, [(x,y_tr), (x_tr,y_tr), (x_tr,y)])
+    self.appendJob( ((x,y),(x_tr,y_tr),Job) )
         
     self.mergePoints(ix-1)
 
@@ -301,8 +423,8 @@ mirrored-L corner __  |      |
     x_tr,y = self.points[ix]
     x    = x_tr-X
     y_tr = y+Y
-    self.points[ix:ix+1] = [(x,y), (x,y_tr), (x_tr,y_tr)]
-    self.jobs.append( ((x,y),(x_tr,y_tr),Job) )
+    self.replacePoints(ix, ix+1, [(x,y), (x,y_tr), (x_tr,y_tr)])
+    self.appendJob( ((x,y),(x_tr,y_tr),Job) )
         
     self.mergePoints(ix-1)
 
@@ -319,32 +441,68 @@ mirrored-L corner __  |      |
 
   def bounds(self):
     """Return 2-tuple ((minX, minY), (maxX, maxY)) of rectangular region defined by all jobs"""
-    minX = minY = float(sys.maxint)
-    maxX = maxY = 0.0
-
-    for bl,tr,job in self.jobs:
-      minX = min(minX,bl[0])
-      maxX = max(maxX,tr[0])
-      minY = min(minY,bl[1])
-      maxY = max(maxY,tr[1])
+    if self.extents:
+      minX,minY,maxX,maxY = self.extents[-1][:4]
+    else:
+      minX = minY = float(sys.maxint)
+      maxX = maxY = 0.0
 
     return ( (minX,minY), (maxX-config.Config['xspacing'], maxY-config.Config['yspacing']) )
 
-  def area(self):
+  def area(self, cfg=config.Config):
     """Return area of rectangular region defined by all jobs."""
-    bl,tr = self.bounds()
+    if not self.extents:
+      bl,tr = self.bounds()
+      return (tr[0]-bl[0])*(tr[1]-bl[1])
 
-    DX = tr[0]-bl[0]
-    DY = tr[1]-bl[1]
+    minX,minY,maxX,maxY = self.extents[-1][:4]
+    DX = maxX-cfg['xspacing']-minX
+    DY = maxY-cfg['yspacing']-minY
     return DX*DY
 
   def usedArea(self):
     """Return total area of just jobs, not spaces in-between."""
-    area = 0.0
-    for job in self.jobs:
-      area += job[2].jobarea()
+    if self.extents:
+      return self.extents[-1][5]
+    return 0.0
+
+  def lowerBound(self, Jobs, cfg=config.Config):
+    """Return a lower bound on area() of any tiling that can be made from this one
+    by adding the jobs in Jobs, a list of 4-tuples (Xdim,Ydim,job,rjob).
+
+    Think of each job as a cell that includes the inter-job spacing. The
+    bounding box of the cells only grows as jobs are added, and it must be
+    large enough to hold the cells of all jobs, placed and remaining. The
+    bounding box also has to fit on the panel. area() is the bounding box
+    less one spacing in each direction. The smallest such area is therefore
+    found with the cell area just filled, at the narrowest or widest
+    allowed box."""
+    xspacing = cfg['xspacing']
+    yspacing = cfg['yspacing']
+
+    if self.extents:
+      minX,minY,maxX,maxY,A,usedArea = self.extents[-1]
+      W = maxX-minX
+      H = maxY-minY
+    else:
+      A = W = H = 0.0
+
+    for Xdim,Ydim,job,rjob in Jobs:
+      A += (Xdim+xspacing)*(Ydim+yspacing)
 
-    return area
+    if W*H >= A:
+      return (W-xspacing)*(H-yspacing)
+
+    # Smallest and largest bounding box widths that fit the panel and the cell area
+    W1 = max(W, A/self.ymax)
+    if H > 0:
+      W2 = min(self.xmax, A/H)
+    else:
+      W2 = self.xmax
+    if W1 > W2:
+      return float(sys.maxint)    # Remaining jobs cannot fit on the panel
+
+    return min((W1-xspacing)*(A/W1-yspacing), (W2-xspacing)*(A/W2-yspacing))
 
 # Function to estimate the maximum possible utilization given a list of jobs.
 # Jobs list is 4-tuple (Xdim,Ydim,job,rjob).
@@ -374,4 +532,32 @@ def minDimension(Jobs):
     M = min(M,Ydim)
   return M
 
+# Utility functions to pass tilings between processes. The jobs in a tiling
+# made by another process are copies, so each is described by its position in
+# the list of 4-tuples (Xdim,Ydim,job,rjob) used to make the tiling and by
+# whether it is rotated.
+def packTiling(T, Jobs):
+  "Return a compact description of tiling T of the jobs in Jobs, or None if T is None"
+  if T is None:
+    return None
+
+  index = {}
+  for ix in range(len(Jobs)):
+    index[id(Jobs[ix][2])] = (ix, 0)
+    index[id(Jobs[ix][3])] = (ix, 1)
+
+  return (T.points, [(bl, tr) + index[id(job)] for bl,tr,job in T.jobs])
+
+def unpackTiling(data, Jobs, X, Y):
+  "Inverse of packTiling(), for a tiling of an X-by-Y panel"
+  if data is None:
+    return None
+
+  points, placed = data
+  T = Tiling(X,Y)
+  T.points = points
+  for bl,tr,ix,rotated in placed:
+    T.appendJob((bl, tr, Jobs[ix][2+rotated]))
+  return T
+
 # vim: expandtab ts=2 sw=2